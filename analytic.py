@@ -0,0 +1,226 @@
+import hashlib
+import itertools
+import json
+import math
+import re
+
+import numpy as np
+
+from circuit_cache import cached_result, circuit_key, map_cases
+from linear_dem import LinearDEM
+from shot_store import compile_decoder, decode_bit_packed
+from sweep import CUSTOM_DECODERS
+
+# bump whenever the results of leading_order_estimate() change, so that cached
+# ones are not picked up:
+RESULT_VERSION = 1
+
+#------------------------------------------------------------------------------
+# mechanism rates
+#------------------------------------------------------------------------------
+#
+# In the sweeps every operation has error rate p and the crossed gates alpha * p
+# (see generate_tasks()). To first order in p, a mechanism with m_k eighths of
+# components of noise source k (see LinearDEM) fires with probability
+#
+#     q = (m_clifford p + m_crossing alpha p + 2 m_reset p + 2 m_measure p) / 16
+#       = p (a + b alpha),
+#
+# and a set S of w mechanisms fires alone with probability
+# prod_{i in S} p (a_i + b_i alpha) + O(p^(w + 1)). If w is the smallest number
+# of faults the decoder fails on, the logical error rate is therefore
+#
+#     p^w sum_{S failing, |S| = w} prod_{i in S} (a_i + b_i alpha) + O(p^(w + 1)),
+#
+# a polynomial in alpha of degree at most w times p^w.
+
+
+def mechanism_rates(linear : LinearDEM) -> tuple[np.ndarray, np.ndarray]:
+    ''' (a, b) of every mechanism of linear, its first-order probability
+    p (a + b alpha) at the noise of the sweeps.'''
+
+    m = linear.multiplicities / 16
+    return m[:, 0] + 2 * m[:, 2] + 2 * m[:, 3], m[:, 1]
+
+
+def mechanism_effects(linear : LinearDEM, num_detectors : int, num_observables : int) -> tuple[np.ndarray, np.ndarray]:
+    ''' The bit-packed detectors and observables every mechanism of linear
+    flips, one row per mechanism. The components of decomposed mechanisms are
+    combined.'''
+
+    detectors = np.zeros((len(linear.errors), num_detectors), dtype = np.uint8)
+    observables = np.zeros((len(linear.errors), num_observables), dtype = np.uint8)
+    for row, index in enumerate(linear.errors.tolist()):
+        for kind, k in re.findall(r'([DL])(\d+)', linear.lines[index]):
+            (detectors if kind == 'D' else observables)[row, int(k)] ^= 1
+    return (np.packbits(detectors, axis = 1, bitorder = 'little'),
+            np.packbits(observables, axis = 1, bitorder = 'little'))
+
+
+def _fault_sets(n : int, w : int, batch_size : int):
+    # all sets of w of n mechanisms, batch_size at a time:
+    combinations = itertools.combinations(range(n), w)
+    while True:
+        batch = np.fromiter(itertools.chain.from_iterable(itertools.islice(combinations, batch_size)),
+                            dtype = np.int64).reshape(-1, w)
+        if not len(batch):
+            return
+        yield batch
+
+
+def _alpha_polynomials(sets : np.ndarray, a : np.ndarray, b : np.ndarray) -> np.ndarray:
+    # coefficients of prod_{i in S} (a_i + b_i alpha) in increasing powers of alpha, summed over the sets:
+    coefficients = np.zeros((len(sets), sets.shape[1] + 1))
+    coefficients[:, 0] = 1
+    for column in sets.T:
+        shifted = coefficients[:, :-1] * b[column, None]
+        coefficients *= a[column, None]
+        coefficients[:, 1:] += shifted
+    return coefficients.sum(axis = 0)
+
+
+#------------------------------------------------------------------------------
+# leading-order estimate
+#------------------------------------------------------------------------------
+
+class LeadingOrderEstimate:
+    ''' Leading-order logical error rate p^order * sum_k coefficients[k] alpha^k
+    of one circuit structure and decoder (see leading_order_estimate()), with
+    the number of fault sets that failed out of those enumerated. order is None
+    if no set of up to max_faults faults failed.'''
+
+    def __init__(self, order : int | None, coefficients, failing : int, enumerated : int) -> None:
+        self.order = order
+        self.coefficients = np.asarray(coefficients, dtype = np.float64)
+        self.failing = failing
+        self.enumerated = enumerated
+
+    def rate(self, p, alpha = 1.0) -> np.ndarray:
+        ''' The estimate at p and alpha, which may be arrays.'''
+
+        p = np.asarray(p, dtype = np.float64)
+        if self.order is None:
+            return np.zeros(np.broadcast(p, np.asarray(alpha)).shape)
+        return p**self.order * np.polynomial.polynomial.polyval(alpha, self.coefficients)
+
+    def as_dict(self) -> dict:
+        return {
+            'order' : self.order,
+            'coefficients' : self.coefficients.tolist(),
+            'failing' : self.failing,
+            'enumerated' : self.enumerated,
+        }
+
+    def __repr__(self) -> str:
+        return f'LeadingOrderEstimate({self.as_dict()})'
+
+
+def leading_order_estimate(
+        decoder : str = 'batch_bposd',
+        max_faults : int = 3,
+        reference_p : float = 1e-3,
+        reference_alpha : float = 1.0,
+        batch_size : int = 100000,
+        max_sets : int = 10**7,
+        **structure,
+) -> LeadingOrderEstimate:
+    ''' Leading-order logical error rate of the circuit_builder() circuit with
+    the given structure arguments (all but the noise strengths), as a
+    polynomial in p and alpha.
+
+    Enumerates all sets of w = 1, 2, ... mechanisms of its detector error model
+    (the mechanisms sinter gives its decoders, decomposed where stim can
+    decompose them, see LinearDEM.from_template()), decodes their
+    syndromes with decoder, a name in CUSTOM_DECODERS, and stops at the first
+    w with failures, at most max_faults. Before enumerating the sets of w
+    mechanisms, it raises a ValueError if there are more than max_sets of
+    them: three faults of the A embeddings are already billions of sets,
+    which is the regime to sample instead (see FaultStrata in stratified.py).
+    The decoder is configured once, at
+    p = reference_p and alpha = reference_alpha, so the failing sets do not
+    follow the change of its priors with alpha.
+
+    Note that generate_tasks() builds the alpha = 0 points without crossings:
+    those match the estimate of the structure with crossings = 0.'''
+
+    linear = LinearDEM.from_layout(decompose_errors = True, **structure)
+    dem = linear.detector_error_model(
+        after_clifford_depolarization = reference_p,
+        after_crossing_depolarization = reference_alpha * reference_p,
+        after_reset_flip_probability = reference_p,
+        before_measure_flip_probability = reference_p,
+    )
+    a, b = mechanism_rates(linear)
+    detectors, observables = mechanism_effects(linear, dem.num_detectors, dem.num_observables)
+
+    sinter_decoder = CUSTOM_DECODERS[decoder]()
+    compiled = compile_decoder(sinter_decoder, dem)
+
+    enumerated = 0
+    for w in range(1, max_faults + 1):
+        if math.comb(len(a), w) > max_sets:
+            raise ValueError(f'no failures up to {w - 1} faults, and the {math.comb(len(a), w)} sets of {w} of the '
+                             f'{len(a)} mechanisms are more than max_sets = {max_sets}; lower max_faults or sample '
+                             'the failure rate instead (see FaultStrata)')
+        coefficients = np.zeros(w + 1)
+        failing = 0
+        for sets in _fault_sets(len(a), w, batch_size):
+            syndromes = np.bitwise_xor.reduce(detectors[sets], axis = 1)
+            predictions = decode_bit_packed(sinter_decoder, compiled, dem, syndromes)
+            failed = sets[np.any(predictions != np.bitwise_xor.reduce(observables[sets], axis = 1), axis = 1)]
+            failing += len(failed)
+            enumerated += len(sets)
+            if len(failed):
+                coefficients += _alpha_polynomials(failed, a, b)
+        if failing:
+            return LeadingOrderEstimate(w, coefficients, failing, enumerated)
+    return LeadingOrderEstimate(None, [], 0, enumerated)
+
+
+#------------------------------------------------------------------------------
+# embedding comparison
+#------------------------------------------------------------------------------
+
+def _cached_estimate(structure : dict, cache_dir : str, options : dict) -> dict:
+    key = hashlib.sha256(json.dumps([RESULT_VERSION, circuit_key(**structure), options],
+                                    sort_keys = True).encode()).hexdigest()
+    return cached_result(cache_dir, key, '.analytic.json',
+                         lambda: leading_order_estimate(**options, **structure).as_dict())
+
+
+def embedding_estimates(cases : dict[str, dict], max_workers : int | None = None,
+                        cache_dir : str = '.circuit_cache', **options) -> dict[str, LeadingOrderEstimate]:
+    ''' leading_order_estimate() for every case, a dict of circuit_builder()
+    structure arguments by name, across a process pool.
+
+    The coefficients do not depend on p or alpha, so they are cached in
+    cache_dir per structure (by circuit_key()), estimate options and
+    RESULT_VERSION (see cached_result()), and
+    evaluating them on any grid is free:
+
+        cases = {embedding[0] : dict(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                                     crossings = embedding[1], rounds = 3, observable = A1_log_obs['z'])
+                 for embedding in ...}
+        estimates = embedding_estimates(cases)
+        estimates['A1'].rate(ps, alpha = 2)'''
+
+    results = map_cases(_cached_estimate, cases, cache_dir, max_workers, options)
+    return {name : LeadingOrderEstimate(**result) for name, result in results.items()}
+
+
+def plot_estimates(ax, estimates : dict[str, LeadingOrderEstimate], ps, alpha : float = 1.0,
+                   plot_args_func = None) -> None:
+    ''' Overlay the estimates at alpha on an axis of sinter.plot_error_rate(),
+    as dashed lines over ps. plot_args_func(name) gives extra matplotlib
+    arguments per curve, e.g. the color of its sinter curve:
+
+        sinter.plot_error_rate(ax = ax, stats = stats, x_func = lambda stat: stat.json_metadata['p'],
+                               group_func = lambda stat: stat.json_metadata['crossing'])
+        plot_estimates(ax, embedding_estimates(cases), ps, alpha = 2)'''
+
+    ps = np.asarray(ps, dtype = np.float64)
+    for name, estimate in estimates.items():
+        args = {'linestyle' : '--', 'label' : f'{name} (order {estimate.order})'}
+        if plot_args_func is not None:
+            args |= plot_args_func(name)
+        ax.plot(ps, estimate.rate(ps, alpha), **args)
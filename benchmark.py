@@ -0,0 +1,219 @@
+import argparse
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from circuit import Layout, enumerate_gates, CircuitTemplate, circuit_builder
+from crossings_27_4_3 import hamming_A1, rep3_checks, embedding_A1
+
+#------------------------------------------------------------------------------
+# synthetic hypergraph product codes
+#------------------------------------------------------------------------------
+
+def repetition_checks(n : int) -> list[tuple[int, int]]:
+    ''' Checks of a length n repetition code, laid out like rep3_checks: bits
+    on the even and checks on the odd positions of a line of 2n - 1 sites.'''
+
+    return [(2*k + 1, 2*k + i) for k in range(n - 1) for i in [0, 2]]
+
+
+def hamming_matrix(r : int) -> np.ndarray:
+    ''' Parity check matrix of the [2^r - 1, 2^r - r - 1, 3] Hamming code.'''
+
+    columns = np.arange(1, 2**r)
+    return (columns[None, :] >> np.arange(r)[:, None]) & 1
+
+
+def line_checks(H : np.ndarray) -> tuple[list[tuple[int, int]], int]:
+    ''' Lay the checks and bits of a classical code with parity check matrix H
+    out on a line, spreading the checks evenly between the bits as in
+    hamming_A1. Returns the (check position, bit position) list and the length
+    of the line.'''
+
+    m, n = H.shape
+    positions = []
+    bit_positions = []
+    check_positions = []
+    for j in range(n):
+        bit_positions.append(len(positions))
+        positions.append(j)
+        # check i goes after the first (i + 1) * (n + 1) // (m + 1) bits:
+        while len(check_positions) < m and (len(check_positions) + 1) * (n + 1) // (m + 1) == j + 1:
+            check_positions.append(len(positions))
+            positions.append(None)
+
+    checks = [(check_positions[i], bit_positions[j]) for i, j in zip(*np.nonzero(H))]
+    return checks, len(positions)
+
+
+def hgp_cases(max_r : int = 4, rep_sizes = (3, 5, 9)) -> dict[str, dict]:
+    ''' circuit_builder() layouts for the HGP codes of the repetition and
+    Hamming codes, plus the A1 embedding of the [[27, 4, 3]] code.'''
+
+    cases = {
+        '27_4_3_A1' : dict(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                           crossings = embedding_A1[1]),
+    }
+
+    for n in rep_sizes:
+        checks = repetition_checks(n)
+        cases[f'rep{n}_x_rep{n}'] = dict(shape = (2*n - 1, 2*n - 1), row_checks = checks,
+                                         col_checks = checks, crossings = [])
+
+    for r in range(3, max_r + 1):
+        checks, length = line_checks(hamming_matrix(r))
+        cases[f'rep3_x_hamming{2**r - 1}'] = dict(shape = (5, length), row_checks = checks,
+                                                  col_checks = rep3_checks, crossings = [])
+        cases[f'hamming{2**r - 1}_x_hamming{2**r - 1}'] = dict(shape = (length, length), row_checks = checks,
+                                                              col_checks = checks, crossings = [])
+
+    return cases
+
+
+#------------------------------------------------------------------------------
+# stage timings
+#------------------------------------------------------------------------------
+
+NOISE = dict(
+    after_clifford_depolarization = 1e-3,
+    after_crossing_depolarization = 1e-2,
+    after_reset_flip_probability = 1e-3,
+    before_measure_flip_probability = 1e-3,
+)
+
+STAGES = ['layout', 'gate_enumeration', 'template', 'build', 'detector_error_model', 'sample']
+
+
+def stage_function(case : dict, rounds : int, shots : int, stage : str):
+    ''' Zero-argument function that runs one stage. Its inputs (the circuit
+    of the build stage for the later stages) are prepared here, so that only
+    the work of the stage itself is measured.'''
+
+    if stage == 'layout':
+        return lambda: Layout(case['shape'], case['row_checks'], case['col_checks'])
+    if stage == 'gate_enumeration':
+        layout = Layout(case['shape'], case['row_checks'], case['col_checks'])
+        return lambda: enumerate_gates(layout, case['row_checks'], case['col_checks'], case['crossings'])
+    if stage == 'template':
+        return lambda: CircuitTemplate.from_layout(**case, rounds = rounds)
+    if stage == 'build':
+        return lambda: circuit_builder(**case, rounds = rounds, **NOISE)
+
+    circuit = circuit_builder(**case, rounds = rounds, **NOISE)
+    if stage == 'detector_error_model':
+        return lambda: circuit.detector_error_model()
+    if stage == 'sample':
+        sampler = circuit.compile_detector_sampler()
+        return lambda: sampler.sample(shots)
+    raise ValueError(f'unknown stage {stage!r}')
+
+
+def _memory_kb(field : str) -> int:
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    raise KeyError(field)
+
+
+def _peak_rss_growth(case : dict, rounds : int, shots : int, stage : str) -> int | None:
+    # runs in a fresh process: the peak resident set (VmHWM) is reset to the
+    # current one after the setup, so the imports and setup do not mask it
+    function = stage_function(case, rounds, shots, stage)
+    try:
+        before = _memory_kb('VmRSS')
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+    function()
+    return 1024 * max(_memory_kb('VmHWM') - before, 0)
+
+
+def measure(case : dict, rounds : int, shots : int, stage : str, repeats : int) -> dict:
+    ''' Median wall time of a stage over repeats, and how far the peak
+    resident set size rises above the resident set after its setup, in one
+    extra run in a fresh process.
+
+    Unlike tracemalloc, the resident set also counts the memory allocated
+    inside stim, which is nearly all of it in the detector_error_model and
+    sample stages. Memory that the setup freed and the stage reuses is not
+    counted. Resetting the peak needs Linux's /proc/self/clear_refs; the
+    memory is None elsewhere.'''
+
+    function = stage_function(case, rounds, shots, stage)
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn')) as pool:
+        peak = pool.submit(_peak_rss_growth, case, rounds, shots, stage).result()
+
+    return {'seconds' : float(np.median(times)), 'peak_rss_bytes' : peak}
+
+
+def run_benchmarks(cases : dict, rounds : int = 3, shots : int = 10000, repeats : int = 5) -> dict:
+    ''' Per-stage timings and memory for every case, as a JSON-ready dict.'''
+
+    results = {}
+    for name, case in cases.items():
+        results[name] = {
+            'qubits' : case['shape'][0] * case['shape'][1],
+            'stages' : {stage : measure(case, rounds, shots, stage, repeats) for stage in STAGES},
+        }
+    return {
+        'rounds' : rounds,
+        'shots' : shots,
+        'repeats' : repeats,
+        'memory' : 'peak_rss_bytes: rise of the peak resident set size over the resident set after the stage setup, in a fresh process (null without Linux /proc)',
+        'results' : results,
+    }
+
+
+def compare(results : dict, baseline : dict, tolerance : float = 1.25) -> list[str]:
+    ''' Stages that got slower than tolerance times their baseline time.'''
+
+    regressions = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        for stage, measured in result['stages'].items():
+            before = baseline['results'][name]['stages'].get(stage)
+            if before and measured['seconds'] > tolerance * before['seconds']:
+                regressions.append(
+                    f"{name} | {stage}: {before['seconds'] * 1e3:.2f} ms -> {measured['seconds'] * 1e3:.2f} ms"
+                )
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark circuit construction, DEM extraction and sampling.')
+    parser.add_argument('--output', help = 'write the results as JSON to this file')
+    parser.add_argument('--baseline', help = 'JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type = float, default = 1.25, help = 'allowed slowdown factor per stage')
+    parser.add_argument('--rounds', type = int, default = 3)
+    parser.add_argument('--shots', type = int, default = 10000)
+    parser.add_argument('--repeats', type = int, default = 5)
+    parser.add_argument('--max-r', type = int, default = 4, help = 'largest Hamming code parameter r')
+    args = parser.parse_args()
+
+    results = run_benchmarks(hgp_cases(args.max_r), args.rounds, args.shots, args.repeats)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent = 2)
+    else:
+        print(json.dumps(results, indent = 2))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('regression:', regression, file = sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,207 @@
+import numpy as np
+import scipy.sparse
+import sinter
+import stim
+from ldpc.bposd_decoder import BpOsdDecoder
+from ldpc.ckt_noise.dem_matrices import detector_error_model_to_check_matrices
+
+#------------------------------------------------------------------------------
+# batched min-sum belief propagation
+#------------------------------------------------------------------------------
+
+class BatchMinSum:
+    ''' Min-sum belief propagation with the parallel schedule of ldpc's
+    BpDecoder, run on a batch of syndromes at once.
+
+    The messages of all shots live in (shots, edges) arrays, with the edges of
+    the check matrix H sorted by check. Check-to-bit messages take the minimum
+    over the other edges of a check from the smallest and second smallest
+    magnitudes per check, bit sums are sparse products. Shots leave the batch
+    as soon as their hard decision reproduces the syndrome, and the whole batch
+    stops early once less than a min_converging fraction of the remaining
+    shots converges in an iteration.'''
+
+    def __init__(self, check_matrix, priors, max_iter : int = 0, ms_scaling_factor : float = 1.0,
+                 min_converging : float = 0.0) -> None:
+        H = scipy.sparse.csr_matrix(check_matrix, dtype = np.uint8)
+        H.sort_indices()
+        self.H = H
+        self.max_iter = max_iter if max_iter > 0 else H.shape[1]
+        self.ms_scaling_factor = ms_scaling_factor
+        self.min_converging = min_converging
+
+        priors = np.asarray(priors, dtype = np.float64)
+        self.channel_llrs = np.log((1 - priors) / priors)
+
+        self.edge_checks = np.repeat(np.arange(H.shape[0]), np.diff(H.indptr))
+        self.edge_bits = H.indices
+        # checks without edges would break the segment reductions; their syndrome bit can never be matched anyway:
+        self.checks = np.nonzero(np.diff(H.indptr))[0]
+        self.check_starts = H.indptr[self.checks]
+        # edges x bits matrix that sums edge messages per bit:
+        self.edge_to_bit = scipy.sparse.csr_matrix(
+            (np.ones(len(self.edge_bits)), (np.arange(len(self.edge_bits)), self.edge_bits)),
+            shape = (len(self.edge_bits), H.shape[1]))
+
+    def _check_to_bit(self, bit_to_check, syndromes):
+        magnitudes = np.abs(bit_to_check)
+        negative = bit_to_check <= 0
+
+        # minimum over the other edges of the check: the smallest magnitude, or
+        # the second smallest one on the (unique) edge that holds the smallest.
+        # With no other edge it is the largest double, as in ldpc (an infinite
+        # message would turn the bit-to-check message into inf - inf):
+        min1 = np.minimum.reduceat(magnitudes, self.check_starts, axis = 0)[self.edge_checks]
+        is_min = magnitudes == min1
+        n_min = np.add.reduceat(is_min, self.check_starts, axis = 0, dtype = np.int32)[self.edge_checks]
+        magnitudes[is_min] = np.finfo(np.float64).max
+        min2 = np.minimum.reduceat(magnitudes, self.check_starts, axis = 0)[self.edge_checks]
+        others = np.where(is_min & (n_min == 1), min2, min1)
+
+        parity = np.add.reduceat(negative, self.check_starts, axis = 0, dtype = np.int32)
+        parity += syndromes[self.checks]
+        sign = (parity[self.edge_checks] & 1).astype(bool) ^ negative
+        others *= self.ms_scaling_factor
+        np.negative(others, out = others, where = sign)
+        return others
+
+    def decode(self, syndromes : np.ndarray, batch_size : int = 1024) -> tuple[np.ndarray, np.ndarray]:
+        ''' Hard decisions for a (shots, checks) boolean array of syndromes, and
+        a boolean array of the shots on which BP converged. Shots are decoded
+        batch_size at a time, which keeps the message arrays in cache.'''
+
+        decisions = np.zeros((len(syndromes), self.H.shape[1]), dtype = bool)
+        converged = np.zeros(len(syndromes), dtype = bool)
+        syndromes = np.asarray(syndromes, dtype = np.uint8)
+        for start in range(0, len(syndromes), batch_size):
+            stop = start + batch_size
+            decisions[start:stop], converged[start:stop] = self._decode_batch(syndromes[start:stop])
+        return decisions, converged
+
+    def _decode_batch(self, syndromes):
+        # messages are (edges, shots) arrays, so that per-edge gathers and
+        # per-check reductions work on whole contiguous rows:
+        shots = len(syndromes)
+        syndromes = np.ascontiguousarray(syndromes.T)
+        decisions = np.zeros((self.H.shape[1], shots), dtype = bool)
+        converged = np.zeros(shots, dtype = bool)
+
+        active = np.arange(shots)
+        bit_to_check = np.repeat(self.channel_llrs[self.edge_bits, None], shots, axis = 1)
+
+        for _ in range(self.max_iter):
+            check_to_bit = self._check_to_bit(bit_to_check, syndromes)
+            posteriors = self.edge_to_bit.T @ check_to_bit
+            posteriors += self.channel_llrs[:, None]
+            decision = posteriors <= 0
+            bit_to_check = posteriors[self.edge_bits] - check_to_bit
+
+            done = np.all((self.H @ decision.astype(np.uint8)) % 2 == syndromes, axis = 0)
+            decisions[:, active] = decision
+            converged[active[done]] = True
+
+            # results do not depend on where BP stops, the reference decoder
+            # redoes the unconverged shots, so stop once hardly any converge:
+            if done.all() or done.mean() < self.min_converging:
+                break
+            if done.any():
+                active = active[~done]
+                bit_to_check = bit_to_check[:, ~done]
+                syndromes = syndromes[:, ~done]
+
+        return decisions.T, converged
+
+
+#------------------------------------------------------------------------------
+# sinter decoder
+#------------------------------------------------------------------------------
+
+class BatchBpOsd:
+    ''' BP-OSD on a check matrix for batches of syndromes: BatchMinSum on all
+    distinct non-empty syndromes at once, and ldpc's BpOsdDecoder with the same
+    settings on the ones on which BP does not converge.'''
+
+    def __init__(self, check_matrix, priors, max_iter, ms_scaling_factor, osd_method, osd_order) -> None:
+        self.num_bits = check_matrix.shape[1]
+        self.bp = BatchMinSum(check_matrix, priors, max_iter, ms_scaling_factor, min_converging = 0.01)
+        # the reference decoder, only run on the shots that BP alone does not decode:
+        self.bposd = BpOsdDecoder(
+            check_matrix,
+            error_channel = list(priors),
+            max_iter = max_iter,
+            bp_method = 'ms',
+            ms_scaling_factor = ms_scaling_factor,
+            schedule = 'parallel',
+            osd_method = osd_method,
+            osd_order = osd_order,
+        )
+
+    def decode(self, syndromes : np.ndarray) -> np.ndarray:
+        ''' Error estimates, a (shots, bits) uint8 array, for a (shots, checks)
+        0/1 array of syndromes.'''
+
+        syndromes = np.ascontiguousarray(syndromes, dtype = np.uint8)
+        errors = np.zeros((len(syndromes), self.num_bits), dtype = np.uint8)
+
+        # shots without detection events need no decoding at all:
+        nonempty = np.nonzero(syndromes.any(axis = 1))[0]
+        if len(nonempty) == 0:
+            return errors
+
+        # decoding is deterministic, so every distinct syndrome is decoded once
+        # (at low p, most shots share a handful of syndromes):
+        packed = np.packbits(syndromes[nonempty], axis = 1)
+        rows = packed.view(np.dtype((np.void, packed.shape[1]))).reshape(-1)
+        _, first, inverse = np.unique(rows, return_index = True, return_inverse = True)
+        unique = syndromes[nonempty[first]]
+
+        decoded, converged = self.bp.decode(unique)
+        decoded = decoded.astype(np.uint8)
+        for k in np.nonzero(~converged)[0]:
+            decoded[k] = self.bposd.decode(unique[k])
+
+        errors[nonempty] = decoded[inverse.reshape(-1)]
+        return errors
+
+
+class CompiledBatchBpOsdDecoder(sinter.CompiledDecoder):
+    ''' BatchBpOsdDecoder configured for one detector error model.'''
+
+    def __init__(self, dem : stim.DetectorErrorModel, max_iter, ms_scaling_factor, osd_method, osd_order) -> None:
+        matrices = detector_error_model_to_check_matrices(dem, allow_undecomposed_hyperedges = True)
+        self.num_detectors = dem.num_detectors
+        self.observables_matrix = scipy.sparse.csr_matrix(matrices.observables_matrix, dtype = np.uint8)
+        self.decoder = BatchBpOsd(matrices.check_matrix, matrices.priors, max_iter, ms_scaling_factor, osd_method, osd_order)
+
+    def decode_shots_bit_packed(self, *, bit_packed_detection_event_data : np.ndarray) -> np.ndarray:
+        packed = np.ascontiguousarray(bit_packed_detection_event_data)
+        syndromes = np.unpackbits(packed, axis = 1, bitorder = 'little')[:, :self.num_detectors]
+        errors = self.decoder.decode(syndromes)
+        flips = (self.observables_matrix @ errors.T).T % 2
+        return np.packbits(flips.astype(np.uint8), axis = 1, bitorder = 'little')
+
+
+class BatchBpOsdDecoder(sinter.Decoder):
+    ''' Sinter decoder with the min-sum, parallel schedule configuration of
+    SinterBpOsdDecoder, that runs BP on all shots of a batch at once with
+    BatchMinSum. Shots without detection events are skipped, repeated syndromes
+    are decoded once, and only the syndromes on which BP does not converge go
+    to ldpc's BpOsdDecoder for OSD. Its predictions are the ones of
+    SinterBpOsdDecoder with the same settings.
+
+    The gain comes from the shots that need no decoding or share a syndrome,
+    so it is largest at low p: on 3-round memory circuits of the codes of
+    benchmark.hgp_cases(), it decodes 1.5 to 10 times faster at p <= 3e-4,
+    and only up to 1.3 times faster at p = 1e-3. At p >= 3e-3, where most
+    syndromes are distinct and OSD dominates, it is as fast or slightly slower.
+
+        sinter.collect(..., custom_decoders = {'batch_bposd' : BatchBpOsdDecoder(max_iter = 13, ms_scaling_factor = 0.5)})'''
+
+    def __init__(self, max_iter : int = 0, ms_scaling_factor : float = 0.625, osd_method : str = 'osd0', osd_order : int = 0) -> None:
+        self.max_iter = max_iter
+        self.ms_scaling_factor = ms_scaling_factor
+        self.osd_method = osd_method
+        self.osd_order = osd_order
+
+    def compile_decoder_for_dem(self, *, dem : stim.DetectorErrorModel) -> CompiledBatchBpOsdDecoder:
+        return CompiledBatchBpOsdDecoder(dem, self.max_iter, self.ms_scaling_factor, self.osd_method, self.osd_order)
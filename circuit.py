@@ -1,21 +1,50 @@
+import itertools
 import numpy as np
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, ProcessPoolExecutor, wait
 import stim 
 
+from embedding import Embedding
+
 #------------------------------------------------------------------------------
 # Gate operations bundled with errors
 #------------------------------------------------------------------------------
 
+def group_noise(targets : list[int], p, width : int = 1) -> list[tuple[float, list[int]]]:
+    ''' Split targets into (probability, targets) groups of equal noise.
+
+    p is either one probability for all targets or an array with one entry per
+    group of width consecutive targets (per qubit, or per qubit pair of a
+    two-qubit gate). Groups keep the order of their first target, so that one
+    noise instruction is emitted per distinct probability.'''
+
+    if np.ndim(p) == 0:
+        return [(p, targets)]
+
+    p = np.asarray(p, dtype = np.float64)
+    if len(p) == 1:
+        return [(float(p[0]), targets)]
+
+    values, first, inverse, counts = np.unique(p, return_index = True, return_inverse = True, return_counts = True)
+    # a stable sort by value keeps the members of every group in order:
+    members = np.split(np.argsort(inverse.reshape(-1), kind = 'stable'), np.cumsum(counts)[:-1])
+    targets = np.asarray(targets).reshape(len(p), width)
+    return [(float(values[k]), targets[members[k]].reshape(-1).tolist()) for k in np.argsort(first).tolist()]
+
+
 def append_anti_basis_error(
                 circuit : stim.Circuit,
                 targets : list[int],
                 p : float,
                 basis: str) -> None:
     
-    if p > 0:
-        if basis == "X":
-            circuit.append("Z_ERROR", targets, p)
-        else:
-            circuit.append("X_ERROR", targets, p)
+    for p, targets in group_noise(targets, p):
+        if p > 0:
+            if basis == "X":
+                circuit.append("Z_ERROR", targets, p)
+            else:
+                circuit.append("X_ERROR", targets, p)
 
 
 def append_reset(
@@ -41,20 +70,42 @@ def append_gate_1(
         circuit.append('DEPOLARIZE1', targets, after_clifford_depolarization * 3/4)
         
 
+def append_depolarize_2(
+                circuit : stim.Circuit,
+                targets : list[int],
+                after_clifford_depolarization : float, 
+                Cr : int,
+                compose_crossings : bool = True
+            ) -> None:
+        
+        # one strength per gate is grouped into one instruction per distinct strength:
+        for p, targets in group_noise(targets, after_clifford_depolarization, width = 2):
+            if p > 0:
+                # account for the number of crossings:
+                if Cr == 1:
+                    # we multiply by 15/16 so maximal mixing happens at p = 1
+                    circuit.append('DEPOLARIZE2', targets, p*15/16)
+                elif compose_crossings:
+                    # Cr depolarizing channels compose into one, with fidelity factor (1 - p)^Cr
+                    # (computed without cancellation at small p)
+                    circuit.append('DEPOLARIZE2', targets, float(-np.expm1(Cr*np.log1p(-p)))*15/16)
+                else:
+                    for _ in range(Cr):
+                        # we multiply by 15/16 so maximal mixing happens at p = 1
+                        circuit.append('DEPOLARIZE2', targets, p*15/16)
+
+
 def append_gate_2(
                 circuit : stim.Circuit,
                 name : str,
                 targets : list[int],
                 after_clifford_depolarization : float, 
-                Cr : int
+                Cr : int,
+                compose_crossings : bool = True
             ) -> None:
         
         circuit.append(name, targets)
-        if after_clifford_depolarization > 0:
-            # account for the number of crossings:
-            for _ in range(Cr):
-                # we multiply by 15/16 so maximal mixing happens at p = 1
-                circuit.append('DEPOLARIZE2', targets, after_clifford_depolarization*15/16)
+        append_depolarize_2(circuit, targets, after_clifford_depolarization, Cr, compose_crossings)
 
 def append_MR(
             circuit : stim.Circuit,
@@ -85,285 +136,841 @@ def append_M(
 
 
 #------------------------------------------------------------------------------
-# circuit building
+# qubit layout
 #------------------------------------------------------------------------------
 
+class Layout:
+    ''' Positions of the data and check qubits of a hypergraph product code.
 
-def circuit_builder(
-        shape,
-        row_checks,
-        col_checks,
-        crossings,
-        rounds,
-        experiment = 'z_memory',
-        observable = False,
-        after_crossing_depolarization : float = 0,
-        after_clifford_depolarization : float = 0,
-        after_reset_flip_probability : float = 0,
-        before_measure_flip_probability : float = 0,
-):
-    
-    # data preparation: 
-    #--------------------------------------------------------------------------
-    
-    row = np.zeros(shape[1], dtype = int)
-    col = np.zeros(shape[0], dtype = int)
-
-    for check in row_checks:
-        row[check[0]] = 1
-    for check in col_checks:
-        col[check[0]] = 1
-
-    # initialize matrix that describes the positions of the data and check qubits
-    qubit_matrix = np.empty(shape = shape, dtype = str)
-
-    # dictionaries for coordinates and qubit indexes:
-    data_qubits = {} 
-    x_checks = {}
-    z_checks = {}
-    counter  = 0
-
-    for i, col_val in enumerate(col): 
-        for j, row_val in enumerate(row):
-            
-            if row_val == col_val:
-                qubit_matrix[i][j] = 'Q'
-                data_qubits.update({(i, j) : counter})
-                counter += 1
-
-
-            if row_val == 0 and col_val == 1 :
-                qubit_matrix[i][j] = 'X'
-                x_checks.update({(i, j) : counter})
-                counter += 1
-
-            if row_val == 1 and col_val == 0 :
-                qubit_matrix[i][j] = 'Z'
-                z_checks.update({(i, j) : counter })
-                counter += 1
-
-    all_coords  = data_qubits  | x_checks | z_checks
-
-    basis = 'X' if experiment == 'x_memory' else 'Z'
-
-    # circuit assembly
-    #--------------------------------------------------------------------------
-
-    # cycle to repeat:
-    def cycle(
-              after_clifford_depolarization = after_clifford_depolarization,
-              after_crossing_depolarization = after_crossing_depolarization,
-              before_measure_flip_probability = before_measure_flip_probability,
-              after_reset_flip_probability = after_reset_flip_probability
-              ):
-        circ_cycle = stim.Circuit()
-        
-        append_gate_1(circ_cycle, 'H', [*x_checks.values()],  after_clifford_depolarization)
+    A cell (i, j) holds a data qubit if row i and column j are both checks or
+    both bits of the classical codes, an X check if only row i is a check and a
+    Z check if only column j is. Every cell holds one qubit and qubits are
+    numbered row by row, so the qubit index of (i, j) is i * shape[1] + j.
 
-        global z_pairings
-        z_pairings = {}
-        global x_pairings
-        x_pairings = {}
-        
-        all_gates = []
-        z_gates = []
-        x_gates = []
-
-        # iterate through the qubit matrix:
-        for i in range(qubit_matrix.shape[0]):
-            for j in range(qubit_matrix.shape[1]):
-
-                
-                for c_c in col_checks:
-                    if c_c[0] == i:
-
-                        if qubit_matrix[i][j] == 'Q':
-                            error = after_clifford_depolarization
-                            Cr = 1
-                            if crossings:
-                                for crossing in crossings:
-                                    if crossing[0] == (c_c[1], j) and crossing[1] == (i, j):
-                                        error = after_crossing_depolarization
-                                        Cr = crossing[2]
-                                    
-                                all_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], error, Cr])
-                                z_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], error, Cr])
- 
-                            else:           
-                                all_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], after_clifford_depolarization, 1])
-                                z_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], after_clifford_depolarization, 1])
-
-                            if (c_c[1], j) in z_pairings:
-                                z_pairings[(c_c[1], j)].append((i, j))
-                            else:
-                                z_pairings[(c_c[1], j)] = [(i, j)]
-
-
-                        else:
-                            error = after_clifford_depolarization
-                            Cr = 1
-                            if crossings:
-                                for crossing in crossings:
-                                    if crossing[1] == (c_c[1], j) and crossing[0] == (i, j):
-                                        error = after_crossing_depolarization
-                                        Cr = crossing[2]
-                                
-                                all_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], error, Cr])
-                                x_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], error, Cr])
-                            
-                            else:           
-                                all_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], after_clifford_depolarization, 1])
-                                x_gates.append([[all_coords[(i, j)], all_coords[(c_c[1], j)]], after_clifford_depolarization, 1])
-
-                            if (i, j) in x_pairings:
-                                x_pairings[(i, j)].append((c_c[1], j))
-                            else:
-                                x_pairings[(i, j)] = [(c_c[1], j)]
-
-                
-                for r_c in row_checks:
-                    if r_c[0] == j:
-                        if qubit_matrix[i][j] == 'Q':
-                            error = after_clifford_depolarization
-                            Cr = 1
-                            if crossings:
-                                for crossing in crossings:
-                                    if crossing[0] == (i, r_c[1]) and crossing[1] == (i, j):
-                                        error = after_crossing_depolarization
-                                        Cr = crossing[2]
-                                        
-                                
-                                all_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], error, Cr])
-                                x_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], error, Cr])
-                            else:           
-                                all_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], after_clifford_depolarization, 1])
-                                x_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], after_clifford_depolarization, 1])
-
-                            if (i, r_c[1]) in x_pairings:
-                                x_pairings[(i, r_c[1])].append((i, j))
-                            else:
-                                x_pairings[(i, r_c[1])] = [(i, j)]
-
-                        else:
-                            error = after_clifford_depolarization
-                            Cr = 1
-                            if crossings:
-                                for crossing in crossings:
-                                    if crossing[1] == (i, r_c[1]) and crossing[0] == (i, j):
-                                        error = after_crossing_depolarization
-                                        Cr = crossing[2]
-
-                                all_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], error, Cr])
-                                z_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], error, Cr])
-                            else:           
-                                all_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], after_clifford_depolarization, 1])
-                                z_gates.append([[all_coords[(i, r_c[1])], all_coords[(i, j)]], after_clifford_depolarization, 1])
-
-                            if (i, j) in z_pairings:
-                                z_pairings[(i, j)].append((i, r_c[1])) 
-                            else:
-                                z_pairings[(i, j)] = [(i, r_c[1])]
-
-        for check in sorted(x_gates, key = lambda x : x[0][0]):
-            append_gate_2(circ_cycle, 'CNOT', check[0], check[1], check[2]) 
-
-        for check in sorted(z_gates, key = lambda x : x[0][1]):
-            append_gate_2(circ_cycle, 'CNOT', check[0], check[1], check[2]) 
-
-
-        append_gate_1(circ_cycle, 'H', [*x_checks.values()],  after_clifford_depolarization)
-
-        append_MR(circ_cycle, [*x_checks.values()] + [*z_checks.values()], before_measure_flip_probability, after_reset_flip_probability)
-
-        return circ_cycle
-    
+    roles   : integer matrix of DATA / X_CHECK / Z_CHECK codes
+    index   : integer matrix of qubit indexes
+    data_coords, x_coords, z_coords : (n, 2) coordinate arrays, row-major order
+    data_index, x_index, z_index    : the matching qubit indexes
+    data_qubits, x_checks, z_checks : {(i, j) : qubit index} lookups'''
 
-    # head of circuit:
-    noisy_cycle = cycle()
-    noisy_head_cycle = cycle()
+    DATA = 0
+    X_CHECK = 1
+    Z_CHECK = 2
 
-    head = stim.Circuit()
+    def __init__(self, shape, row_checks, col_checks) -> None:
+        self.shape = tuple(shape)
 
-    for coord, index in all_coords.items():
-        head.append('QUBIT_COORDS', [index], [coord[0], coord[1]])
-    
-    # magically noiseless state initialization:
-    append_reset(head, [*data_qubits.values()],0 , basis)
-    append_reset(head, [*x_checks.values()] + [*z_checks.values()], 0)
+        # indicator vectors of the check columns and check rows:
+        row = np.zeros(shape[1], dtype = int)
+        col = np.zeros(shape[0], dtype = int)
+        row[[check[0] for check in row_checks]] = 1
+        col[[check[0] for check in col_checks]] = 1
 
-    head += noisy_head_cycle
+        self.roles = np.where(col[:, None] == row[None, :], self.DATA,
+                              np.where(col[:, None] == 1, self.X_CHECK, self.Z_CHECK))
+        self.index = np.arange(shape[0] * shape[1]).reshape(shape)
+
+        self.data_coords = np.argwhere(self.roles == self.DATA)
+        self.x_coords = np.argwhere(self.roles == self.X_CHECK)
+        self.z_coords = np.argwhere(self.roles == self.Z_CHECK)
+
+        self.data_index = self.index[self.roles == self.DATA]
+        self.x_index = self.index[self.roles == self.X_CHECK]
+        self.z_index = self.index[self.roles == self.Z_CHECK]
+
+        self.data_qubits = self._lookup(self.data_coords, self.data_index)
+        self.x_checks = self._lookup(self.x_coords, self.x_index)
+        self.z_checks = self._lookup(self.z_coords, self.z_index)
+
+    @staticmethod
+    def _lookup(coords : np.ndarray, index : np.ndarray) -> dict[tuple[int, int], int]:
+        return dict(zip(map(tuple, coords.tolist()), index.tolist()))
+
+
+#------------------------------------------------------------------------------
+# check and crossing lookups
+#------------------------------------------------------------------------------
+
+def check_adjacency(checks : list[tuple[int, int]]) -> dict[int, list[int]]:
+    ''' Group a check list by check position: maps each check row (column) to
+    the rows (columns) it couples to, in the order they appear in the list.'''
+
+    adjacency = {}
+    for check in checks:
+        adjacency.setdefault(check[0], []).append(check[1])
+    return adjacency
+
+
+def crossing_map(crossings : list | Embedding) -> dict[tuple, int]:
+    ''' Index a crossing list or Embedding by its (check, data) coordinate
+    pair. If a pair appears more than once, the last entry wins.'''
+
+    if isinstance(crossings, Embedding):
+        return crossings.crossing_map()
+    return {(crossing[0], crossing[1]) : crossing[2] for crossing in crossings}
+
+
+#------------------------------------------------------------------------------
+# gate enumeration
+#------------------------------------------------------------------------------
+
+def enumerate_gates(layout : Layout, row_checks, col_checks, crossings) -> tuple[list, list, dict, dict]:
+    ''' List the CNOTs of one syndrome extraction cycle.
+
+    Returns the X-check and Z-check gates as [[control, target], error, Cr]
+    entries, where error is the CLIFFORD or CROSSING noise slot, together with
+    the x_pairings and z_pairings that map every check coordinate to the data
+    qubit coordinates it acts on.'''
+
+    roles = layout.roles.tolist()
+    all_coords = layout.data_qubits | layout.x_checks | layout.z_checks
+
+    # lookups built once, instead of scanning the check and crossing lists per gate:
+    col_adjacency = check_adjacency(col_checks)
+    row_adjacency = check_adjacency(row_checks)
+    crossing_lookup = crossing_map(crossings) if crossings else {}
+
+    z_pairings = {}
+    x_pairings = {}
+
+    z_gates = []
+    x_gates = []
+
+    def gate_noise(check, data):
+        # crossed gates get the crossing error, repeated Cr times:
+        if (check, data) in crossing_lookup:
+            return CROSSING, crossing_lookup[(check, data)]
+        return CLIFFORD, 1
+
+    # iterate through the qubit matrix:
+    for i in range(layout.shape[0]):
+        for j in range(layout.shape[1]):
+
+            for partner in col_adjacency.get(i, []):
+                control, target = (i, j), (partner, j)
+
+                if roles[i][j] == Layout.DATA:
+                    # data qubit -> Z check
+                    error, Cr = gate_noise(target, control)
+                    z_gates.append([[all_coords[control], all_coords[target]], error, Cr])
+                    z_pairings.setdefault(target, []).append(control)
+
+                else:
+                    # X check -> data qubit
+                    error, Cr = gate_noise(control, target)
+                    x_gates.append([[all_coords[control], all_coords[target]], error, Cr])
+                    x_pairings.setdefault(control, []).append(target)
+
+            for partner in row_adjacency.get(j, []):
+                control, target = (i, partner), (i, j)
+
+                if roles[i][j] == Layout.DATA:
+                    # X check -> data qubit
+                    error, Cr = gate_noise(control, target)
+                    x_gates.append([[all_coords[control], all_coords[target]], error, Cr])
+                    x_pairings.setdefault(control, []).append(target)
+
+                else:
+                    # data qubit -> Z check
+                    error, Cr = gate_noise(target, control)
+                    z_gates.append([[all_coords[control], all_coords[target]], error, Cr])
+                    z_pairings.setdefault(target, []).append(control)
+
+    return x_gates, z_gates, x_pairings, z_pairings
+
+
+#------------------------------------------------------------------------------
+# CNOT scheduling
+#------------------------------------------------------------------------------
+
+def schedule_layers(gates : list) -> list[list]:
+    ''' Pack two-qubit gates into layers in which no qubit is used twice.
+
+    The gates ([[control, target], error, Cr] entries of cycle()) are the edges
+    of a bipartite graph between control and target qubits, so they can be
+    edge coloured with as many colours as the largest qubit degree (Koenig's
+    theorem). Each colour is one layer. Conflicts are resolved by swapping the
+    colours along an alternating path. Layers keep the input order of gates.'''
+
+    # colours[q][c] is the qubit that q shares its gate of colour c with
+    colours = {}
+    gate_colours = {}
+    edge_gates = {}
+
+    def free_colour(qubit):
+        c = 0
+        while c in colours.get(qubit, {}):
+            c += 1
+        return c
+
+    for n, gate in enumerate(gates):
+        u, v = gate[0]
+        a = free_colour(u)
+        b = free_colour(v)
+
+        if a in colours.get(v, {}):
+            # walk the a/b alternating path starting at v and swap its colours
+            path = []
+            x, c = v, a
+            while c in colours.get(x, {}):
+                y = colours[x][c]
+                path.append((x, y, c))
+                x, c = y, (b if c == a else a)
+            for x, y, c in path:
+                del colours[x][c]
+                del colours[y][c]
+            for x, y, c in path:
+                swapped = b if c == a else a
+                colours[x][swapped] = y
+                colours[y][swapped] = x
+                gate_colours[edge_gates[frozenset((x, y))]] = swapped
+
+        colours.setdefault(u, {})[a] = v
+        colours.setdefault(v, {})[a] = u
+        gate_colours[n] = a
+        edge_gates[frozenset((u, v))] = n
+
+    layers = [[] for _ in range(max(gate_colours.values(), default = -1) + 1)]
+    for n, gate in enumerate(gates):
+        layers[gate_colours[n]].append(gate)
+
+    return layers
 
-    if basis == 'Z':
-        for i, coord in enumerate([*z_checks.keys()]):
-            head.append('DETECTOR',
-                           [stim.target_rec(-i-1)],
-                           )
-    
-    elif basis == 'X':
-        for i, coord in enumerate([*x_checks.keys()]):
-            head.append('DETECTOR',
-                           [stim.target_rec(-i-1-len([*z_checks.values()]))],
-                           )
-    # body of the circuit (that we repeat for the specified number of rounds) 
-    body = noisy_cycle.copy()
-
-    if basis == 'Z':
-        for i, coord in enumerate([*z_checks.keys()]):
-            body.append('DETECTOR',
-                        [stim.target_rec(-i-1), stim.target_rec(-i-len([*z_checks.values()] + [*x_checks.values()])-1)],
-                        )
-    
-    elif basis == 'X':
-        for i, coord in enumerate([*x_checks.keys()]):
-            body.append('DETECTOR',
-                        [stim.target_rec(-i-1-len([*z_checks.values()])),stim.target_rec(-i-len([*z_checks.values()] + [*z_checks.values()] + [*x_checks.values()])-1)],
-                        )
-
-    # tail of the circuit
-    tail = stim.Circuit()
-    #magically noiseless final data qubit measurements:
-    append_M(tail, [*data_qubits.values()], 0, basis)
-
-    reindexed_data_q = {index : i for i, index in enumerate(data_qubits)}
-
-    if basis == 'Z':
-        for i, z_pair in enumerate(z_pairings):
-            tail.append(
-                'DETECTOR',
-                [stim.target_rec(-len(data_qubits) + reindexed_data_q[i]) for i in z_pairings[z_pair]] \
-                + [stim.target_rec(-(len(data_qubits) + len(z_checks)) + i)]
-                        ) 
-            
-    elif basis == 'X':
-        for i, x_pair in enumerate(x_pairings):
-            tail.append(
-                'DETECTOR',
-                [stim.target_rec(-len(data_qubits) + reindexed_data_q[i]) for i in x_pairings[x_pair]] \
-                + [stim.target_rec(-(len(data_qubits) + len(z_checks) + len(x_checks)) + i)]
-                        ) 
-            
-    if observable != False :
+
+#------------------------------------------------------------------------------
+# build statistics
+#------------------------------------------------------------------------------
+
+NOISE_CHANNELS = ('X_ERROR', 'Z_ERROR', 'DEPOLARIZE1', 'DEPOLARIZE2')
+
+
+def instruction_counts(program : str) -> dict[str, int]:
+    ''' Number of executed instructions of every type in stim program text,
+    with the body of every REPEAT block counted as often as it repeats.'''
+
+    counts = {}
+    repeats = [1]
+    for line in program.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if line.startswith('REPEAT'):
+            repeats.append(repeats[-1] * int(line.split()[1]))
+        elif line == '}':
+            repeats.pop()
+        else:
+            name = line.split('(', 1)[0].split(' ', 1)[0]
+            counts[name] = counts.get(name, 0) + repeats[-1]
+    return counts
+
+
+class BuildStats:
+    ''' What building one circuit cost and what it produced.
+
+    times holds the wall time in seconds of every stage: 'layout',
+    'gate_enumeration', 'sort' (gate order, scheduling and noise grouping of
+    the cycle), 'detectors' (detectors, observables and the rest of the
+    template), 'program' (noise filled in, text written) and, for
+    circuit_builder(), 'parse'. counts holds:
+
+        cnots, crossed_cnots    CNOTs of one cycle, and those with crossing noise
+        matched_crossings       crossing entries that hit a gate of the cycle
+        unmatched_crossings     crossing entries that hit no gate (and are ignored)
+        detectors               detectors of the circuit
+        noise_channels          noise instructions of the circuit, REPEAT blocks unrolled
+        depolarize2_instructions
+                                DEPOLARIZE2 instructions of the circuit, REPEAT blocks unrolled
+                                (a crossed gate with compose_crossings = False has Cr of them)
+
+    and unmatched lists the (check, data) coordinates of the unmatched crossing
+    entries. key is free for the caller to tag the build with (CircuitCache
+    puts the circuit_key() there).'''
+
+    def __init__(self) -> None:
+        self.times = {}
+        self.counts = {}
+        self.unmatched = []
+        self.key = None
+        self._last = time.perf_counter()
+
+    def lap(self, stage : str) -> None:
+        ''' Book the time since the previous lap (or since creation) on stage.'''
+
+        now = time.perf_counter()
+        self.times[stage] = self.times.get(stage, 0.0) + now - self._last
+        self._last = now
+
+    def count_program(self, program : str) -> None:
+        ''' Fill in the circuit-size counts from the program text.'''
+
+        instructions = instruction_counts(program)
+        self.counts['detectors'] = instructions.get('DETECTOR', 0)
+        self.counts['noise_channels'] = sum(instructions.get(name, 0) for name in NOISE_CHANNELS)
+        self.counts['depolarize2_instructions'] = instructions.get('DEPOLARIZE2', 0)
+
+    def as_dict(self) -> dict:
+        return {'key' : self.key, 'times' : dict(self.times), 'counts' : dict(self.counts),
+                'unmatched' : [list(map(list, pair)) for pair in self.unmatched]}
+
+    def __repr__(self) -> str:
+        times = ', '.join(f'{stage} {1e3 * t:.2f} ms' for stage, t in self.times.items())
+        counts = ', '.join(f'{name} {n}' for name, n in self.counts.items())
+        return f'BuildStats({times}; {counts})'
+
+
+class BuildStatsCollector:
+    ''' Hook that aggregates the BuildStats of many builds, e.g. over all
+    circuits of a sweep:
+
+        collector = BuildStatsCollector()
+        run_sweep(..., build_hook = collector)
+        collector.summary()'''
+
+    def __init__(self) -> None:
+        self.builds = []
+
+    def __call__(self, stats : BuildStats) -> None:
+        self.builds.append(stats)
+
+    def summary(self) -> dict:
+        ''' Number of builds, total time per stage and total counts, and the
+        builds with unmatched crossing entries.'''
+
+        times = {}
+        counts = {}
+        for stats in self.builds:
+            for stage, t in stats.times.items():
+                times[stage] = times.get(stage, 0.0) + t
+            for name, n in stats.counts.items():
+                counts[name] = counts.get(name, 0) + n
+        return {
+            'builds' : len(self.builds),
+            'times' : times,
+            'counts' : counts,
+            'unmatched' : [stats for stats in self.builds if stats.unmatched],
+        }
+
+
+#------------------------------------------------------------------------------
+# circuit templates
+#------------------------------------------------------------------------------
+
+class NoiseSlot:
+    ''' Placeholder for a noise strength that is only filled in when a
+    CircuitTemplate is instantiated. The name matches the corresponding
+    keyword argument of circuit_builder().'''
+
+    def __init__(self, name : str) -> None:
+        self.name = name
+
+    def __repr__(self) -> str:
+        return f'NoiseSlot({self.name!r})'
+
+
+CLIFFORD = NoiseSlot('after_clifford_depolarization')
+CROSSING = NoiseSlot('after_crossing_depolarization')
+RESET = NoiseSlot('after_reset_flip_probability')
+MEASURE = NoiseSlot('before_measure_flip_probability')
+
+
+class NoiseLookup:
+    ''' Placeholder for per-gate or per-qubit noise strengths: entries indices
+    of the array passed as the keyword argument array (gate_noise, reset_noise
+    or measure_noise) of CircuitTemplate.program(), or the value of slot for
+    all of them if that array is not given.'''
+
+    def __init__(self, slot : NoiseSlot, array : str, indices : list[int]) -> None:
+        self.slot = slot
+        self.array = array
+        self.indices = indices
+
+    def __repr__(self) -> str:
+        return f'NoiseLookup({self.slot.name!r}, {self.array!r}, {len(self.indices)} entries)'
+
+
+class CircuitText:
+    ''' Minimal stand-in for stim.Circuit that the append_* helpers can write
+    into. Instructions are collected as stim program text and parsed in one go,
+    which is much cheaper than one stim.Circuit.append() call per instruction.'''
+
+    def __init__(self) -> None:
+        self.lines = []
+
+    def append(self, name : str, targets : list = (), arg = None) -> None:
+        if arg is None:
+            args = ''
+        elif isinstance(arg, (list, tuple)):
+            args = '(' + ', '.join(repr(float(a)) for a in arg) + ')'
+        else:
+            args = f'({float(arg)!r})'
+
+        if isinstance(targets, (int, stim.GateTarget)):
+            targets = [targets]
+
+        self.lines.append(name + args + ''.join(
+            f' rec[{t.value}]' if isinstance(t, stim.GateTarget) else f' {t}' for t in targets
+        ))
+
+    append_operation = append
+
+    def __str__(self) -> str:
+        return '\n'.join(self.lines)
+
+
+class CircuitTemplate:
+    ''' Noise-free structure of a circuit_builder() circuit.
+
+    The qubit layout, gate enumeration, gate order and detectors are worked out
+    once in from_layout(). The parts of the circuit are kept as lists of
+    (helper, args) calls to the append_* functions above, with NoiseSlots in
+    place of the noise strengths. instantiate() only replays these calls with
+    the slots filled in, so a sweep over p reuses one template.
+
+    The circuit is head + cycle + head_detectors, then rounds - 1 repetitions
+    of cycle + body_detectors, then tail. The noisy cycle is shared, so it is
+    only replayed once per instantiation.
+
+    gates lists the CNOTs of the cycle as [[control, target], error, Cr] in the
+    order of enumerate_gates(), X-check gates first: entry g of a gate_noise
+    array is the noise strength of gate gates[g]. num_qubits is the length of
+    the per-qubit reset_noise and measure_noise arrays. stats is the
+    BuildStats of from_layout().'''
+
+    def __init__(
+            self,
+            head : list,
+            cycle : list,
+            head_detectors : list,
+            body_detectors : list,
+            tail : list,
+            rounds : int,
+            gates : list = (),
+            num_qubits : int = 0,
+            stats : BuildStats | None = None,
+    ) -> None:
+        self.head = head
+        self.cycle = cycle
+        self.head_detectors = head_detectors
+        self.body_detectors = body_detectors
+        self.tail = tail
+        self.rounds = rounds
+        self.gates = list(gates)
+        self.num_qubits = num_qubits
+        self.stats = stats if stats is not None else BuildStats()
+
+    @classmethod
+    def from_layout(
+            cls,
+            shape,
+            row_checks,
+            col_checks,
+            crossings,
+            rounds,
+            experiment = 'z_memory',
+            observable = False,
+            compose_crossings = True,
+            schedule = 'sorted',
+    ) -> 'CircuitTemplate':
+
+        # data preparation:
+        #----------------------------------------------------------------------
+
+        stats = BuildStats()
+        layout = Layout(shape, row_checks, col_checks)
+
+        # dictionaries for coordinates and qubit indexes:
+        data_qubits = layout.data_qubits
+        x_checks = layout.x_checks
+        z_checks = layout.z_checks
+
+        all_coords  = data_qubits  | x_checks | z_checks
+
+        basis = 'X' if experiment == 'x_memory' else 'Z'
+        stats.lap('layout')
+
+        # circuit assembly
+        #----------------------------------------------------------------------
+
+        # cycle to repeat:
+        def cycle():
+            circ_cycle = []
+
+            circ_cycle.append((append_gate_1, ('H', [*x_checks.values()], CLIFFORD)))
+
+            x_gates, z_gates, x_pairings, z_pairings = enumerate_gates(layout, row_checks, col_checks, crossings)
+            stats.lap('gate_enumeration')
+
+            # number the gates in enumeration order, X-check gates first, for gate_noise:
+            gates.extend(x_gates + z_gates)
+            x_gates = [gate + [g] for g, gate in enumerate(x_gates)]
+            z_gates = [gate + [g + len(x_gates)] for g, gate in enumerate(z_gates)]
+
+            def gate_noise(gates):
+                return NoiseLookup(gates[0][1], 'gate_noise', [gate[3] for gate in gates])
+
+            x_gates = sorted(x_gates, key = lambda x : x[0][0])
+            z_gates = sorted(z_gates, key = lambda x : x[0][1])
+
+            if schedule == 'layered':
+                # all X-check gates before all Z-check gates, each packed into parallel layers:
+                circ_cycle.append((CircuitText.append, ('TICK',)))
+                for layer in schedule_layers(x_gates) + schedule_layers(z_gates):
+                    circ_cycle.append((CircuitText.append, ('CNOT', [qubit for check in layer for qubit in check[0]])))
+
+                    # one noise instruction per group of gates with equal noise:
+                    noise_groups = {}
+                    for check in layer:
+                        noise_groups.setdefault((check[1], check[2]), []).append(check)
+                    for (error, Cr), group in noise_groups.items():
+                        targets = [qubit for check in group for qubit in check[0]]
+                        circ_cycle.append((append_depolarize_2, (targets, gate_noise(group), Cr, compose_crossings)))
+
+                    circ_cycle.append((CircuitText.append, ('TICK',)))
+
+            else:
+                for check in x_gates:
+                    circ_cycle.append((append_gate_2, ('CNOT', check[0], gate_noise([check]), check[2], compose_crossings)))
+
+                for check in z_gates:
+                    circ_cycle.append((append_gate_2, ('CNOT', check[0], gate_noise([check]), check[2], compose_crossings)))
+
+
+            circ_cycle.append((append_gate_1, ('H', [*x_checks.values()], CLIFFORD)))
+
+            checks = [*x_checks.values()] + [*z_checks.values()]
+            circ_cycle.append((append_MR, (checks, NoiseLookup(MEASURE, 'measure_noise', checks),
+                                           NoiseLookup(RESET, 'reset_noise', checks))))
+
+            return circ_cycle, x_pairings, z_pairings
+
+
+        # head of circuit:
+        # the gates are the same in every round, so the cycle is built once:
+        gates = []
+        noisy_cycle, x_pairings, z_pairings = cycle()
+        stats.lap('sort')
+
+        # crossing entries that no gate of the cycle picked up:
+        paired = {(check, data) for pairings in (x_pairings, z_pairings)
+                  for check, datas in pairings.items() for data in datas}
+        crossed = crossing_map(crossings) if crossings else {}
+        stats.unmatched = [pair for pair in crossed if pair not in paired]
+        stats.counts['cnots'] = len(gates)
+        stats.counts['crossed_cnots'] = sum(gate[1] is CROSSING for gate in gates)
+        stats.counts['matched_crossings'] = len(crossed) - len(stats.unmatched)
+        stats.counts['unmatched_crossings'] = len(stats.unmatched)
+
+        head = []
+
+        for coord, index in all_coords.items():
+            head.append((CircuitText.append, ('QUBIT_COORDS', [index], [coord[0], coord[1]])))
+
+        # magically noiseless state initialization:
+        head.append((append_reset, ([*data_qubits.values()], 0, basis)))
+        head.append((append_reset, ([*x_checks.values()] + [*z_checks.values()], 0)))
+
+        # detectors carry the (row, column) of their check and the round,
+        # which SHIFT_COORDS advances by one after the head:
+        head_detectors = []
 
         if basis == 'Z':
+            for i, coord in enumerate([*z_checks.keys()]):
+                head_detectors.append((CircuitText.append, ('DETECTOR',
+                               [stim.target_rec(-i-1)],
+                               [coord[0], coord[1], 0],
+                               )))
 
-            for obs in observable:
-                logical_obs = []
+        elif basis == 'X':
+            for i, coord in enumerate([*x_checks.keys()]):
+                head_detectors.append((CircuitText.append, ('DETECTOR',
+                               [stim.target_rec(-i-1-len([*z_checks.values()]))],
+                               [coord[0], coord[1], 0],
+                               )))
+        # body of the circuit (that we repeat for the specified number of rounds)
+        body_detectors = [(CircuitText.append, ('SHIFT_COORDS', [], [0, 0, 1]))]
 
-                for j in range(qubit_matrix.shape[0]):
-                    if (j, obs) in reindexed_data_q:
-                        logical_obs.append(-len(data_qubits) + reindexed_data_q[(j, obs)])
+        if basis == 'Z':
+            for i, coord in enumerate([*z_checks.keys()]):
+                body_detectors.append((CircuitText.append, ('DETECTOR',
+                            [stim.target_rec(-i-1), stim.target_rec(-i-len([*z_checks.values()] + [*x_checks.values()])-1)],
+                            [coord[0], coord[1], 0],
+                            )))
+
+        elif basis == 'X':
+            for i, coord in enumerate([*x_checks.keys()]):
+                body_detectors.append((CircuitText.append, ('DETECTOR',
+                            [stim.target_rec(-i-1-len([*z_checks.values()])),stim.target_rec(-i-len([*z_checks.values()] + [*z_checks.values()] + [*x_checks.values()])-1)],
+                            [coord[0], coord[1], 0],
+                            )))
+
+        # tail of the circuit
+        tail = []
+        #magically noiseless final data qubit measurements:
+        tail.append((append_M, ([*data_qubits.values()], 0, basis)))
+
+        reindexed_data_q = {index : i for i, index in enumerate(data_qubits)}
+
+        # the final detectors compare the data measurements with the last round:
+        tail.append((CircuitText.append, ('SHIFT_COORDS', [], [0, 0, 1])))
+
+        if basis == 'Z':
+            for i, z_pair in enumerate(z_pairings):
+                tail.append((CircuitText.append, (
+                    'DETECTOR',
+                    [stim.target_rec(-len(data_qubits) + reindexed_data_q[i]) for i in z_pairings[z_pair]] \
+                    + [stim.target_rec(-(len(data_qubits) + len(z_checks)) + i)],
+                    [z_pair[0], z_pair[1], 0],
+                            )))
 
-                tail.append('OBSERVABLE_INCLUDE', [stim.target_rec(rec) for rec in logical_obs], obs)
-        
         elif basis == 'X':
+            for i, x_pair in enumerate(x_pairings):
+                tail.append((CircuitText.append, (
+                    'DETECTOR',
+                    [stim.target_rec(-len(data_qubits) + reindexed_data_q[i]) for i in x_pairings[x_pair]] \
+                    + [stim.target_rec(-(len(data_qubits) + len(z_checks) + len(x_checks)) + i)],
+                    [x_pair[0], x_pair[1], 0],
+                            )))
+
+        if observable != False :
+
+            if basis == 'Z':
+
+                for obs in observable:
+                    logical_obs = []
+
+                    for j in range(layout.shape[0]):
+                        if (j, obs) in reindexed_data_q:
+                            logical_obs.append(-len(data_qubits) + reindexed_data_q[(j, obs)])
+
+                    tail.append((CircuitText.append, ('OBSERVABLE_INCLUDE', [stim.target_rec(rec) for rec in logical_obs], obs)))
+
+            elif basis == 'X':
+
+                for i, obs in enumerate(observable):
+                    tail.append((CircuitText.append, ('OBSERVABLE_INCLUDE', [stim.target_rec(-len(data_qubits) + reindexed_data_q[obs_q]) for obs_q in obs], i)))
+
+        stats.lap('detectors')
+        return cls(head, noisy_cycle, head_detectors, body_detectors, tail, rounds, gates, layout.shape[0] * layout.shape[1], stats)
+
+    def program(
+            self,
+            after_crossing_depolarization : float = 0,
+            after_clifford_depolarization : float = 0,
+            after_reset_flip_probability : float = 0,
+            before_measure_flip_probability : float = 0,
+            gate_noise : np.ndarray | None = None,
+            reset_noise : np.ndarray | None = None,
+            measure_noise : np.ndarray | None = None,
+    ) -> str:
+        ''' Fill the noise slots with the given strengths and return the stim
+        program text of the circuit. Unlike str(stim.Circuit), the probabilities
+        are written out exactly.
+
+        gate_noise (one strength per entry of gates), reset_noise and
+        measure_noise (one probability per qubit index) replace the scalar
+        strengths of the CNOTs and of the check resets and measurements. A
+        crossed gate of strength p still gets its channel Cr times: composed
+        into one DEPOLARIZE2 of strength 1 - (1 - p)^Cr (compose_crossings,
+        the default of from_layout()), or repeated Cr times. Equal strengths of
+        gates or qubits that share an instruction are emitted as one noise
+        instruction.
+
+        The Hadamards on the X checks have no array: their DEPOLARIZE1 strength
+        is always after_clifford_depolarization. Pass it along with gate_noise,
+        or the Hadamards are noiseless:
+
+            template.program(after_clifford_depolarization = p, gate_noise = p * gate_factors)'''
+
+        noise = {
+            CROSSING : after_crossing_depolarization,
+            CLIFFORD : after_clifford_depolarization,
+            RESET : after_reset_flip_probability,
+            MEASURE : before_measure_flip_probability,
+        }
+
+        arrays = {}
+        for name, array, length in [('gate_noise', gate_noise, len(self.gates)),
+                                    ('reset_noise', reset_noise, self.num_qubits),
+                                    ('measure_noise', measure_noise, self.num_qubits)]:
+            if array is not None:
+                array = np.asarray(array, dtype = np.float64)
+                if array.shape != (length,):
+                    raise ValueError(f'{name} must have one entry per {"gate" if name == "gate_noise" else "qubit"} ({length}), not shape {array.shape}')
+                arrays[name] = array
+
+        def fill(arg):
+            if isinstance(arg, NoiseSlot):
+                return noise[arg]
+            if isinstance(arg, NoiseLookup):
+                if arg.array in arrays:
+                    return arrays[arg.array][arg.indices]
+                return noise[arg.slot]
+            return arg
+
+        def replay(calls):
+            circuit = CircuitText()
+            for helper, args in calls:
+                helper(circuit, *[fill(arg) for arg in args])
+            return str(circuit)
+
+        cycle = replay(self.cycle)
+        head = '\n'.join([replay(self.head), cycle, replay(self.head_detectors)])
+        body = '\n'.join([cycle, replay(self.body_detectors)])
+
+        if self.rounds - 1 > 1:
+            body = f'REPEAT {self.rounds - 1} {{\n{body}\n}}'
+        elif self.rounds - 1 < 1:
+            body = ''
+
+        return '\n'.join([head, body, replay(self.tail)])
+
+    def instantiate(self, **noise : float) -> stim.Circuit:
+        ''' Fill the noise slots with the given strengths and return the circuit.
+        Takes the same noise keyword arguments as program().'''
+
+        return stim.Circuit(self.program(**noise))
 
-            for i, obs in enumerate(observable):
-                tail.append('OBSERVABLE_INCLUDE', [stim.target_rec(-len(data_qubits) + reindexed_data_q[obs_q]) for obs_q in obs], i)
-            
-    return head + body * (rounds-1) + tail
 
+#------------------------------------------------------------------------------
+# circuit building
+#------------------------------------------------------------------------------
 
 
+def circuit_program(
+        shape,
+        row_checks,
+        col_checks,
+        crossings,
+        rounds,
+        experiment = 'z_memory',
+        observable = False,
+        after_crossing_depolarization : float = 0,
+        after_clifford_depolarization : float = 0,
+        after_reset_flip_probability : float = 0,
+        before_measure_flip_probability : float = 0,
+        compose_crossings : bool = True,
+        schedule : str = 'sorted',
+        gate_noise : np.ndarray | None = None,
+        reset_noise : np.ndarray | None = None,
+        measure_noise : np.ndarray | None = None,
+        stats_hook = None,
+) -> str:
+    ''' Same as circuit_builder(), but returns the exact stim program text.'''
+
+    template = CircuitTemplate.from_layout(
+        shape = shape,
+        row_checks = row_checks,
+        col_checks = col_checks,
+        crossings = crossings,
+        rounds = rounds,
+        experiment = experiment,
+        observable = observable,
+        compose_crossings = compose_crossings,
+        schedule = schedule,
+    )
+
+    program = template.program(
+        after_crossing_depolarization = after_crossing_depolarization,
+        after_clifford_depolarization = after_clifford_depolarization,
+        after_reset_flip_probability = after_reset_flip_probability,
+        before_measure_flip_probability = before_measure_flip_probability,
+        gate_noise = gate_noise,
+        reset_noise = reset_noise,
+        measure_noise = measure_noise,
+    )
+
+    if stats_hook is not None:
+        template.stats.lap('program')
+        template.stats.count_program(program)
+        stats_hook(template.stats)
+    return program
 
 
-    
\ No newline at end of file
+def circuit_builder(
+        shape,
+        row_checks,
+        col_checks,
+        crossings,
+        rounds,
+        experiment = 'z_memory',
+        observable = False,
+        after_crossing_depolarization : float = 0,
+        after_clifford_depolarization : float = 0,
+        after_reset_flip_probability : float = 0,
+        before_measure_flip_probability : float = 0,
+        compose_crossings : bool = True,
+        schedule : str = 'sorted',
+        gate_noise : np.ndarray | None = None,
+        reset_noise : np.ndarray | None = None,
+        measure_noise : np.ndarray | None = None,
+        stats_hook = None,
+):
+    ''' Build the stim circuit of a memory experiment, see CircuitTemplate.
+    With stats_hook, a callable, the BuildStats of the build are passed to it
+    once the circuit is parsed.'''
+
+    built = []
+    circuit = stim.Circuit(circuit_program(
+        shape = shape,
+        row_checks = row_checks,
+        col_checks = col_checks,
+        crossings = crossings,
+        rounds = rounds,
+        experiment = experiment,
+        observable = observable,
+        after_crossing_depolarization = after_crossing_depolarization,
+        after_clifford_depolarization = after_clifford_depolarization,
+        after_reset_flip_probability = after_reset_flip_probability,
+        before_measure_flip_probability = before_measure_flip_probability,
+        compose_crossings = compose_crossings,
+        schedule = schedule,
+        gate_noise = gate_noise,
+        reset_noise = reset_noise,
+        measure_noise = measure_noise,
+        stats_hook = None if stats_hook is None else built.append,
+    ))
+
+    if stats_hook is not None:
+        built[0].lap('parse')
+        stats_hook(built[0])
+    return circuit
+
+
+#------------------------------------------------------------------------------
+# parallel building
+#------------------------------------------------------------------------------
+
+
+def build_circuits_parallel(
+        param_grid,
+        max_workers : int | None = None,
+        executor : str = 'thread',
+):
+    ''' Build a circuit with circuit_builder() for every dictionary of keyword
+    arguments in param_grid, using a 'thread' or 'process' pool. The
+    (params, circuit) pairs are yielded in the order the builds finish.
+
+    param_grid is read lazily, and at most 2 * max_workers builds are in
+    flight or waiting to be yielded at a time, so memory stays bounded
+    however long the grid is.'''
+
+    if executor == 'thread':
+        pool_class = ThreadPoolExecutor
+    elif executor == 'process':
+        pool_class = ProcessPoolExecutor
+    else:
+        raise ValueError(f"executor must be 'thread' or 'process', not {executor!r}")
+
+    window = 2 * (max_workers or os.cpu_count() or 1)
+    param_grid = iter(param_grid)
+    with pool_class(max_workers = max_workers) as pool:
+        futures = {}
+        while True:
+            for params in itertools.islice(param_grid, window - len(futures)):
+                futures[pool.submit(circuit_program, **params)] = params
+            if not futures:
+                break
+            done, _ = wait(futures, return_when = FIRST_COMPLETED)
+            for future in done:
+                # circuits travel as exact program text, as pickling a stim.Circuit rounds its probabilities
+                yield futures.pop(future), stim.Circuit(future.result())
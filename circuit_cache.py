@@ -0,0 +1,260 @@
+import concurrent.futures
+import hashlib
+import inspect
+import json
+import os
+import re
+from collections import OrderedDict
+
+import numpy as np
+import stim
+
+from circuit import circuit_builder, circuit_program
+from embedding import Embedding
+
+# bump whenever circuit_builder() changes the circuits it produces, so that
+# stale cache entries are not picked up:
+CACHE_VERSION = 3
+
+
+#------------------------------------------------------------------------------
+# cache keys
+#------------------------------------------------------------------------------
+
+def _to_json(obj):
+    # embeddings hash like their crossing lists:
+    if isinstance(obj, Embedding):
+        return obj.crossings
+    # numpy scalars and arrays (e.g. from np.logspace or crossing_mapper)
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f'cannot hash {type(obj).__name__} as a circuit parameter')
+
+
+def circuit_key(**params) -> str:
+    ''' Content hash of the circuit_builder() keyword arguments. Defaults are
+    filled in, tuples and lists hash the same and floats are hashed exactly.'''
+
+    arguments = inspect.signature(circuit_builder).bind(**params)
+    arguments.apply_defaults()
+    # instrumentation does not change the circuit:
+    arguments.arguments.pop('stats_hook')
+    text = json.dumps([CACHE_VERSION, arguments.arguments], sort_keys = True, default = _to_json)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+#------------------------------------------------------------------------------
+# cache
+#------------------------------------------------------------------------------
+
+# names of the files CircuitCache writes; the directory is shared with other caches
+CACHE_FILE = re.compile(r'[0-9a-f]{64}(\.stim|\.dem|\.decomposed\.dem)')
+
+class CircuitCache:
+    ''' On-disk cache of circuit_builder() circuits and their detector error
+    models, keyed by circuit_key() of the builder arguments.
+
+    Circuits are stored as exact .stim program text and detector error models
+    as .dem text in directory. When these files grow beyond max_bytes, the least
+    recently used ones are deleted until they take up a fraction
+    evict_fraction of it. Other files in directory (e.g. ShotStore shots or
+    cached distances) are never touched, and neither are the file just written
+    and the paths pinned with pin() (e.g. the circuits of tasks that sinter
+    workers have yet to load) until unpin(). Pins only hold against eviction
+    by this object, not by other processes sharing directory. An in-process memo of the last
+    memo_size objects sits in front of the files. build_hook, if given, gets
+    the BuildStats of every circuit that is actually built (on a miss), with
+    its key set to the circuit_key().
+
+        cache = CircuitCache('.circuit_cache')
+        circuit = cache.circuit(shape = (5, 10), row_checks = hamming_A1, ...)
+        dem = cache.detector_error_model(shape = (5, 10), ...)'''
+
+    def __init__(self, directory : str = '.circuit_cache', max_bytes : int = 2**30, memo_size : int = 256,
+                 build_hook = None, evict_fraction : float = 0.9) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evict_fraction = evict_fraction
+        self.memo_size = memo_size
+        self.build_hook = build_hook
+        self.memo = OrderedDict()
+        self.pinned = set()
+        os.makedirs(directory, exist_ok = True)
+        # running size of the cache files, so that writes need not scan the directory.
+        # Other processes sharing the directory make it drift; it is recomputed on eviction.
+        self.total_bytes = sum(size for _, size, _ in self._entries())
+
+    def circuit(self, **params) -> stim.Circuit:
+        ''' The circuit_builder() circuit for params, built only on a miss.'''
+
+        key = circuit_key(**params)
+        return self._get(key + '.stim', stim.Circuit, lambda: self._program(key, params))
+
+    def circuit_path(self, **params) -> str:
+        ''' Path of the .stim file of the circuit for params, written only on a
+        miss. Nothing is parsed, so this is what sinter.Task(circuit_path = ...)
+        wants for tasks whose circuit is only loaded by the sinter workers.'''
+
+        key = circuit_key(**params)
+        path = os.path.join(self.directory, key + '.stim')
+        if os.path.exists(path):
+            self._touch(path)
+        else:
+            self._write(path, self._program(key, params))
+        return path
+
+    def detector_error_model(self, decompose_errors : bool = False, **params) -> stim.DetectorErrorModel:
+        ''' The detector error model of the circuit_builder() circuit for params.'''
+
+        key = circuit_key(**params)
+        suffix = '.decomposed.dem' if decompose_errors else '.dem'
+        return self._get(
+            key + suffix,
+            stim.DetectorErrorModel,
+            lambda: str(self.circuit(**params).detector_error_model(decompose_errors = decompose_errors)),
+        )
+
+    def pin(self, path : str) -> None:
+        ''' Keep the cache file at path from being evicted until unpin().'''
+
+        self.pinned.add(path)
+
+    def unpin(self) -> None:
+        ''' Release all pinned paths.'''
+
+        self.pinned.clear()
+
+    def _program(self, key : str, params : dict) -> str:
+        if self.build_hook is None:
+            return circuit_program(**params)
+
+        def hook(stats):
+            stats.key = key
+            self.build_hook(stats)
+
+        return circuit_program(**params, stats_hook = hook)
+
+    def clear(self) -> None:
+        ''' Delete the cached circuits and detector error models (only those).'''
+
+        self.memo.clear()
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self.total_bytes = 0
+
+    def _get(self, name : str, parse, make_text):
+        path = os.path.join(self.directory, name)
+        if name in self.memo:
+            self.memo.move_to_end(name)
+            self._touch(path)
+            return self.memo[name].copy()
+
+        try:
+            with open(path) as f:
+                text = f.read()
+            self._touch(path)
+        except FileNotFoundError:
+            text = make_text()
+            self._write(path, text)
+
+        value = parse(text)
+        self.memo[name] = value
+        if len(self.memo) > self.memo_size:
+            self.memo.popitem(last = False)
+        return value.copy()
+
+    def _write(self, path : str, text : str) -> None:
+        # write to a temporary file first, so that concurrent readers never see half a file:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(text)
+        try:
+            # a rewrite replaces the old file, which was counted already:
+            self.total_bytes -= os.path.getsize(path)
+        except FileNotFoundError:
+            pass
+        self.total_bytes += os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        if self.total_bytes > self.max_bytes:
+            self._evict(keep = path)
+
+    @staticmethod
+    def _touch(path : str) -> None:
+        # the modification time doubles as the last access time for eviction:
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _entries(self) -> list[tuple[float, int, str]]:
+        # (last access, size, path) of the files written by _write(), nothing else in the directory
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and CACHE_FILE.fullmatch(entry.name):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _evict(self, keep : str) -> None:
+        # evict down to a fraction of max_bytes, so that the scan is amortized over many writes
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.evict_fraction * self.max_bytes:
+                break
+            if path == keep or path in self.pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+
+#------------------------------------------------------------------------------
+# result caches
+#------------------------------------------------------------------------------
+#
+# Results derived from circuits (distances, analytic estimates) are cached as
+# <key><suffix> JSON files in the same directory. CircuitCache leaves them
+# alone: they are small and not evicted.
+
+def cached_result(cache_dir : str, key : str, suffix : str, compute) -> dict:
+    ''' The JSON result stored under key + suffix in cache_dir, or compute()
+    written there. Fresh results go through JSON as well, so that they agree
+    with cached ones (tuples become lists).'''
+
+    path = os.path.join(cache_dir, key + suffix)
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        pass
+
+    result = json.loads(json.dumps(compute()))
+
+    # write to a temporary file first, so that concurrent readers never see half a file:
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(result, f)
+    os.replace(tmp_path, path)
+    return result
+
+
+def map_cases(function, cases : dict, cache_dir : str, max_workers : int | None = None, *args) -> dict:
+    ''' function(case, cache_dir, *args) for every case of a dict by name,
+    across a process pool.'''
+
+    os.makedirs(cache_dir, exist_ok = True)
+    with concurrent.futures.ProcessPoolExecutor(max_workers = max_workers) as pool:
+        futures = {name : pool.submit(function, case, cache_dir, *args) for name, case in cases.items()}
+        return {name : future.result() for name, future in futures.items()}
@@ -0,0 +1,219 @@
+import time
+
+import numpy as np
+import scipy.sparse
+import sinter
+import stim
+
+from bp_decoder import BatchBpOsdDecoder
+from circuit import Layout, enumerate_gates
+from shot_store import compile_decoder, decode_bit_packed
+
+#------------------------------------------------------------------------------
+# parity-check matrices
+#------------------------------------------------------------------------------
+#
+# Columns are the data qubits of the Layout in its data_index order (row by
+# row), rows the X checks (Z checks) in its x_index (z_index) order.
+
+
+def _incidence(rows : list[list[int]], num_columns : int) -> scipy.sparse.csr_matrix:
+    indptr = np.cumsum([0] + [len(row) for row in rows])
+    indices = np.array([k for row in rows for k in row], dtype = np.int64)
+    matrix = scipy.sparse.csr_matrix((np.ones(len(indices), dtype = np.uint8), indices, indptr),
+                                     shape = (len(rows), num_columns))
+    matrix.sort_indices()
+    return matrix
+
+
+def parity_check_matrices(shape, row_checks, col_checks) -> tuple[scipy.sparse.csr_matrix, scipy.sparse.csr_matrix]:
+    ''' The X and Z parity-check matrices (hx, hz) of the HGP code of a layout,
+    as uint8 CSR matrices with one row per check and one column per data
+    qubit. They hold the same check supports as the detectors of
+    circuit_builder().'''
+
+    layout = Layout(shape, row_checks, col_checks)
+    _, _, x_pairings, z_pairings = enumerate_gates(layout, row_checks, col_checks, [])
+    columns = dict(zip(map(tuple, layout.data_coords.tolist()), range(len(layout.data_index))))
+
+    hx = _incidence([[columns[data] for data in x_pairings.get(check, [])] for check in layout.x_checks], len(columns))
+    hz = _incidence([[columns[data] for data in z_pairings.get(check, [])] for check in layout.z_checks], len(columns))
+    return hx, hz
+
+
+def logical_operators(shape, row_checks, col_checks, observable, experiment : str = 'z_memory') -> scipy.sparse.csr_matrix:
+    ''' The logical operators of a circuit_builder() observable list as a CSR
+    matrix over the data qubits, one row per observable: Z logicals given by
+    their column (A1_zlog_obs) for 'z_memory', X logicals given by their
+    (row, column) coordinates (A1_xlog_obs) for 'x_memory'.'''
+
+    layout = Layout(shape, row_checks, col_checks)
+    columns = dict(zip(map(tuple, layout.data_coords.tolist()), range(len(layout.data_index))))
+
+    if experiment == 'x_memory':
+        rows = [[columns[tuple(coord)] for coord in obs] for obs in observable]
+    else:
+        rows = [[columns[(i, obs)] for i in range(layout.shape[0]) if (i, obs) in columns] for obs in observable]
+    return _incidence(rows, len(columns))
+
+
+#------------------------------------------------------------------------------
+# code-capacity and phenomenological simulation
+#------------------------------------------------------------------------------
+#
+# With rounds noisy syndrome measurements, every one of the rounds + 1
+# syndromes (the last one from the data measurement, without errors) follows
+# fresh data errors of probability p, and the noisy ones flip every outcome
+# with probability q. Detector t compares syndromes t - 1 and t, so a data
+# error before syndrome t flips the detectors of its checks in block t, and
+# a measurement error of syndrome t flips its check in blocks t and t + 1.
+# rounds = 0 is code capacity.
+
+
+def _bernoulli(rng : np.random.Generator, shape : tuple[int, int], p : float) -> scipy.sparse.csr_matrix:
+    # independent bits that are 1 with probability p, as a sparse int32
+    # matrix: the gaps between the ones (in row-major order) are geometric
+    size = shape[0] * shape[1]
+    positions = np.zeros(0, dtype = np.int64)
+    if p > 0:
+        last = -1
+        parts = []
+        while last < size:
+            expected = (size - last) * p
+            gaps = rng.geometric(p, size = int(expected + 6 * np.sqrt(expected) + 16))
+            part = last + np.cumsum(gaps)
+            parts.append(part)
+            last = int(part[-1])
+        positions = np.concatenate(parts)
+        positions = positions[positions < size]
+    rows, columns = np.divmod(positions, shape[1])
+    return scipy.sparse.csr_matrix((np.ones(len(positions), dtype = np.int32), (rows, columns)), shape = shape)
+
+
+class CodeCapacity:
+    ''' Code-capacity and phenomenological noise simulation of one memory
+    experiment, on its check matrix H (the Z checks of 'z_memory', the X
+    checks of 'x_memory') and logicals L, without building a circuit.
+
+    Errors are sampled as sparse matrices and handed to the decoder bit packed,
+    with the detector error model of the same noise, so any sinter.Decoder
+    works. This screens a layout in milliseconds:
+
+        code = CodeCapacity.from_layout(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                                        observable = A1_log_obs['z'])
+        code.simulate(p = 0.02, shots = 10000)                    # code capacity
+        code.simulate(p = 0.01, q = 0.01, rounds = 3, shots = 10000)  # phenomenological'''
+
+    def __init__(self, check_matrix : scipy.sparse.csr_matrix, logicals : scipy.sparse.csr_matrix) -> None:
+        self.check_matrix = scipy.sparse.csr_matrix(check_matrix, dtype = np.uint8)
+        self.logicals = scipy.sparse.csr_matrix(logicals, dtype = np.uint8)
+        # products of 0/1 matrices with error batches, counted in int32:
+        self._H = self.check_matrix.astype(np.int32)
+        self._L = self.logicals.astype(np.int32)
+
+    @classmethod
+    def from_layout(cls, shape, row_checks, col_checks, observable, experiment : str = 'z_memory') -> 'CodeCapacity':
+        ''' The experiment of circuit_builder() with the same arguments.'''
+
+        hx, hz = parity_check_matrices(shape, row_checks, col_checks)
+        logicals = logical_operators(shape, row_checks, col_checks, observable, experiment)
+        return cls(hx if experiment == 'x_memory' else hz, logicals)
+
+    @property
+    def num_checks(self) -> int:
+        return self.check_matrix.shape[0]
+
+    @property
+    def num_qubits(self) -> int:
+        return self.check_matrix.shape[1]
+
+    def detector_error_model(self, p : float, q : float = 0, rounds : int = 0) -> stim.DetectorErrorModel:
+        ''' The detector error model of the noise, with num_checks detectors
+        per syndrome.'''
+
+        m = self.num_checks
+        H = self.check_matrix.T.tocsr()
+        L = self.logicals.T.tocsr()
+
+        lines = []
+        for t in range(rounds + 1):
+            if p > 0:
+                for k in range(self.num_qubits):
+                    targets = [f'D{t * m + c}' for c in H.indices[H.indptr[k]:H.indptr[k + 1]].tolist()]
+                    targets += [f'L{l}' for l in L.indices[L.indptr[k]:L.indptr[k + 1]].tolist()]
+                    lines.append(f'error({p!r}) ' + ' '.join(targets))
+            if q > 0 and t < rounds:
+                lines += [f'error({q!r}) D{t * m + c} D{(t + 1) * m + c}' for c in range(m)]
+        # every detector and observable is declared, even if no error flips it:
+        lines.append(f'detector D{(rounds + 1) * m - 1}')
+        lines.append(f'logical_observable L{self.logicals.shape[0] - 1}')
+        return stim.DetectorErrorModel('\n'.join(lines))
+
+    def sample(self, p : float, shots : int, q : float = 0, rounds : int = 0,
+               rng : np.random.Generator | None = None, chunk_size : int = 1024) -> tuple[np.ndarray, np.ndarray]:
+        ''' Bit-packed detection events and observable flips of shots shots,
+        in the layout of stim's bit-packed samples.
+
+        Errors are drawn as sparse matrices (see _bernoulli()) for chunk_size
+        shots at a time, and every chunk is packed before the next one is
+        drawn, so memory grows with the packed output, not with shots times
+        qubits.'''
+
+        rng = np.random.default_rng() if rng is None else rng
+        m = self.num_checks
+        num_observables = self.logicals.shape[0]
+
+        detectors = np.zeros((shots, ((rounds + 1) * m + 7) // 8), dtype = np.uint8)
+        observables = np.zeros((shots, (num_observables + 7) // 8), dtype = np.uint8)
+        for start in range(0, shots, chunk_size):
+            n = min(chunk_size, shots - start)
+            # syndromes of the errors before each syndrome, one (n, checks) block per syndrome:
+            blocks = np.zeros((n, rounds + 1, m), dtype = np.int32)
+            flipped = np.zeros((n, num_observables), dtype = np.int32)
+            for t in range(rounds + 1):
+                errors = _bernoulli(rng, (n, self.num_qubits), p)
+                blocks[:, t] = (errors @ self._H.T).toarray()
+                flipped += (errors @ self._L.T).toarray()
+            if q > 0 and rounds > 0:
+                for t in range(rounds):
+                    flips = _bernoulli(rng, (n, m), q).toarray()
+                    blocks[:, t] += flips
+                    blocks[:, t + 1] += flips
+
+            blocks &= 1
+            detectors[start:start + n] = np.packbits(blocks.reshape(n, -1).astype(np.uint8), axis = 1, bitorder = 'little')
+            observables[start:start + n] = np.packbits((flipped & 1).astype(np.uint8), axis = 1, bitorder = 'little')
+        return detectors, observables
+
+    def simulate(
+            self,
+            p : float,
+            shots : int,
+            q : float = 0,
+            rounds : int = 0,
+            decoder : sinter.Decoder | None = None,
+            batch_size : int = 10000,
+            seed : int | None = None,
+    ) -> dict:
+        ''' Sample and decode shots shots batch_size at a time, with
+        BatchBpOsdDecoder() by default. Returns the number of shots and
+        logical errors, the logical error rate and the seconds taken.'''
+
+        t = time.monotonic()
+        decoder = BatchBpOsdDecoder() if decoder is None else decoder
+        rng = np.random.default_rng(seed)
+        dem = self.detector_error_model(p, q, rounds)
+        compiled = compile_decoder(decoder, dem)
+
+        errors = 0
+        for start in range(0, shots, batch_size):
+            detectors, observables = self.sample(p, min(batch_size, shots - start), q, rounds, rng)
+            predictions = decode_bit_packed(decoder, compiled, dem, detectors)
+            errors += int(np.count_nonzero(np.any(predictions != observables, axis = 1)))
+
+        return {
+            'shots' : shots,
+            'errors' : errors,
+            'rate' : errors / shots if shots else 0.0,
+            'seconds' : time.monotonic() - t,
+        }
@@ -0,0 +1,2 @@
+# pytest puts the directory of this file on sys.path, so the tests in tests/
+# import the top-level modules (circuit, sweep, ...) directly.
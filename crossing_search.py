@@ -0,0 +1,259 @@
+import math
+
+import numpy as np
+
+from embedding import Embedding
+from crossings_27_4_3 import crossing_mapper
+
+#------------------------------------------------------------------------------
+# crossing model
+#------------------------------------------------------------------------------
+#
+# The couplers of a row_checks gate (check column c, bit column b) are drawn in
+# every row of the layout. Neighbouring columns are joined by a straight
+# coupler, while a long-range coupler is an arc that leaves its row towards
+# the row below (direction +1) or above (direction -1). There it runs through
+# the channel between the two rows and crosses the vertical coupler of every
+# column strictly between c and b. Arcs that would leave the layout (down from
+# the last row, up from the first) have no crossings. The col_checks gates are
+# the vertical couplers and must join neighbouring rows, as for rep3_checks.
+#
+# So in every channel, the vertical coupler of column j is crossed once by
+# every long-range arc over j, and an arc in row i is crossed once per column
+# it jumps over if its channel holds a vertical coupler.
+
+
+def vertical_channels(col_checks) -> set[int]:
+    ''' Rows r such that the channel between rows r and r + 1 holds vertical
+    couplers.'''
+
+    channels = set()
+    for check, bit in col_checks:
+        if abs(check - bit) != 1:
+            raise ValueError(f'col_checks gate {(check, bit)} does not join neighbouring rows')
+        channels.add(min(check, bit))
+    return channels
+
+
+def arc_rows(shape, channels : set[int], direction : int) -> list[int]:
+    ''' Rows in which an arc with the given direction crosses vertical
+    couplers.'''
+
+    if direction not in (1, -1):
+        raise ValueError(f'arc directions must be +1 or -1, not {direction}')
+    return [i for i in range(shape[0]) if min(i, i + direction) in channels]
+
+
+def compute_crossings(shape, row_checks, col_checks, directions = None, name : str = '') -> Embedding:
+    ''' Crossing count Cr of every crossed gate of the layout.
+
+    directions maps a long-range (check column, bit column) pair of row_checks
+    to +1 (arc towards the row below) or -1 (towards the row above); pairs that
+    are not in it default to +1.'''
+
+    directions = directions or {}
+    channels = vertical_channels(col_checks)
+
+    row = np.zeros(shape[1], dtype = int)
+    col = np.zeros(shape[0], dtype = int)
+    row[[check[0] for check in row_checks]] = 1
+    col[[check[0] for check in col_checks]] = 1
+
+    # number of long-range arcs over each column:
+    cover = np.zeros(shape[1], dtype = int)
+    for c, b in row_checks:
+        lo, hi = min(c, b), max(c, b)
+        cover[lo + 1 : hi] += 1
+
+    crossings = []
+
+    # arcs:
+    for c, b in row_checks:
+        length = abs(c - b) - 1
+        if length < 1:
+            continue
+        for i in arc_rows(shape, channels, directions.get((c, b), 1)):
+            # the check qubit is (i, c) in a bit row and (i, b) in a check row:
+            if col[i] == 0:
+                crossings.append([(i, c), (i, b), length])
+            else:
+                crossings.append([(i, b), (i, c), length])
+
+    # vertical couplers:
+    for j in np.nonzero(cover)[0].tolist():
+        for r, b in col_checks:
+            # the check qubit is (r, j) in a bit column and (b, j) in a check column:
+            if row[j] == 0:
+                crossings.append([(r, j), (b, j), int(cover[j])])
+            else:
+                crossings.append([(b, j), (r, j), int(cover[j])])
+
+    return Embedding.from_list([name, crossings])
+
+
+def layout_checks(row_checks, map) -> list[tuple[int, int]]:
+    ''' row_checks of the reference (A1) layout moved to the layout in which
+    reference column k sits at position map[k].'''
+
+    return [(int(map[c]), int(map[b])) for c, b in row_checks]
+
+
+def embedding_for_layout(shape, row_checks, col_checks, map, directions = None, name : str = '') -> Embedding:
+    ''' Crossings of the layout given by map (see layout_checks()), mapped back
+    to the reference layout with crossing_mapper(), like mapped_embedding_A0.
+    directions are keyed by the (check column, bit column) pairs of the
+    reference row_checks, which keep their direction wherever map moves them.'''
+
+    moved = {(int(map[c]), int(map[b])) : d for (c, b), d in (directions or {}).items()}
+    embedding = compute_crossings(shape, layout_checks(row_checks, map), col_checks, moved, name)
+    return crossing_mapper(embedding, np.asarray(map))
+
+
+#------------------------------------------------------------------------------
+# crossing cost
+#------------------------------------------------------------------------------
+
+def crossing_cost(embedding : Embedding, weight = None) -> float:
+    ''' Total crossings cr() of an embedding, or the sum of weight(Cr) over its
+    crossed gates, e.g. weight = lambda Cr: 1 - (1 - alpha * p)**Cr.'''
+
+    if weight is None:
+        return embedding.total()
+    return float(np.sum(weight(embedding.counts)))
+
+
+class CrossingState:
+    ''' Crossing cost of a column layout, updated incrementally when two
+    column positions are swapped.
+
+    Per the crossing model above, the cost only depends on the length of
+    every long-range arc and on the number of arcs over every column, so a
+    swap only revisits the arcs that end in one of the two swapped columns and
+    the columns under them. directions are keyed by the pairs of row_checks,
+    as for embedding_for_layout().'''
+
+    def __init__(self, shape, row_checks, col_checks, map, weight = None, directions = None) -> None:
+        self.row_checks = [(int(c), int(b)) for c, b in row_checks]
+        self.map = [int(k) for k in map]
+        self.column_at = [0] * len(self.map)
+        for k, position in enumerate(self.map):
+            self.column_at[position] = k
+
+        directions = directions or {}
+        channels = vertical_channels(col_checks)
+        # weight(Cr) summed over the gates of an arc (one per row in which it is
+        # crossed, see arc_rows()) and of the vertical couplers of a column:
+        weight = weight if weight is not None else (lambda Cr: Cr)
+        costs = [0] + [weight(Cr) for Cr in range(1, max(shape[1], len(self.row_checks) + 1))]
+        self.arc_cost = []
+        for c, b in self.row_checks:
+            rows = len(arc_rows(shape, channels, directions.get((c, b), 1)))
+            self.arc_cost.append([rows * w for w in costs])
+        self.column_cost = [len(col_checks) * w for w in costs]
+
+        self.arcs_at = {}
+        for n, (c, b) in enumerate(self.row_checks):
+            self.arcs_at.setdefault(c, []).append(n)
+            self.arcs_at.setdefault(b, []).append(n)
+
+        self.cover = [0] * shape[1]
+        for n in range(len(self.row_checks)):
+            lo, hi = self._interval(n, self.map)
+            for j in range(lo + 1, hi):
+                self.cover[j] += 1
+
+        self.cost = sum(self.arc_cost[n][max(hi - lo - 1, 0)] for n, (lo, hi) in
+                        enumerate(self._interval(n, self.map) for n in range(len(self.row_checks))))
+        self.cost += sum(self.column_cost[n] for n in self.cover)
+
+    def _interval(self, n, map):
+        c, b = self.row_checks[n]
+        return (map[c], map[b]) if map[c] < map[b] else (map[b], map[c])
+
+    def _changes(self, u, v):
+        # cost change of swapping positions u and v, and the cover change per column:
+        a, b = self.column_at[u], self.column_at[v]
+        affected = set(self.arcs_at.get(a, ())) | set(self.arcs_at.get(b, ()))
+
+        moved = {a : v, b : u}
+        delta = 0
+        cover = {}
+        for n in affected:
+            c, d = self.row_checks[n]
+            lo, hi = self._interval(n, self.map)
+            new_lo, new_hi = sorted((moved.get(c, self.map[c]), moved.get(d, self.map[d])))
+            delta += self.arc_cost[n][max(new_hi - new_lo - 1, 0)] - self.arc_cost[n][max(hi - lo - 1, 0)]
+            for j in range(lo + 1, hi):
+                cover[j] = cover.get(j, 0) - 1
+            for j in range(new_lo + 1, new_hi):
+                cover[j] = cover.get(j, 0) + 1
+
+        for j, change in cover.items():
+            if change:
+                delta += self.column_cost[self.cover[j] + change] - self.column_cost[self.cover[j]]
+        return delta, cover
+
+    def swap_delta(self, u : int, v : int) -> float:
+        ''' Cost change of swapping the columns at positions u and v.'''
+
+        return self._changes(u, v)[0]
+
+    def swap(self, u : int, v : int) -> None:
+        ''' Swap the columns at positions u and v.'''
+
+        delta, cover = self._changes(u, v)
+        for j, change in cover.items():
+            self.cover[j] += change
+        a, b = self.column_at[u], self.column_at[v]
+        self.map[a], self.map[b] = v, u
+        self.column_at[u], self.column_at[v] = b, a
+        self.cost += delta
+
+
+#------------------------------------------------------------------------------
+# embedding search
+#------------------------------------------------------------------------------
+
+def search_embeddings(
+        shape,
+        row_checks,
+        col_checks,
+        weight = None,
+        directions = None,
+        n_best : int = 5,
+        steps : int = 20000,
+        restarts : int = 4,
+        start_temperature : float = 10.0,
+        end_temperature : float = 0.05,
+        seed : int | None = None,
+) -> list[tuple[float, np.ndarray]]:
+    ''' Simulated annealing over column permutations of the layout, with moves
+    that swap two columns and incremental cost updates.
+
+    Returns up to n_best (cost, map) pairs with the lowest cost found, map in
+    the convention of map_A0 (see layout_checks()). Use embedding_for_layout()
+    with the same directions to get the crossings of a result.'''
+
+    rng = np.random.default_rng(seed)
+    n_columns = shape[1]
+    best = {}
+
+    for _ in range(restarts):
+        state = CrossingState(shape, row_checks, col_checks, rng.permutation(n_columns), weight, directions)
+        temperatures = np.geomspace(start_temperature, end_temperature, steps).tolist()
+        moves = rng.integers(0, n_columns, size = (steps, 2)).tolist()
+        draws = rng.random(steps).tolist()
+
+        for temperature, (u, v), draw in zip(temperatures, moves, draws):
+            if u == v:
+                continue
+            delta = state.swap_delta(u, v)
+            if delta > 0 and draw >= math.exp(-delta / temperature):
+                continue
+            state.swap(u, v)
+            if len(best) < n_best or state.cost < max(best.values()):
+                best.setdefault(tuple(state.map), state.cost)
+                if len(best) > n_best:
+                    del best[max(best, key = best.get)]
+
+    return [(float(cost), np.array(map)) for map, cost in sorted(best.items(), key = lambda item: item[1])]
@@ -1,12 +1,17 @@
 import numpy as np
 
+from embedding import Embedding
+
 def fl(l):
     ''' Unpack a nested list of depth 2 into a flat, non-nested list.'''
 
     return [element for sublist in l for element in sublist]
 
 def cr(crossings_obj):
-    ''' Obtain the total number of crossings from a crossing object.'''
+    ''' Obtain the total number of crossings from a crossing object or Embedding.'''
+
+    if isinstance(crossings_obj, Embedding):
+        return crossings_obj.total()
 
     crossings = 0
     for check in crossings_obj[1]:
@@ -68,15 +73,12 @@ cr_A1 = cr(embedding_A1)
 def crossing_mapper(crossing_object, map):
     """Maps the crossings of an embedding to the data and check qubit layout of
     of the A1 embedding. This is necessary in order to keep the overall gate order of the 
-    code the same, only change the position of the errors."""
-
-    og_map = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
-    remaped_corssings = [crossing_object[0], []]
-    for crossing in crossing_object[1]:
-        remaped_corssings[1].append([(crossing[0][0], og_map[np.where(map == crossing[0][1])[0][0]]),
-                                     (crossing[1][0], (og_map[np.where(map == crossing[1][1])[0][0]]) ), crossing[2]])
+    code the same, only change the position of the errors. Accepts a crossing
+    object or an Embedding, and returns the same type."""
 
-    return remaped_corssings
+    if isinstance(crossing_object, Embedding):
+        return crossing_object.remap(map)
+    return Embedding.from_list(crossing_object).remap(map).to_list()
 
 
 
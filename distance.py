@@ -0,0 +1,120 @@
+import hashlib
+import json
+
+import stim
+
+from circuit import circuit_program, crossing_map
+from circuit_cache import cached_result, map_cases
+
+# noise used for the cases that do not set their own: the search only needs
+# every error mechanism to be present, not its strength
+DISTANCE_NOISE = dict(
+    after_clifford_depolarization = 1e-3,
+    after_crossing_depolarization = 1e-3,
+    after_reset_flip_probability = 1e-3,
+    before_measure_flip_probability = 1e-3,
+)
+
+# bump whenever the results of logical_error_search() change form, so that
+# cached ones are not picked up:
+RESULT_VERSION = 3
+
+#------------------------------------------------------------------------------
+# logical error search
+#------------------------------------------------------------------------------
+
+def _coords(target : stim.GateTargetWithCoords) -> tuple[int, int]:
+    return tuple(int(x) for x in target.coords)
+
+
+def explain_error(error : list[stim.ExplainedError], crossings = None) -> list[dict]:
+    ''' One entry per fault of a logical error found by stim: the noise
+    instruction, the (row, column) coordinates of the qubits it acts on, its
+    location in the circuit as (instruction offset, REPEAT iteration) pairs
+    from the top level down, whether it follows a crossed gate, and the
+    crossing count Cr of that gate (1 for gates that are not in crossings,
+    as in the builder). Faults that do not follow a two-qubit gate (resets,
+    measurements, single-qubit gates) have Cr None.'''
+
+    crossed = crossing_map(crossings or [])
+
+    faults = []
+    for explained in error:
+        # every representative circuit error of a DEM term explains it equally well:
+        location = explained.circuit_error_locations[0]
+        qubits = [_coords(target) for target in location.instruction_targets.targets_in_range]
+        Cr = None
+        if len(qubits) == 2:
+            Cr = crossed.get((qubits[0], qubits[1]), crossed.get((qubits[1], qubits[0])))
+        faults.append({
+            'gate' : location.instruction_targets.gate,
+            'qubits' : qubits,
+            'instruction' : [(frame.instruction_offset, frame.iteration_index) for frame in location.stack_frames],
+            'crossed' : Cr is not None,
+            'Cr' : Cr if Cr is not None else 1 if len(qubits) == 2 else None,
+        })
+    return faults
+
+
+def logical_error_search(circuit : stim.Circuit, crossings = None, max_detection_events : int = 6,
+                         max_edge_degree : int = 6, graphlike : bool = False) -> dict | None:
+    ''' Circuit-level distance of circuit and one of its lowest-weight
+    undetectable logical errors, explained by explain_error(), or None if
+    stim finds no logical error within the search bounds.
+
+    Uses stim's search_for_undetectable_logical_errors() with the given search
+    bounds, which handles the hyperedges of our HGP detector error models, or
+    shortest_graphlike_error() with graphlike = True, which is faster but needs
+    errors that decompose into graphlike pieces and only gives an upper bound
+    on the distance otherwise.'''
+
+    try:
+        if graphlike:
+            error = circuit.shortest_graphlike_error(canonicalize_circuit_errors = True)
+        else:
+            error = circuit.search_for_undetectable_logical_errors(
+                dont_explore_detection_event_sets_with_size_above = max_detection_events,
+                dont_explore_edges_with_degree_above = max_edge_degree,
+                dont_explore_edges_increasing_symptom_degree = False,
+                canonicalize_circuit_errors = True,
+            )
+    except ValueError as e:
+        if 'Failed to find' not in str(e):
+            raise
+        return None
+
+    faults = explain_error(error, crossings)
+    return {
+        'distance' : len(error),
+        'crossed_faults' : sum(fault['crossed'] for fault in faults),
+        'faults' : faults,
+    }
+
+
+#------------------------------------------------------------------------------
+# embedding comparison
+#------------------------------------------------------------------------------
+
+def _cached_search(params : dict, cache_dir : str, search : dict) -> dict:
+    text = circuit_program(**(DISTANCE_NOISE | params))
+    key = hashlib.sha256(json.dumps([RESULT_VERSION, text, search], sort_keys = True).encode()).hexdigest()
+    return cached_result(cache_dir, key, '.distance.json',
+                         lambda: logical_error_search(stim.Circuit(text), params.get('crossings'), **search))
+
+
+def embedding_distances(cases : dict[str, dict], max_workers : int | None = None,
+                        cache_dir : str = '.circuit_cache', **search) -> dict[str, dict]:
+    ''' logical_error_search() for every case, a dict of circuit_builder()
+    keyword arguments by name, across a process pool. Noise that a case does
+    not set is taken from DISTANCE_NOISE. Cases without a logical error within
+    the search bounds get None.
+
+    Results are cached in cache_dir by the hash of the circuit text and the
+    search options, so repeating a comparison only searches new circuits.
+
+        cases = {name : dict(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                             crossings = embedding[1], rounds = 3, observable = A1_log_obs['z'])
+                 for name, embedding in ...}
+        distances = embedding_distances(cases)'''
+
+    return map_cases(_cached_search, cases, cache_dir, max_workers, search)
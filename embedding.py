@@ -0,0 +1,106 @@
+import json
+
+import numpy as np
+
+FIELDS = ('check_rows', 'check_cols', 'data_rows', 'data_cols', 'counts')
+
+
+def _npz_path(path : str) -> str:
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+class Embedding:
+    ''' Array form of a crossing object [name, [[(r, c), (r, c), Cr], ...]].
+
+    Every crossing is stored as the (row, column) coordinates of the check
+    qubit and of the data qubit of a gate, followed by the number of crossings
+    Cr of that gate, in five integer arrays of equal length. Embeddings can be
+    passed to circuit_builder() as crossings, and saved to / loaded from .npz
+    or .json files.'''
+
+    def __init__(self, name : str, check_rows, check_cols, data_rows, data_cols, counts) -> None:
+        self.name = name
+        self.check_rows = np.asarray(check_rows, dtype = np.int64)
+        self.check_cols = np.asarray(check_cols, dtype = np.int64)
+        self.data_rows = np.asarray(data_rows, dtype = np.int64)
+        self.data_cols = np.asarray(data_cols, dtype = np.int64)
+        self.counts = np.asarray(counts, dtype = np.int64)
+
+        if len({len(getattr(self, field)) for field in FIELDS}) > 1:
+            raise ValueError('all crossing arrays of an embedding must have the same length')
+
+    @classmethod
+    def from_list(cls, crossing_object : list) -> 'Embedding':
+        ''' Embedding of a crossing object [name, crossings].'''
+
+        name, crossings = crossing_object
+        columns = np.array([[c[0][0], c[0][1], c[1][0], c[1][1], c[2]] for c in crossings],
+                           dtype = np.int64).reshape(-1, 5)
+        return cls(name, *columns.T)
+
+    @property
+    def crossings(self) -> list:
+        ''' The crossings as a list of [(r, c), (r, c), Cr] entries.'''
+
+        return [[(cr, cc), (dr, dc), n] for cr, cc, dr, dc, n in
+                zip(*(getattr(self, field).tolist() for field in FIELDS))]
+
+    def to_list(self) -> list:
+        ''' The crossing object [name, crossings] of this embedding.'''
+
+        return [self.name, self.crossings]
+
+    def crossing_map(self) -> dict[tuple, int]:
+        ''' Same as circuit.crossing_map() of the crossing list.'''
+
+        checks = zip(self.check_rows.tolist(), self.check_cols.tolist())
+        data = zip(self.data_rows.tolist(), self.data_cols.tolist())
+        return dict(zip(zip(checks, data), self.counts.tolist()))
+
+    def total(self) -> int:
+        ''' Total number of crossings.'''
+
+        return int(self.counts.sum())
+
+    def remap(self, map : np.ndarray) -> 'Embedding':
+        ''' Move the columns of the crossings to the layout of the A1 embedding,
+        as crossing_mapper() does: column map[k] becomes column k.'''
+
+        inverse = np.empty_like(np.asarray(map))
+        inverse[map] = np.arange(len(map))
+        return Embedding(self.name, self.check_rows, inverse[self.check_cols],
+                         self.data_rows, inverse[self.data_cols], self.counts)
+
+    def save(self, path : str) -> None:
+        ''' Write the embedding to a .json file, or else a .npz file: like
+        np.savez, a path without either suffix gets .npz appended (as in
+        load()).'''
+
+        arrays = {field : getattr(self, field) for field in FIELDS}
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({'name' : self.name} | {k : v.tolist() for k, v in arrays.items()}, f)
+        else:
+            np.savez_compressed(_npz_path(path), name = np.array(self.name), **arrays)
+
+    @classmethod
+    def load(cls, path : str) -> 'Embedding':
+        ''' Read an embedding written by save(), from the same path.'''
+
+        if path.endswith('.json'):
+            with open(path) as f:
+                data = json.load(f)
+            return cls(data['name'], *(data[field] for field in FIELDS))
+
+        with np.load(_npz_path(path)) as data:
+            return cls(str(data['name']), *(data[field] for field in FIELDS))
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Embedding) and self.name == other.name and all(
+            np.array_equal(getattr(self, field), getattr(other, field)) for field in FIELDS)
+
+    def __repr__(self) -> str:
+        return f'Embedding({self.name!r}, {len(self)} crossings, total {self.total()})'
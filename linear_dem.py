@@ -0,0 +1,137 @@
+import numpy as np
+import stim
+
+from circuit import CircuitTemplate
+from shot_store import sinter_detector_error_model
+
+NOISE_ARGUMENTS = (
+    'after_clifford_depolarization',
+    'after_crossing_depolarization',
+    'after_reset_flip_probability',
+    'before_measure_flip_probability',
+)
+
+# noise strengths at which the structure is probed: distinct, so that no two
+# sources can be confused, and small, so that no mechanism saturates
+PROBE_NOISE = (1e-3, 2e-3, 3e-3, 4e-3)
+
+#------------------------------------------------------------------------------
+# noise features
+#------------------------------------------------------------------------------
+#
+# stim treats every Pauli of a channel as an independent component with
+# probability q, and gives a DEM mechanism the probability P that an odd number
+# of its components fire, so 1 - 2P is the product of 1 - 2q over them. For the
+# channels of circuit_builder():
+#
+#     X_ERROR(p), Z_ERROR(p)                  1 - 2q = 1 - 2p
+#     DEPOLARIZE1(3p/4)                       1 - 2q = (1 - p)^(1/2)
+#     DEPOLARIZE2((1 - (1 - p)^Cr) * 15/16)   1 - 2q = (1 - p)^(Cr/8)
+#
+# (Cr DEPOLARIZE2(15p/16) give the same.) So log(1 - 2P) is a linear function
+# of the features log(1 - p) of the two depolarizing strengths and log(1 - 2p)
+# of the two flip probabilities, with coefficients in multiples of 1/8 that
+# count the components of each source behind the mechanism.
+
+
+def noise_features(**noise) -> np.ndarray:
+    ''' The four features of the noise keyword arguments of circuit_builder(),
+    in the order of NOISE_ARGUMENTS. The strengths may be arrays of noise
+    points, which gives a (points, 4) array.'''
+
+    p = [np.asarray(noise.get(name, 0), dtype = np.float64) for name in NOISE_ARGUMENTS]
+    return np.stack([np.log1p(-p[0]), np.log1p(-p[1]), np.log1p(-2 * p[2]), np.log1p(-2 * p[3])], axis = -1)
+
+
+def _error_lines(dem : stim.DetectorErrorModel):
+    # flattened DEM as text lines, with the probability and targets of every error:
+    lines = []
+    errors = []
+    probabilities = []
+    for instruction in dem.flattened():
+        if instruction.type == 'error':
+            text = str(instruction)
+            errors.append(len(lines))
+            lines.append(text[text.index(')') + 1:])
+            probabilities.append(instruction.args_copy()[0])
+        else:
+            lines.append(str(instruction))
+    return lines, errors, np.array(probabilities)
+
+
+#------------------------------------------------------------------------------
+# noise-linear detector error model
+#------------------------------------------------------------------------------
+
+class LinearDEM:
+    ''' Detector error model of a circuit_builder() circuit as a function of
+    its four noise strengths.
+
+    The mechanisms (flattened) are extracted once, each tagged with the number
+    of components of every noise source that feed it (in eighths, see
+    noise_features()). detector_error_model() then gives the DEM at any noise
+    point, equal to the one stim derives from the circuit up to floating point
+    rounding, without building the circuit:
+
+        dem = LinearDEM.from_layout(shape = (5, 10), row_checks = hamming_A1, ...)
+        dem.detector_error_model(after_clifford_depolarization = p, after_crossing_depolarization = alpha * p, ...)
+
+    Mechanisms whose sources are all switched off are left out, like stim
+    does.'''
+
+    def __init__(self, lines : list[str], errors : list[int], multiplicities : np.ndarray) -> None:
+        self.lines = lines
+        self.errors = np.asarray(errors)
+        self.multiplicities = np.asarray(multiplicities, dtype = np.int64)
+
+    @classmethod
+    def from_template(cls, template : CircuitTemplate, decompose_errors : bool = False) -> 'LinearDEM':
+        ''' Probe the template at PROBE_NOISE and at each source doubled. With
+        decompose_errors, the mechanisms are the ones that sinter gives its
+        decoders: decomposed if stim can decompose them, and otherwise with
+        sinter's fallbacks (see sinter_detector_error_model()).'''
+
+        base = dict(zip(NOISE_ARGUMENTS, PROBE_NOISE))
+        points = [base] + [base | {name : 2 * base[name]} for name in NOISE_ARGUMENTS]
+
+        logs = []
+        for noise in points:
+            circuit = template.instantiate(**noise)
+            if decompose_errors:
+                dem = sinter_detector_error_model(circuit)
+            else:
+                dem = circuit.detector_error_model()
+            lines, errors, probabilities = _error_lines(dem)
+            if logs and lines != reference:
+                raise ValueError('the detector error model changes structure with the noise strengths')
+            reference = lines
+            logs.append(np.log1p(-2 * probabilities))
+
+        features = noise_features(**{name : np.array([point[name] for point in points]) for name in NOISE_ARGUMENTS})
+        # differences against the base point isolate one source each:
+        slopes = (np.array(logs[1:]) - logs[0]) / np.diag(features[1:] - features[0])[:, None]
+        multiplicities = np.rint(8 * slopes.T)
+        if np.max(np.abs(8 * slopes.T - multiplicities)) > 1e-3:
+            raise ValueError('the detector error model is not linear in the noise features')
+
+        return cls(lines, errors, multiplicities)
+
+    @classmethod
+    def from_layout(cls, decompose_errors : bool = False, **params) -> 'LinearDEM':
+        ''' from_template() of CircuitTemplate.from_layout(**params).'''
+
+        return cls.from_template(CircuitTemplate.from_layout(**params), decompose_errors)
+
+    def probabilities(self, **noise) -> np.ndarray:
+        ''' Probability of every mechanism at the noise point(s), a (points,
+        mechanisms) array if the strengths are arrays.'''
+
+        return -np.expm1(noise_features(**noise) @ (self.multiplicities.T / 8)) / 2
+
+    def detector_error_model(self, **noise) -> stim.DetectorErrorModel:
+        ''' The detector error model at one noise point.'''
+
+        lines = list(self.lines)
+        for index, p in zip(self.errors.tolist(), self.probabilities(**noise).tolist()):
+            lines[index] = f'error({p!r}){self.lines[index]}' if p > 0 else ''
+        return stim.DetectorErrorModel('\n'.join(lines))
@@ -0,0 +1,287 @@
+import contextlib
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+import sinter
+
+from circuit_cache import CircuitCache
+from sweep import CUSTOM_DECODERS, collect_in_chunks, generate_tasks, task_key
+
+#------------------------------------------------------------------------------
+# shards
+#------------------------------------------------------------------------------
+
+def task_keys(**sweep) -> list[str]:
+    ''' task_key() of every task that generate_tasks(**sweep) yields, in order, without building any
+    circuit or touching the circuit cache.'''
+
+    keys = []
+
+    def record(decoder, json_metadata):
+        keys.append(task_key(decoder, json_metadata))
+        return None
+
+    for _ in generate_tasks(**sweep, collection_options = record):
+        pass
+    return keys
+
+
+def make_shards(keys : list[str], shard_size : int) -> dict[str, list[str]]:
+    ''' Split task keys into shards of shard_size consecutive keys, by shard
+    id. The id is a hash of the keys of the shard, so the same sweep gives the
+    same shards on every node and in every run.'''
+
+    shards = {}
+    for start in range(0, len(keys), shard_size):
+        shard = keys[start:start + shard_size]
+        shards[hashlib.sha256(json.dumps(shard).encode()).hexdigest()[:16]] = shard
+    return shards
+
+
+#------------------------------------------------------------------------------
+# work queue
+#------------------------------------------------------------------------------
+
+class ShardQueue:
+    ''' Work queue of sweep shards in an SQLite database in a directory that
+    all nodes share, with the sinter statistics of every shard next to it in
+    shards/<shard id>.<worker>.csv, one file per worker that sampled it.
+
+    A shard is pending, running or done. Running shards carry the worker that
+    claimed them and the time it last renewed its lease (see lease()); once
+    that is more than lease_seconds ago, the worker is taken to be dead and
+    the shard is handed out again. The next worker counts the statistics
+    files of the workers before it (see stats_paths()) and continues where
+    they stopped. A worker that was only slow keeps writing to its own file,
+    so two workers never append to the same one.
+
+    SQLite needs working file locks, which local directories and most (but
+    not all) network filesystems provide.'''
+
+    def __init__(self, directory : str, lease_seconds : float = 600) -> None:
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        os.makedirs(os.path.join(directory, 'shards'), exist_ok = True)
+        with self._connect() as db:
+            db.execute('''CREATE TABLE IF NOT EXISTS shards (
+                id TEXT PRIMARY KEY,
+                keys TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                heartbeat REAL)''')
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # autocommit connection, transactions are opened explicitly:
+        db = sqlite3.connect(os.path.join(self.directory, 'queue.sqlite'), timeout = 60, isolation_level = None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def stats_path(self, shard_id : str, worker : str) -> str:
+        ''' The statistics file of worker on a shard.'''
+
+        name = re.sub(r'[^\w.-]', '_', worker)
+        return os.path.join(self.directory, 'shards', f'{shard_id}.{name}.csv')
+
+    def stats_paths(self, shard_id : str) -> list[str]:
+        ''' The statistics files of every worker that sampled a shard.'''
+
+        return sorted(glob.glob(os.path.join(self.directory, 'shards', glob.escape(shard_id) + '.*.csv')))
+
+    def add_shards(self, shards : dict[str, list[str]]) -> None:
+        ''' Queue shards that are not queued yet.'''
+
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany('INSERT OR IGNORE INTO shards (id, keys) VALUES (?, ?)',
+                           [(shard_id, json.dumps(keys)) for shard_id, keys in shards.items()])
+            db.execute('COMMIT')
+
+    def claim(self, worker : str) -> tuple[str, list[str]] | None:
+        ''' Hand a pending shard, or one whose worker stopped reporting, to
+        worker. Returns its id and task keys, or None once no shard is left.'''
+
+        with self._connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            row = db.execute('''SELECT id, keys FROM shards
+                WHERE state = 'pending' OR (state = 'running' AND heartbeat < ?)
+                ORDER BY state, rowid LIMIT 1''', (now - self.lease_seconds,)).fetchone()
+            if row is not None:
+                db.execute("UPDATE shards SET state = 'running', worker = ?, heartbeat = ? WHERE id = ?",
+                           (worker, now, row[0]))
+            db.execute('COMMIT')
+        return None if row is None else (row[0], json.loads(row[1]))
+
+    def heartbeat(self, shard_id : str, worker : str) -> bool:
+        ''' Renew the lease of worker on a running shard. False if worker lost
+        the shard to another worker.'''
+
+        with self._connect() as db:
+            cursor = db.execute("UPDATE shards SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                                (time.time(), shard_id, worker))
+            return cursor.rowcount == 1
+
+    @contextlib.contextmanager
+    def lease(self, shard_id : str, worker : str):
+        ''' Renew the lease of worker on a shard every lease_seconds / 10 from a
+        background thread while the block runs, however long sinter takes
+        between progress reports.'''
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.lease_seconds / 10):
+                if not self.heartbeat(shard_id, worker):
+                    return
+
+        thread = threading.Thread(target = renew, daemon = True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def finish(self, shard_id : str, worker : str) -> bool:
+        ''' Mark the shard of worker done. False if worker lost the shard to
+        another worker (which then finishes it).'''
+
+        with self._connect() as db:
+            cursor = db.execute("UPDATE shards SET state = 'done', heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                                (time.time(), shard_id, worker))
+            return cursor.rowcount == 1
+
+    def status(self) -> dict[str, int]:
+        ''' Number of shards per state.'''
+
+        with self._connect() as db:
+            return dict(db.execute('SELECT state, COUNT(*) FROM shards GROUP BY state').fetchall())
+
+
+#------------------------------------------------------------------------------
+# results
+#------------------------------------------------------------------------------
+
+def merge_shards(directory : str, path : str | None = None) -> list[sinter.TaskStats]:
+    ''' Statistics of all shards of a sweep directory, with the partial
+    statistics of every task (one line per sinter batch, from any number of
+    workers) summed into one per strong_id. Also written to path, by default
+    stats.csv in the directory, as a sinter CSV file.'''
+
+    paths = sorted(glob.glob(os.path.join(directory, 'shards', '*.csv')))
+    stats = sinter.read_stats_from_csv_files(*paths) if paths else []
+
+    path = path or os.path.join(directory, 'stats.csv')
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        print(sinter.CSV_HEADER, file = f)
+        for stat in stats:
+            print(stat.to_csv_line(), file = f)
+    os.replace(tmp_path, path)
+    return stats
+
+
+#------------------------------------------------------------------------------
+# workers
+#------------------------------------------------------------------------------
+
+def run_sharded_sweep(
+        directory : str,
+        embeddings,
+        alphas,
+        ps,
+        experiments,
+        shape,
+        row_checks,
+        col_checks,
+        rounds : int = 3,
+        ind_obs = False,
+        decoders = ('bposd',),
+        max_shots : int = 500000,
+        max_errors : int = 500,
+        shard_size : int = 8,
+        lease_seconds : float = 600,
+        num_workers : int | None = None,
+        cache_dir : str = '.circuit_cache',
+        print_progress : bool = False,
+        linear_dems : bool = False,
+        build_hook = None,
+        chunk_size : int = 64,
+) -> list[sinter.TaskStats]:
+    ''' run_sweep() split across machines that share directory.
+
+    Run the same call on every node: the sweep is cut into shards of
+    shard_size tasks with make_shards(), queued in a ShardQueue in directory
+    (shards that are already queued are kept with their state), and every
+    node takes shards from the queue until none is left, building only the
+    circuits of its shard and sampling them with sinter on num_workers cores,
+    chunk_size tasks at a time (see collect_in_chunks()). A worker renews its
+    lease on the shard every lease_seconds / 10 while it samples. Shards of
+    workers that died are picked up again after lease_seconds, continuing
+    from their statistics files.
+
+    Returns merge_shards() of the directory once this node runs out of
+    shards; other nodes may still be sampling theirs.'''
+
+    sweep = dict(
+        embeddings = embeddings,
+        alphas = alphas,
+        ps = ps,
+        experiments = experiments,
+        shape = shape,
+        row_checks = row_checks,
+        col_checks = col_checks,
+        rounds = rounds,
+        ind_obs = ind_obs,
+        decoders = decoders,
+        linear_dems = linear_dems,
+    )
+
+    queue = ShardQueue(directory, lease_seconds)
+    queue.add_shards(make_shards(task_keys(**sweep), shard_size))
+
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    cache = CircuitCache(cache_dir, build_hook = build_hook)
+    custom_decoders = {name : CUSTOM_DECODERS[name]() for name in decoders}
+
+    while (claimed := queue.claim(worker)) is not None:
+        shard_id, keys = claimed
+        keys = set(keys)
+
+        stats_path = queue.stats_path(shard_id, worker)
+        earlier = [path for path in queue.stats_paths(shard_id) if path != stats_path]
+
+        with queue.lease(shard_id, worker):
+            collect_in_chunks(
+                chunk_size = chunk_size,
+                num_workers = num_workers or max(multiprocessing.cpu_count() - 1, 1),
+                max_shots = max_shots,
+                max_errors = max_errors,
+                tasks = generate_tasks(
+                    **sweep,
+                    cache = cache,
+                    collection_options = lambda decoder, json_metadata :
+                        sinter.CollectionOptions() if task_key(decoder, json_metadata) in keys else None,
+                ),
+                custom_decoders = custom_decoders,
+                existing_data_filepaths = earlier,
+                save_resume_filepath = stats_path,
+                print_progress = print_progress,
+            )
+        cache.unpin()
+        if not queue.finish(shard_id, worker):
+            print(f'shard {shard_id} was handed to another worker after its lease ran out', file = sys.stderr)
+
+    return merge_shards(directory)
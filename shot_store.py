@@ -0,0 +1,242 @@
+import concurrent.futures
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+import sinter
+import stim
+
+#------------------------------------------------------------------------------
+# detection-event store
+#------------------------------------------------------------------------------
+
+class ShotStore:
+    ''' Bit-packed detection events and observable flips of one circuit,
+    sampled once and kept in two .npy files that are read back memory-mapped.
+
+    The files live next to the circuit: for circuit_path 'abc.stim' they are
+    'abc.dets.npy' (shots x ceil(num_detectors / 8) bytes) and 'abc.obs.npy'
+    (shots x ceil(num_observables / 8) bytes), bit packed in little endian
+    bit order like stim and sinter use. Inside a CircuitCache directory they
+    are not counted towards its max_bytes and never evicted: they stay until
+    remove() deletes them, so delete stores once they are decoded.
+
+        circuit_path = CircuitCache().circuit_path(shape = (5, 10), ...)
+        store = sample_store(circuit_path, shots = 10**6)
+        stats = decode_store(store, circuit_path, {'bposd' : bposd_decoder()})'''
+
+    def __init__(self, circuit_path : str) -> None:
+        prefix = circuit_path[:-len('.stim')] if circuit_path.endswith('.stim') else circuit_path
+        self.detectors_path = prefix + '.dets.npy'
+        self.observables_path = prefix + '.obs.npy'
+
+    def exists(self) -> bool:
+        return os.path.exists(self.detectors_path) and os.path.exists(self.observables_path)
+
+    @property
+    def num_shots(self) -> int:
+        return len(self.detectors()) if self.exists() else 0
+
+    def detectors(self) -> np.ndarray:
+        ''' Read-only memory map of the bit-packed detection events.'''
+
+        return np.load(self.detectors_path, mmap_mode = 'r')
+
+    def observables(self) -> np.ndarray:
+        ''' Read-only memory map of the bit-packed observable flips.'''
+
+        return np.load(self.observables_path, mmap_mode = 'r')
+
+    def remove(self) -> None:
+        ''' Delete the files of the store.'''
+
+        for path in [self.detectors_path, self.observables_path]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def chunks(self, chunk_size : int) -> list[tuple[int, int]]:
+        ''' (start, stop) shot ranges of at most chunk_size shots.'''
+
+        n = self.num_shots
+        return [(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+
+def sample_store(circuit_path : str, shots : int, chunk_size : int = 100000, seed : int | None = None) -> ShotStore:
+    ''' Sample shots of the circuit in circuit_path into its ShotStore.
+
+    A store that already holds at least shots shots is reused as it is,
+    otherwise it is sampled anew. Sampling goes chunk by chunk straight into
+    the memory-mapped files, so memory stays bounded for any number of shots.'''
+
+    store = ShotStore(circuit_path)
+    if store.num_shots >= shots:
+        return store
+
+    circuit = stim.Circuit.from_file(circuit_path)
+    sampler = circuit.compile_detector_sampler(seed = seed)
+
+    # write to temporary files first, so that readers never see half a store:
+    paths = []
+    arrays = []
+    for path, bits in [(store.detectors_path, circuit.num_detectors), (store.observables_path, circuit.num_observables)]:
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        paths.append((tmp_path, path))
+        arrays.append(np.lib.format.open_memmap(tmp_path, mode = 'w+', dtype = np.uint8,
+                                                shape = (shots, (bits + 7) // 8)))
+
+    detectors, observables = arrays
+    for start in range(0, shots, chunk_size):
+        stop = min(start + chunk_size, shots)
+        detectors[start:stop], observables[start:stop] = sampler.sample(
+            stop - start, separate_observables = True, bit_packed = True)
+
+    for array in arrays:
+        array.flush()
+    del detectors, observables, arrays
+    for tmp_path, path in paths:
+        os.replace(tmp_path, path)
+    return store
+
+
+#------------------------------------------------------------------------------
+# decoding
+#------------------------------------------------------------------------------
+
+def sinter_detector_error_model(circuit : stim.Circuit) -> stim.DetectorErrorModel:
+    ''' The detector error model sinter itself gives its decoders (and hashes
+    into the strong_id of a task).'''
+
+    try:
+        return circuit.detector_error_model(decompose_errors = True, approximate_disjoint_errors = True)
+    except ValueError:
+        try:
+            return circuit.detector_error_model(approximate_disjoint_errors = True)
+        except ValueError:
+            return circuit.detector_error_model(approximate_disjoint_errors = True, flatten_loops = True)
+
+
+def compile_decoder(decoder : sinter.Decoder, dem : stim.DetectorErrorModel):
+    ''' decoder.compile_decoder_for_dem(dem = dem), or None for decoders that
+    only implement decode_via_files() (such as ldpc's SinterBpOsdDecoder).'''
+
+    try:
+        return decoder.compile_decoder_for_dem(dem = dem)
+    except NotImplementedError:
+        return None
+
+
+def decode_bit_packed(decoder : sinter.Decoder, compiled, dem : stim.DetectorErrorModel, detectors : np.ndarray) -> np.ndarray:
+    ''' Bit-packed observable predictions of decoder for bit-packed detection
+    events, with compiled = compile_decoder(decoder, dem).'''
+
+    if compiled is not None:
+        return compiled.decode_shots_bit_packed(bit_packed_detection_event_data = detectors)
+
+    # b8 files hold the same bytes as the bit-packed arrays:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dem_path = os.path.join(tmp_dir, 'dem.dem')
+        dets_path = os.path.join(tmp_dir, 'dets.b8')
+        obs_path = os.path.join(tmp_dir, 'obs.b8')
+        dem.to_file(dem_path)
+        np.ascontiguousarray(detectors).tofile(dets_path)
+        decoder.decode_via_files(
+            num_shots = len(detectors),
+            num_dets = dem.num_detectors,
+            num_obs = dem.num_observables,
+            dem_path = pathlib.Path(dem_path),
+            dets_b8_in_path = pathlib.Path(dets_path),
+            obs_predictions_b8_out_path = pathlib.Path(obs_path),
+            tmp_dir = pathlib.Path(tmp_dir),
+        )
+        return np.fromfile(obs_path, dtype = np.uint8).reshape(len(detectors), -1)
+
+
+# per-process decoding state, set up once per worker by _init_worker():
+_worker = {}
+
+
+def _init_worker(dem_text : str, decoders : dict, store : ShotStore) -> None:
+    _worker.clear()
+    _worker['dem'] = stim.DetectorErrorModel(dem_text)
+    _worker['decoders'] = decoders
+    _worker['compiled'] = {}
+    _worker['store'] = store
+
+
+def _decode_chunk(name : str, start : int, stop : int) -> tuple[str, int, int, float]:
+    store = _worker['store']
+    detectors = np.asarray(store.detectors()[start:stop])
+    observables = np.asarray(store.observables()[start:stop])
+
+    decoder = _worker['decoders'][name]
+    compiled = _worker['compiled']
+    t = time.monotonic()
+    if name not in compiled:
+        compiled[name] = compile_decoder(decoder, _worker['dem'])
+    predictions = decode_bit_packed(decoder, compiled[name], _worker['dem'], detectors)
+    seconds = time.monotonic() - t
+
+    errors = int(np.count_nonzero(np.any(predictions != observables, axis = 1)))
+    return name, stop - start, errors, seconds
+
+
+def decode_store(
+        store : ShotStore,
+        circuit_path : str,
+        decoders : dict,
+        json_metadata = None,
+        chunk_size : int = 10000,
+        max_workers : int | None = None,
+) -> list[sinter.TaskStats]:
+    ''' Decode every shot of a ShotStore with each decoder in decoders, a dict
+    of sinter.Decoder objects by name (e.g. one entry per max_iter or
+    ms_scaling_factor setting), across a process pool.
+
+    Workers read chunk_size shots at a time from the memory-mapped store. The
+    result holds one sinter.TaskStats per decoder, with the strong_id sinter
+    would give the same task, so it can be written with save_stats() and read
+    by sinter.read_stats_from_csv_files() next to sinter.collect() results.'''
+
+    circuit = stim.Circuit.from_file(circuit_path)
+    dem = sinter_detector_error_model(circuit)
+
+    totals = {name : [0, 0, 0.0] for name in decoders}
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers = max_workers,
+            initializer = _init_worker,
+            initargs = (str(dem), decoders, store)) as pool:
+        futures = [pool.submit(_decode_chunk, name, start, stop)
+                   for name in decoders for start, stop in store.chunks(chunk_size)]
+        for future in concurrent.futures.as_completed(futures):
+            name, shots, errors, seconds = future.result()
+            totals[name][0] += shots
+            totals[name][1] += errors
+            totals[name][2] += seconds
+
+    stats = []
+    for name, (shots, errors, seconds) in totals.items():
+        task = sinter.Task(circuit = circuit, decoder = name, detector_error_model = dem, json_metadata = json_metadata)
+        stats.append(sinter.TaskStats(
+            strong_id = task.strong_id(),
+            decoder = name,
+            json_metadata = json_metadata,
+            shots = shots,
+            errors = errors,
+            seconds = seconds,
+        ))
+    return stats
+
+
+def save_stats(stats : list[sinter.TaskStats], path : str) -> None:
+    ''' Append stats to a sinter CSV file, writing the header to new files.'''
+
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    with open(path, 'a') as f:
+        if new:
+            print(sinter.CSV_HEADER, file = f)
+        for stat in stats:
+            print(stat.to_csv_line(), file = f)
@@ -0,0 +1,187 @@
+import hashlib
+
+import numpy as np
+import scipy.sparse
+import sinter
+import stim
+from ldpc.ckt_noise.dem_matrices import detector_error_model_to_check_matrices
+
+from bp_decoder import BatchBpOsd
+
+#------------------------------------------------------------------------------
+# windows
+#------------------------------------------------------------------------------
+#
+# The round of a detector is its last coordinate (see circuit_builder()). An
+# error mechanism spans the rounds from its first to its last detector. The
+# window starting at round s holds the detectors of rounds s, ..., s + size - 1
+# and the undecided mechanisms that reach them, cut off at the end of the
+# window. Mechanisms whose last detector lies in the first commit rounds are
+# committed: their detector flips (inside and after the window) are removed
+# from the syndrome and their observable flips added to the prediction. So
+# every committed mechanism lies wholly inside the window, with at least one
+# round of buffer after it. The next window starts commit rounds later. It
+# also holds the detectors of round s - 1, through which the mechanisms that
+# cross from the commit region into the buffer stay tied to the decisions
+# already taken. The last window commits everything.
+
+
+def detector_rounds(dem : stim.DetectorErrorModel) -> np.ndarray:
+    ''' Round of every detector of dem, its last coordinate.'''
+
+    coordinates = dem.get_detector_coordinates()
+    if any(not coordinates[k] for k in range(dem.num_detectors)):
+        raise ValueError('sliding window decoding needs coordinates on every detector, with the round last')
+    return np.array([coordinates[k][-1] for k in range(dem.num_detectors)], dtype = np.int64)
+
+
+class Window:
+    ''' One decoding window: its first round start, the detectors rows (a
+    range), the mechanisms columns, the commit mask over columns, and the
+    detectors (affected, a range) and observables that the committed
+    mechanisms flip, as sparse matrices over the committed columns.'''
+
+    def __init__(self, start, rows, columns, commit, affected, detector_flips, observable_flips, key) -> None:
+        self.start = start
+        self.rows = rows
+        self.columns = columns
+        self.commit = commit
+        self.affected = affected
+        self.detector_flips = detector_flips
+        self.observable_flips = observable_flips
+        self.key = key
+
+
+def _canonical_order(H, rows : range, columns : np.ndarray, priors : np.ndarray) -> np.ndarray:
+    # columns sorted by their detectors relative to the window (then by prior),
+    # so that windows of the same shape get the same check matrix:
+    window = H[rows.start:rows.stop][:, columns].tocsc()
+    window.sort_indices()
+    signatures = [tuple(window.indices[window.indptr[k]:window.indptr[k + 1]]) for k in range(len(columns))]
+    order = sorted(range(len(columns)), key = lambda k: (signatures[k], priors[columns[k]]))
+    return columns[order]
+
+
+def _window_key(check_matrix, priors, commit) -> str:
+    # windows with the same matrices (all but the first and last few of a
+    # long memory experiment) share one decoder:
+    digest = hashlib.sha256()
+    for array in (check_matrix.indptr, check_matrix.indices, np.asarray(check_matrix.shape), priors, commit):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+#------------------------------------------------------------------------------
+# sinter decoder
+#------------------------------------------------------------------------------
+
+class CompiledSlidingWindowDecoder(sinter.CompiledDecoder):
+    ''' SlidingWindowDecoder configured for one detector error model.'''
+
+    def __init__(self, dem : stim.DetectorErrorModel, window : int, commit : int, max_iter, ms_scaling_factor,
+                 osd_method, osd_order) -> None:
+        matrices = detector_error_model_to_check_matrices(dem, allow_undecomposed_hyperedges = True)
+        H = scipy.sparse.csc_matrix(matrices.check_matrix, dtype = np.uint8)
+        L = scipy.sparse.csc_matrix(matrices.observables_matrix, dtype = np.uint8)
+        priors = np.asarray(matrices.priors, dtype = np.float64)
+
+        self.num_detectors = dem.num_detectors
+        self.num_observables = dem.num_observables
+
+        # detectors are numbered in round order:
+        rounds = detector_rounds(dem)
+        if np.any(np.diff(rounds) < 0):
+            raise ValueError('detectors must be numbered in the order of their rounds')
+        num_rounds = int(rounds[-1]) + 1 if len(rounds) else 0
+        round_starts = np.searchsorted(rounds, np.arange(num_rounds + 1))
+
+        # mechanisms that flip no detector cannot be decoded, leave them out:
+        first_row = np.full(H.shape[1], -1)
+        last_row = np.full(H.shape[1], -1)
+        has_rows = np.diff(H.indptr) > 0
+        first_row[has_rows] = H.indices[H.indptr[:-1][has_rows]]
+        last_row[has_rows] = H.indices[H.indptr[1:][has_rows] - 1]
+        first_round = np.where(has_rows, rounds[first_row], -1)
+        last_round = np.where(has_rows, rounds[last_row], -1)
+
+        self.windows = []
+        self.decoders = {}
+        start = 0
+        while start < num_rounds:
+            stop = min(start + window, num_rounds)
+            last = stop == num_rounds
+            rows = range(round_starts[max(start - 1, 0)], round_starts[stop])
+            # the mechanisms that earlier windows did not commit:
+            columns = np.nonzero((last_round >= start) & (first_round < stop))[0]
+            columns = _canonical_order(H, rows, columns, priors)
+            commit_mask = np.ones(len(columns), dtype = bool) if last else last_round[columns] < start + commit
+
+            check_matrix = H[rows.start:rows.stop][:, columns].tocsr()
+            check_matrix.sort_indices()
+            key = _window_key(check_matrix, priors[columns], commit_mask)
+            if key not in self.decoders:
+                self.decoders[key] = BatchBpOsd(check_matrix, priors[columns], max_iter, ms_scaling_factor,
+                                                osd_method, osd_order)
+
+            committed = columns[commit_mask]
+            affected = range(rows.start, int(last_row[committed].max()) + 1 if len(committed) else rows.start)
+            self.windows.append(Window(
+                start = start,
+                rows = rows,
+                columns = columns,
+                commit = commit_mask,
+                affected = affected,
+                detector_flips = H[affected.start:affected.stop][:, committed].T.tocsr(),
+                observable_flips = L[:, committed].T.tocsr(),
+                key = key,
+            ))
+            if last:
+                break
+            start += commit
+
+    def decode_shots_bit_packed(self, *, bit_packed_detection_event_data : np.ndarray) -> np.ndarray:
+        packed = np.ascontiguousarray(bit_packed_detection_event_data)
+        syndromes = np.unpackbits(packed, axis = 1, bitorder = 'little')[:, :self.num_detectors]
+        predictions = np.zeros((len(packed), self.num_observables), dtype = np.uint8)
+
+        # windows only read the detection events up to their end and only
+        # change the ones of committed mechanisms from their start on:
+        for window in self.windows:
+            errors = self.decoders[window.key].decode(syndromes[:, window.rows.start:window.rows.stop])
+            committed = errors[:, window.commit]
+            if not committed.any():
+                continue
+            syndromes[:, window.affected.start:window.affected.stop] ^= (committed @ window.detector_flips).astype(np.uint8) & 1
+            predictions ^= (committed @ window.observable_flips).astype(np.uint8) & 1
+
+        return np.packbits(predictions, axis = 1, bitorder = 'little')
+
+
+class SlidingWindowDecoder(sinter.Decoder):
+    ''' Sinter decoder for many-round memory experiments that decodes
+    overlapping windows of window rounds with BatchBpOsd, committing the
+    correction of the first commit rounds of every window (see the notes
+    above), where commit < window. The detectors need the round as their last coordinate, as
+    circuit_builder() gives them.
+
+    Windows in the bulk of the experiment have the same check matrix, so they
+    share one decoder: the decoding cost per round and the decoder memory stay
+    constant in the number of rounds, unlike BP-OSD over the whole detector
+    error model.
+
+        sinter.collect(..., custom_decoders = {'window_bposd' : SlidingWindowDecoder(window = 4, commit = 2)})'''
+
+    def __init__(self, window : int = 4, commit : int = 2, max_iter : int = 0, ms_scaling_factor : float = 0.625,
+                 osd_method : str = 'osd0', osd_order : int = 0) -> None:
+        if not 0 < commit < window:
+            raise ValueError(f'commit must be between 1 and window - 1 ({window - 1}), not {commit}')
+        self.window = window
+        self.commit = commit
+        self.max_iter = max_iter
+        self.ms_scaling_factor = ms_scaling_factor
+        self.osd_method = osd_method
+        self.osd_order = osd_order
+
+    def compile_decoder_for_dem(self, *, dem : stim.DetectorErrorModel) -> CompiledSlidingWindowDecoder:
+        return CompiledSlidingWindowDecoder(dem, self.window, self.commit, self.max_iter, self.ms_scaling_factor,
+                                            self.osd_method, self.osd_order)
@@ -0,0 +1,179 @@
+import math
+
+import numpy as np
+import sinter
+import stim
+from scipy.stats import norm
+
+from shot_store import compile_decoder, decode_bit_packed
+
+#------------------------------------------------------------------------------
+# fault mechanisms
+#------------------------------------------------------------------------------
+#
+# A detector error model is a list of independent mechanisms i that fire with
+# probability q_i. Given that exactly w of them fire, a set S of w mechanisms
+# fires with probability prod_{i in S} r_i / e_w(r), with the odds
+# r_i = q_i / (1 - q_i) and e_w the elementary symmetric polynomial of degree
+# w, and w faults happen with probability prod_i (1 - q_i) * e_w(r). So the
+# failure rate is sum_w P(w) * P(fail | w), and P(fail | w) at any p follows
+# from fault sets sampled at a reference p0 by importance weights
+# prod_{i in S} r_i(p) / r_i(p0) * e_w(r(p0)) / e_w(r(p)).
+
+
+def fault_mechanisms(dem : stim.DetectorErrorModel):
+    ''' (detectors, observables, priors) of the mechanisms of a detector error
+    model: the bit-packed detectors and observables each mechanism flips, one
+    row per error instruction of the flattened model (the components of
+    decomposed mechanisms combined), and its probability.
+
+    Not the columns of the decoders' check matrix, which merges mechanisms
+    that flip the same detectors but different observables.'''
+
+    errors = [instruction for instruction in dem.flattened() if instruction.type == 'error']
+    detectors = np.zeros((len(errors), dem.num_detectors), dtype = np.uint8)
+    observables = np.zeros((len(errors), dem.num_observables), dtype = np.uint8)
+    for row, instruction in enumerate(errors):
+        for target in instruction.targets_copy():
+            if target.is_relative_detector_id():
+                detectors[row, target.val] ^= 1
+            elif target.is_logical_observable_id():
+                observables[row, target.val] ^= 1
+    priors = np.array([instruction.args_copy()[0] for instruction in errors], dtype = np.float64)
+    return (np.packbits(detectors, axis = 1, bitorder = 'little'),
+            np.packbits(observables, axis = 1, bitorder = 'little'), priors)
+
+
+def elementary_symmetric(r : np.ndarray, max_degree : int) -> np.ndarray:
+    ''' e_0(r), ..., e_max_degree(r).'''
+
+    e = np.zeros(max_degree + 1)
+    e[0] = 1.0
+    for x in r.tolist():
+        e[1:] = e[1:] + x * e[:-1]
+    return e
+
+
+def fault_count_probabilities(priors : np.ndarray, max_faults : int) -> np.ndarray:
+    ''' Probability that exactly w mechanisms fire, for w = 0, ..., max_faults.'''
+
+    log_none = np.sum(np.log1p(-priors))
+    return np.exp(log_none) * elementary_symmetric(priors / (1 - priors), max_faults)
+
+
+def sample_fault_sets(priors : np.ndarray, w : int, shots : int, rng : np.random.Generator) -> np.ndarray:
+    ''' shots sets of w distinct mechanisms, drawn with the probability of S
+    given that exactly w mechanisms fire. Draws w mechanisms with probability
+    proportional to their odds and rejects draws with repeats, which leaves
+    exactly that distribution.'''
+
+    odds = priors / (1 - priors)
+    odds = odds / odds.sum()
+
+    accepted = []
+    n = 0
+    while n < shots:
+        draws = np.sort(rng.choice(len(priors), size = (2 * (shots - n) + 16, w), p = odds), axis = 1)
+        draws = draws[np.all(draws[:, 1:] != draws[:, :-1], axis = 1)][:shots - n]
+        accepted.append(draws)
+        n += len(draws)
+    return np.concatenate(accepted)
+
+
+#------------------------------------------------------------------------------
+# stratified estimator
+#------------------------------------------------------------------------------
+
+class FaultStrata:
+    ''' Decoded fault sets of a circuit, stratified by the number of faults w,
+    that estimate the logical failure rate of the same circuit at any p.
+
+    Sample once at a reference p0 (at the low end of the range of interest),
+    then reweight to every p with the detector error model of the circuit at
+    that p, which must have the same mechanisms:
+
+        build = lambda p: circuit_builder(..., after_clifford_depolarization = p, ...)
+        strata = FaultStrata.sample(build(1e-3).detector_error_model(), decoder, max_faults = 6)
+        estimates = [strata.failure_rate(build(p).detector_error_model()) for p in ps]
+
+    The decoder is configured with the detector error model at p0 for all p.
+    The detectors and observables of every mechanism are kept, to check that
+    the model at p has the same mechanisms.'''
+
+    def __init__(self, detectors : np.ndarray, observables : np.ndarray, priors : np.ndarray,
+                 fault_sets : list[np.ndarray], failures : list[np.ndarray]) -> None:
+        self.detectors = detectors
+        self.observables = observables
+        self.priors = priors
+        self.fault_sets = fault_sets
+        self.failures = failures
+
+    @property
+    def max_faults(self) -> int:
+        return len(self.fault_sets) - 1
+
+    @classmethod
+    def sample(
+            cls,
+            dem : stim.DetectorErrorModel,
+            decoder : sinter.Decoder,
+            max_faults : int = 6,
+            shots_per_stratum : int = 10000,
+            seed : int | None = None,
+    ) -> 'FaultStrata':
+        ''' Sample and decode shots_per_stratum fault sets for every number of
+        faults w = 1, ..., max_faults of the mechanisms of dem. No fault never
+        fails.'''
+
+        rng = np.random.default_rng(seed)
+        detectors, observables, priors = fault_mechanisms(dem)
+        compiled = compile_decoder(decoder, dem)
+
+        fault_sets = [np.zeros((1, 0), dtype = np.int64)]
+        failures = [np.zeros(1, dtype = bool)]
+        for w in range(1, max_faults + 1):
+            sets = sample_fault_sets(priors, w, shots_per_stratum, rng)
+            predictions = decode_bit_packed(decoder, compiled, dem, np.bitwise_xor.reduce(detectors[sets], axis = 1))
+            fault_sets.append(sets)
+            failures.append(np.any(predictions != np.bitwise_xor.reduce(observables[sets], axis = 1), axis = 1))
+        return cls(detectors, observables, priors, fault_sets, failures)
+
+    def failure_rate(self, dem : stim.DetectorErrorModel, confidence : float = 0.95) -> dict:
+        ''' Estimated failure rate at the noise strength of dem, with a normal
+        confidence interval. The upper end includes the probability of more
+        than max_faults faults, which are not sampled, and a stratum without
+        any failures adds its rule-of-three bound instead of zero.'''
+
+        detectors, observables, priors = fault_mechanisms(dem)
+        if not (np.array_equal(detectors, self.detectors) and np.array_equal(observables, self.observables)):
+            raise ValueError('the detector error model has different mechanisms than the sampled one')
+
+        probabilities = fault_count_probabilities(priors, self.max_faults)
+        e_ref = elementary_symmetric(self.priors / (1 - self.priors), self.max_faults)
+        e_new = elementary_symmetric(priors / (1 - priors), self.max_faults)
+        log_ratio = np.log(priors / (1 - priors)) - np.log(self.priors / (1 - self.priors))
+
+        z = norm.ppf(0.5 + confidence / 2)
+        rate = variance = upper = 0.0
+        strata = []
+        for w in range(1, self.max_faults + 1):
+            weights = np.exp(log_ratio[self.fault_sets[w]].sum(axis = 1)) * e_ref[w] / e_new[w]
+            values = weights * self.failures[w]
+            n = len(values)
+            mean = values.mean()
+            rate += probabilities[w] * mean
+            variance += probabilities[w]**2 * values.var(ddof = 1) / n
+            if not self.failures[w].any():
+                upper += probabilities[w] * weights.max() * -math.log(1 - confidence) / n
+            strata.append({'faults' : w, 'probability' : float(probabilities[w]), 'failure_rate' : float(mean),
+                           'failures' : int(self.failures[w].sum()), 'shots' : n})
+
+        tail = max(1.0 - probabilities.sum(), 0.0)
+        sigma = math.sqrt(variance)
+        return {
+            'rate' : float(rate),
+            'low' : float(max(rate - z * sigma, 0.0)),
+            'high' : float(rate + z * sigma + upper + tail),
+            'truncation' : float(tail),
+            'strata' : strata,
+        }
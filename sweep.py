@@ -0,0 +1,518 @@
+import itertools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import sinter
+from ldpc.sinter_decoders import SinterBpOsdDecoder
+
+from bp_decoder import BatchBpOsdDecoder
+from circuit_cache import CircuitCache, circuit_key
+from linear_dem import LinearDEM
+from sliding_window import SlidingWindowDecoder
+
+#------------------------------------------------------------------------------
+# task generation
+#------------------------------------------------------------------------------
+
+def bposd_decoder() -> SinterBpOsdDecoder:
+    ''' The BP-OSD decoder configuration used in our experiments.'''
+
+    return SinterBpOsdDecoder(
+        max_iter=13,
+        bp_method="ms",
+        ms_scaling_factor=0.5,
+        schedule="parallel",
+        osd_method="osd0")
+
+
+def batch_bposd_decoder() -> BatchBpOsdDecoder:
+    ''' bposd_decoder() with batched BP, for the low p points.'''
+
+    return BatchBpOsdDecoder(
+        max_iter = 13,
+        ms_scaling_factor = 0.5,
+        osd_method = 'osd0')
+
+
+def window_bposd_decoder() -> SlidingWindowDecoder:
+    ''' batch_bposd_decoder() on sliding windows, for many rounds.'''
+
+    return SlidingWindowDecoder(
+        window = 4,
+        commit = 2,
+        max_iter = 13,
+        ms_scaling_factor = 0.5,
+        osd_method = 'osd0')
+
+
+CUSTOM_DECODERS = {
+    'bposd' : bposd_decoder,
+    'batch_bposd' : batch_bposd_decoder,
+    'window_bposd' : window_bposd_decoder,
+}
+
+
+def structure_key(**structure) -> str:
+    ''' Short hash of the circuit_builder() arguments of a task other than
+    its noise strengths (layout, checks, crossings, observables, experiment,
+    rounds). It goes into the json_metadata of every task, so that sweeps of
+    different codes or settings that share a resume file keep apart.'''
+
+    return circuit_key(**structure)[:16]
+
+
+def task_key(decoder : str, json_metadata : dict) -> str:
+    ''' Key of a task by its decoder and json_metadata, the same in every run
+    and on every node (see finished_tasks()).'''
+
+    return decoder + json.dumps(json_metadata, sort_keys = True)
+
+
+def finished_tasks(resume_file : str, max_shots : int, max_errors : int) -> set[str]:
+    ''' task_key() of the (decoder, json_metadata) pairs in a sinter resume
+    file that already reached max_shots or max_errors.'''
+
+    if resume_file is None or not os.path.exists(resume_file):
+        return set()
+
+    finished = set()
+    for stat in sinter.read_stats_from_csv_files(resume_file):
+        if stat.shots >= max_shots or stat.errors >= max_errors:
+            finished.add(task_key(stat.decoder, stat.json_metadata))
+    return finished
+
+
+def generate_tasks(
+        embeddings,
+        alphas,
+        ps,
+        experiments,
+        shape,
+        row_checks,
+        col_checks,
+        rounds : int = 3,
+        ind_obs = False,
+        decoders = ('bposd',),
+        cache : CircuitCache | None = None,
+        skip : set[str] = frozenset(),
+        linear_dems : bool = False,
+        collection_options = None,
+):
+    ''' Lazily yield one sinter.Task per embedding, alpha, p and experiment.
+
+    embeddings is a list of [embedding, log_obs] pairs, e.g.
+    [[embedding_B1, log_obs], [embedding_B2, log_obs]]. The crossed gates get
+    the error rate alpha * p, all other operations p. Circuits are only built
+    when the generator reaches them, and are written to the cache directory
+    instead of being held in memory: the tasks point at the .stim file, so that
+    the sinter workers load the circuit and derive its detector error model.
+    These files are pinned in the cache (see CircuitCache.pin()), so that
+    they are not evicted before the workers load them; the caller unpins
+    them once the tasks are collected. Tasks whose key is in skip (see
+    finished_tasks()) are never built.
+
+    The json_metadata of a task holds p, alpha, the embedding name as
+    'crossing', the experiment, rounds, ind_obs and the structure_key() of
+    its circuit.
+
+    collection_options, if given, is called with the decoder name and the
+    json_metadata of every task and returns its sinter.CollectionOptions, or
+    None to leave the task out (before its circuit is built).
+
+    With linear_dems, the detector error model of every task is derived from
+    one LinearDEM per embedding and experiment instead of by the workers, with
+    the same decomposed mechanisms that sinter would derive.'''
+
+    structures = {}
+
+    for experiment in experiments:
+        basis = 'x' if experiment == 'x_memory' else 'z'
+        for alpha in alphas:
+            for p in ps:
+                for embedding, log_obs in embeddings:
+                    observable = log_obs[basis]
+                    structure = dict(
+                        shape = shape,
+                        row_checks = row_checks,
+                        col_checks = col_checks,
+                        crossings = 0 if alpha == 0 else embedding[1],
+                        observable = observable if ind_obs is False else [observable[ind_obs]],
+                        experiment = experiment,
+                        rounds = rounds,
+                    )
+                    json_metadata = {
+                        'p' : float(p),
+                        'alpha' : float(alpha),
+                        'crossing' : embedding[0],
+                        'experiment' : experiment,
+                        'rounds' : int(rounds),
+                        'ind_obs' : ind_obs,
+                        'structure' : structure_key(**structure),
+                    }
+                    options = {}
+                    for d in decoders:
+                        if task_key(d, json_metadata) in skip:
+                            continue
+                        options[d] = collection_options(d, json_metadata) if collection_options else sinter.CollectionOptions()
+                    todo = [d for d in options if options[d] is not None]
+                    if not todo:
+                        continue
+
+                    noise = dict(
+                        after_clifford_depolarization = p,
+                        after_crossing_depolarization = alpha * p,
+                        after_reset_flip_probability = p,
+                        before_measure_flip_probability = p,
+                    )
+                    # the default cache is only created once a circuit is built:
+                    if cache is None:
+                        cache = CircuitCache()
+                    circuit_path = cache.circuit_path(**structure, **noise)
+                    cache.pin(circuit_path)
+
+                    dem = None
+                    if linear_dems:
+                        key = (embedding[0], experiment, alpha == 0)
+                        if key not in structures:
+                            structures[key] = LinearDEM.from_layout(decompose_errors = True, **structure)
+                        dem = structures[key].detector_error_model(**noise)
+
+                    for decoder in todo:
+                        yield sinter.Task(
+                            circuit_path = circuit_path,
+                            decoder = decoder,
+                            detector_error_model = dem,
+                            json_metadata = json_metadata,
+                            collection_options = options[decoder],
+                        )
+
+
+#------------------------------------------------------------------------------
+# sweeps
+#------------------------------------------------------------------------------
+
+def collect_in_chunks(tasks, chunk_size : int = 64, **collect_options) -> list[sinter.TaskStats]:
+    ''' sinter.collect() over the tasks chunk_size at a time.
+
+    sinter.collect() lists all its tasks before it starts sampling, which
+    would build every circuit of generate_tasks() first. Here only the first
+    chunk is built before sampling starts; every further chunk is built in a
+    background thread while the one before it samples. Returns the statistics
+    of all chunks, and of the save_resume_filepath if one is given.'''
+
+    tasks = iter(tasks)
+    stats = {}
+    resume_file = collect_options.get('save_resume_filepath')
+    if resume_file is not None and os.path.exists(resume_file):
+        stats = {stat.strong_id : stat for stat in sinter.read_stats_from_csv_files(resume_file)}
+
+    with ThreadPoolExecutor(max_workers = 1) as builder:
+        chunk = list(itertools.islice(tasks, chunk_size))
+        while chunk:
+            next_chunk = builder.submit(lambda: list(itertools.islice(tasks, chunk_size)))
+            # with a resume file, sinter returns everything in it, so later chunks supersede earlier ones:
+            stats |= {stat.strong_id : stat for stat in sinter.collect(tasks = chunk, **collect_options)}
+            chunk = next_chunk.result()
+    return list(stats.values())
+
+
+
+def run_sweep(
+        embeddings,
+        alphas,
+        ps,
+        experiments,
+        shape,
+        row_checks,
+        col_checks,
+        rounds : int = 3,
+        ind_obs = False,
+        decoders = ('bposd',),
+        max_shots : int = 500000,
+        max_errors : int = 500,
+        num_workers : int | None = None,
+        resume_file : str | None = None,
+        cache_dir : str = '.circuit_cache',
+        print_progress : bool = False,
+        linear_dems : bool = False,
+        build_hook = None,
+        chunk_size : int = 64,
+) -> list[sinter.TaskStats]:
+    ''' Sample every task of generate_tasks() with sinter and BP-OSD, using the
+    decoders named in CUSTOM_DECODERS, chunk_size tasks at a time (see
+    collect_in_chunks()), so that sampling starts once the circuits of the
+    first chunk are built.
+
+    With a resume_file, sinter appends its statistics to that file and counts
+    the ones already in it. Tasks that already reached max_shots or max_errors
+    there are skipped without building their circuits, partially sampled tasks
+    continue where they stopped. The returned statistics include the ones read
+    from the resume file.
+
+    build_hook is passed on to the CircuitCache, e.g. a BuildStatsCollector
+    that gathers the BuildStats of every circuit the sweep builds.'''
+
+    skip = finished_tasks(resume_file, max_shots, max_errors)
+    cache = CircuitCache(cache_dir, build_hook = build_hook)
+
+    try:
+        return collect_in_chunks(
+            chunk_size = chunk_size,
+            num_workers = num_workers or max(multiprocessing.cpu_count() - 1, 1),
+            max_shots = max_shots,
+            max_errors = max_errors,
+            tasks = generate_tasks(
+                embeddings = embeddings,
+                alphas = alphas,
+                ps = ps,
+                experiments = experiments,
+                shape = shape,
+                row_checks = row_checks,
+                col_checks = col_checks,
+                rounds = rounds,
+                ind_obs = ind_obs,
+                decoders = decoders,
+                cache = cache,
+                skip = skip,
+                linear_dems = linear_dems,
+            ),
+            custom_decoders = {name : CUSTOM_DECODERS[name]() for name in decoders},
+            save_resume_filepath = resume_file,
+            print_progress = print_progress,
+        )
+    finally:
+        cache.unpin()
+
+
+#------------------------------------------------------------------------------
+# adaptive sweeps
+#------------------------------------------------------------------------------
+#
+# Curves are the logical error rates of one (crossing, decoder) pair against p
+# at fixed experiment and alpha, or against alpha at fixed experiment and p.
+# At every point, two curves are tied if their confidence intervals overlap,
+# and so are a curve and the physical error rate p, whose crossing is the
+# pseudo-threshold. Where the best estimates of two curves change order
+# between neighbouring points, and they are not tied at both, a crossing lies
+# in between and the interval is split. Ties at both ends are left to more
+# shots first, which keeps statistical noise from adding points.
+
+
+def _fits(stats : list[sinter.TaskStats], likelihood_factor : float) -> dict:
+    # {(experiment, alpha, p) : {(crossing, decoder) : (shots, errors, fit)}}
+    fits = {}
+    for stat in stats:
+        meta = stat.json_metadata
+        fit = sinter.fit_binomial(num_shots = stat.shots - stat.discards, num_hits = stat.errors,
+                                  max_likelihood_factor = likelihood_factor)
+        point = (meta['experiment'], meta['alpha'], meta['p'])
+        fits.setdefault(point, {})[(meta['crossing'], stat.decoder)] = (stat.shots, stat.errors, fit)
+    return fits
+
+
+def _orderings(curves : dict, p : float) -> dict:
+    # (sign of the difference of the best estimates, tied) of every pair of
+    # curves at one point, and of every curve against p:
+    fits = {curve : fit for curve, (_, _, fit) in curves.items()}
+    names = sorted(fits)
+    pairs = [(a, 'p') for a in names] + [(a, b) for k, a in enumerate(names) for b in names[k + 1:]]
+
+    orderings = {}
+    for a, b in pairs:
+        low, best, high = (p, p, p) if b == 'p' else (fits[b].low, fits[b].best, fits[b].high)
+        orderings[(a, b)] = (np.sign(fits[a].best - best), fits[a].low <= high and low <= fits[a].high)
+    return orderings
+
+
+def refine_points(stats : list[sinter.TaskStats], min_p_ratio : float = 1.1, min_alpha_step : float = 0.1,
+                  likelihood_factor : float = 1000) -> tuple[dict, set]:
+    ''' Points of a sweep to add and points that need more shots, as
+    (experiment, alpha, p) tuples.
+
+    Returns (new_points, contested). new_points maps the midpoints (geometric
+    in p, arithmetic in alpha) of the neighbouring points across which two
+    curves, or a curve and the physical error rate, cross, as long as they are
+    at least min_p_ratio and min_alpha_step apart, to the number of shots
+    taken at the less sampled of the two. contested are the points at which
+    two curves or a curve and p are tied, and the ends of the split
+    intervals.'''
+
+    fits = _fits(stats, likelihood_factor)
+    orderings = {point : _orderings(curves, point[2]) for point, curves in fits.items()}
+
+    new_points = {}
+    contested = {point for point, order in orderings.items() if any(tied for _, tied in order.values())}
+
+    lines = {}
+    for point in fits:
+        experiment, alpha, p = point
+        lines.setdefault(('p', experiment, alpha), []).append(point)
+        lines.setdefault(('alpha', experiment, p), []).append(point)
+
+    for (axis, *_), points in lines.items():
+        points.sort()
+        for a, b in zip(points, points[1:]):
+            crossed = False
+            for pair in orderings[a].keys() & orderings[b].keys():
+                (sign_a, tied_a), (sign_b, tied_b) = orderings[a][pair], orderings[b][pair]
+                crossed |= sign_a * sign_b < 0 and not (tied_a and tied_b)
+            if not crossed:
+                continue
+            contested |= {a, b}
+            if axis == 'p' and b[2] / a[2] >= min_p_ratio:
+                point = (a[0], a[1], float(np.sqrt(a[2] * b[2])))
+            elif axis == 'alpha' and b[1] - a[1] >= min_alpha_step:
+                point = (a[0], (a[1] + b[1]) / 2, a[2])
+            else:
+                continue
+            shots = min(max(shots for shots, _, _ in fits[end].values()) for end in (a, b))
+            if point not in fits:
+                new_points[point] = max(new_points.get(point, 0), shots)
+
+    return new_points, contested
+
+
+def curve_crossovers(stats : list[sinter.TaskStats], likelihood_factor : float = 1000) -> list[dict]:
+    ''' Crossing points in p of every pair of curves at fixed experiment and
+    alpha, and of every curve with the physical error rate (pseudo-thresholds,
+    with 'p' in place of the second curve), interpolated linearly in log-log
+    between the neighbouring points at which their best estimates change
+    order.'''
+
+    fits = _fits(stats, likelihood_factor)
+    lines = {}
+    for (experiment, alpha, p), curves in fits.items():
+        lines.setdefault((experiment, alpha), []).append((p, {curve : fit.best for curve, (_, _, fit) in curves.items()}))
+
+    crossovers = []
+    for (experiment, alpha), points in sorted(lines.items()):
+        points.sort(key = lambda point : point[0])
+        names = sorted({curve for _, curves in points for curve in curves})
+        pairs = [(a, 'p') for a in names] + [(a, b) for k, a in enumerate(names) for b in names[k + 1:]]
+        for a, b in pairs:
+            # log ratio of the two curves at every point where both have errors:
+            xs, ys = [], []
+            for p, curves in points:
+                y = curves.get(a, 0)
+                z = p if b == 'p' else curves.get(b, 0)
+                if y > 0 and z > 0:
+                    xs.append(np.log(p))
+                    ys.append(np.log(y / z))
+            for k in range(len(xs) - 1):
+                if ys[k] * ys[k + 1] < 0:
+                    x = xs[k] + (xs[k + 1] - xs[k]) * ys[k] / (ys[k] - ys[k + 1])
+                    crossovers.append({'experiment' : experiment, 'alpha' : alpha, 'curves' : (a, b), 'p' : float(np.exp(x))})
+    return crossovers
+
+
+def run_adaptive_sweep(
+        embeddings,
+        alphas,
+        ps,
+        experiments,
+        shape,
+        row_checks,
+        col_checks,
+        rounds : int = 3,
+        ind_obs = False,
+        decoders = ('bposd',),
+        initial_shots : int = 10000,
+        max_shots : int = 500000,
+        max_errors : int = 500,
+        precision : float = 0.2,
+        coarse_precision : float = 0.5,
+        min_p_ratio : float = 1.1,
+        min_alpha_step : float = 0.1,
+        max_passes : int = 20,
+        likelihood_factor : float = 1000,
+        num_workers : int | None = None,
+        resume_file : str = 'adaptive_sweep.csv',
+        cache_dir : str = '.circuit_cache',
+        print_progress : bool = False,
+        linear_dems : bool = False,
+        build_hook = None,
+        chunk_size : int = 64,
+) -> list[sinter.TaskStats]:
+    ''' run_sweep() on a coarse grid of alphas and ps that is refined where it
+    matters.
+
+    Every pass samples the active points of the sweep with sinter, then adds
+    the points from refine_points(): between neighbouring points across which
+    curves of different embeddings (or a curve and p) cross or stop
+    overlapping. A point stays active until every task at it reached
+    max_shots or max_errors, or until the relative width (high - low) / best
+    of its confidence interval (sinter.fit_binomial() with
+    likelihood_factor) is below precision at contested points and below
+    coarse_precision elsewhere. The shots of an active task double every pass,
+    starting from initial_shots, or from the shots of the less sampled
+    neighbour for points added by refine_points().
+
+    Every pass samples chunk_size tasks at a time (see collect_in_chunks()).
+    Statistics accumulate in resume_file, so an interrupted sweep continues
+    where it stopped. Returns all statistics in it, to be passed to
+    curve_crossovers() or plotted like the ones of run_sweep().'''
+
+    # shots to start every point with:
+    points = {(experiment, float(alpha), float(p)) : initial_shots
+              for experiment in experiments for alpha in alphas for p in ps}
+    custom_decoders = {name : CUSTOM_DECODERS[name]() for name in decoders}
+    cache = CircuitCache(cache_dir, build_hook = build_hook)
+
+    stats = []
+    if os.path.exists(resume_file):
+        stats = sinter.read_stats_from_csv_files(resume_file)
+        points |= dict.fromkeys(_fits(stats, likelihood_factor), initial_shots)
+
+    for _ in range(max_passes):
+        fits = _fits(stats, likelihood_factor)
+        new_points, contested = refine_points(stats, min_p_ratio, min_alpha_step, likelihood_factor)
+        points |= {point : max(shots, initial_shots) for point, shots in new_points.items() if point not in points}
+
+        def options(decoder, json_metadata):
+            point = (json_metadata['experiment'], json_metadata['alpha'], json_metadata['p'])
+            if point not in points:
+                return None
+            shots, errors, fit = fits.get(point, {}).get((json_metadata['crossing'], decoder), (0, 0, None))
+            if shots >= max_shots or errors >= max_errors:
+                return None
+            target = precision if point in contested else coarse_precision
+            if fit is not None and fit.best > 0 and (fit.high - fit.low) / fit.best <= target:
+                return None
+            return sinter.CollectionOptions(max_shots = min(max(2 * shots, points[point]), max_shots),
+                                            max_errors = max_errors)
+
+        tasks = generate_tasks(
+            embeddings = embeddings,
+            alphas = sorted({point[1] for point in points}),
+            ps = sorted({point[2] for point in points}),
+            experiments = experiments,
+            shape = shape,
+            row_checks = row_checks,
+            col_checks = col_checks,
+            rounds = rounds,
+            ind_obs = ind_obs,
+            decoders = decoders,
+            cache = cache,
+            linear_dems = linear_dems,
+            collection_options = options,
+        )
+        first = next(tasks, None)
+        if first is None:
+            break
+
+        try:
+            stats = collect_in_chunks(
+                itertools.chain([first], tasks),
+                chunk_size = chunk_size,
+                num_workers = num_workers or max(multiprocessing.cpu_count() - 1, 1),
+                custom_decoders = custom_decoders,
+                save_resume_filepath = resume_file,
+                print_progress = print_progress,
+            )
+        finally:
+            cache.unpin()
+
+    return stats
@@ -0,0 +1,100 @@
+import itertools
+import os
+
+import numpy as np
+import pytest
+
+import analytic
+from analytic import embedding_estimates, leading_order_estimate
+from circuit import circuit_builder
+from shot_store import compile_decoder, decode_bit_packed, sinter_detector_error_model
+from sweep import CUSTOM_DECODERS
+from test_circuit import embedding_B1, log_obs, rep_3_checks, rep_3_mod_checks
+
+
+def _structure(experiment : str) -> dict:
+    return dict(shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks, crossings = embedding_B1[1],
+                experiment = experiment, observable = log_obs['x' if experiment == 'x_memory' else 'z'], rounds = 3)
+
+
+def _dem(structure : dict, p : float, alpha : float):
+    return sinter_detector_error_model(circuit_builder(
+        **structure, after_clifford_depolarization = p, after_crossing_depolarization = alpha * p,
+        after_reset_flip_probability = p, before_measure_flip_probability = p))
+
+
+def _mechanisms(dem) -> list[tuple[float, set, set]]:
+    # (probability, detectors, observables) of every error instruction, components combined:
+    mechanisms = []
+    for instruction in dem.flattened():
+        if instruction.type != 'error':
+            continue
+        detectors, observables = set(), set()
+        for target in instruction.targets_copy():
+            if target.is_relative_detector_id():
+                detectors ^= {target.val}
+            elif target.is_logical_observable_id():
+                observables ^= {target.val}
+        mechanisms.append((instruction.args_copy()[0], detectors, observables))
+    return mechanisms
+
+
+def _brute_force(structure : dict, w : int, alpha : float, p : float = 1e-7) -> float:
+    # sum over the failing sets of w mechanisms of the circuit's own detector error model of
+    # their probability, divided by p^w, with the decoder leading_order_estimate() uses:
+    reference = _dem(structure, 1e-3, 1.0)
+    decoder = CUSTOM_DECODERS['batch_bposd']()
+    compiled = compile_decoder(decoder, reference)
+    mechanisms = _mechanisms(_dem(structure, p, alpha))
+
+    sets = list(itertools.combinations(mechanisms, w))
+    syndromes = np.zeros((len(sets), reference.num_detectors), dtype = np.uint8)
+    flips = np.zeros((len(sets), reference.num_observables), dtype = np.uint8)
+    for row, faults in enumerate(sets):
+        for _, detectors, observables in faults:
+            syndromes[row, list(detectors)] ^= 1
+            flips[row, list(observables)] ^= 1
+    predictions = decode_bit_packed(decoder, compiled, reference, np.packbits(syndromes, axis = 1, bitorder = 'little'))
+    failed = np.any(predictions != np.packbits(flips, axis = 1, bitorder = 'little'), axis = 1)
+    return sum(np.prod([q for q, _, _ in faults]) for faults, fail in zip(sets, failed) if fail) / p**w
+
+
+@pytest.mark.parametrize('experiment, order', [('z_memory', 1), ('x_memory', 2)])
+def test_against_brute_force(experiment, order):
+    structure = _structure(experiment)
+    estimate = leading_order_estimate(**structure)
+    assert estimate.order == order
+    assert len(estimate.coefficients) == order + 1
+
+    # no set of fewer faults fails:
+    for w in range(1, order):
+        assert _brute_force(structure, w, alpha = 1.0) == 0
+    for alpha in [0.5, 1.0, 3.0]:
+        expected = _brute_force(structure, order, alpha)
+        assert expected > 0
+        assert np.isclose(estimate.rate(1.0, alpha), expected, rtol = 1e-4)
+
+
+def test_too_many_sets():
+    structure = _structure('x_memory')
+    with pytest.raises(ValueError, match = 'max_sets'):
+        leading_order_estimate(max_sets = 1000, **structure)
+    assert leading_order_estimate(max_faults = 1, max_sets = 1000, **structure).order is None
+
+
+def test_cached_estimates(tmp_path, monkeypatch):
+    cases = {experiment : _structure(experiment) for experiment in ['z_memory', 'x_memory']}
+    estimates = embedding_estimates(cases, max_workers = 2, cache_dir = str(tmp_path))
+    assert {name : estimate.order for name, estimate in estimates.items()} == {'z_memory' : 1, 'x_memory' : 2}
+    assert len(os.listdir(tmp_path)) == 2
+
+    # cached estimates are read back as they were computed:
+    cached = embedding_estimates(cases, max_workers = 1, cache_dir = str(tmp_path))
+    assert {name : estimate.as_dict() for name, estimate in cached.items()} == \
+           {name : estimate.as_dict() for name, estimate in estimates.items()}
+    assert len(os.listdir(tmp_path)) == 2
+
+    # and computed again under another RESULT_VERSION:
+    monkeypatch.setattr(analytic, 'RESULT_VERSION', analytic.RESULT_VERSION + 1)
+    embedding_estimates(cases, max_workers = 1, cache_dir = str(tmp_path))
+    assert len(os.listdir(tmp_path)) == 4
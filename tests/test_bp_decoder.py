@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from ldpc.bposd_decoder import BpOsdDecoder
+from ldpc.ckt_noise.dem_matrices import detector_error_model_to_check_matrices
+from ldpc.sinter_decoders import SinterBpOsdDecoder
+
+from bp_decoder import BatchBpOsd, BatchBpOsdDecoder
+from circuit import circuit_builder
+from crossings_27_4_3 import A1_log_obs, embedding_A1, hamming_A1, rep3_checks
+from shot_store import compile_decoder, decode_bit_packed
+
+SETTINGS = dict(max_iter = 0, ms_scaling_factor = 0.625, osd_method = 'osd0', osd_order = 0)
+
+
+def _circuit(p : float, experiment : str = 'z_memory'):
+    # the [[27, 4, 3]] hypergraph product code in its A1 embedding
+    return circuit_builder(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                           crossings = embedding_A1[1], experiment = experiment,
+                           observable = A1_log_obs['x' if experiment == 'x_memory' else 'z'], rounds = 3,
+                           after_clifford_depolarization = p, after_crossing_depolarization = p,
+                           after_reset_flip_probability = p, before_measure_flip_probability = p)
+
+
+@pytest.mark.parametrize('p', [1e-3, 1e-2])
+def test_same_errors_as_bposd(p):
+    # at p = 1e-2, BP does not converge on a good fraction of the shots, so OSD is covered too
+    circuit = _circuit(p)
+    matrices = detector_error_model_to_check_matrices(circuit.detector_error_model(), allow_undecomposed_hyperedges = True)
+    syndromes = circuit.compile_detector_sampler(seed = 1).sample(500).astype(np.uint8)
+
+    reference = BpOsdDecoder(matrices.check_matrix, error_channel = list(matrices.priors), bp_method = 'ms',
+                             schedule = 'parallel', **SETTINGS)
+    expected = np.array([reference.decode(syndrome) for syndrome in syndromes])
+    errors = BatchBpOsd(matrices.check_matrix, matrices.priors, **SETTINGS).decode(syndromes)
+    assert np.array_equal(errors, expected)
+
+
+@pytest.mark.parametrize('experiment', ['z_memory', 'x_memory'])
+def test_same_predictions_as_sinter_bposd(experiment):
+    circuit = _circuit(3e-3, experiment)
+    dem = circuit.detector_error_model()
+    packed = circuit.compile_detector_sampler(seed = 2).sample(2000, bit_packed = True)
+
+    predictions = []
+    for decoder in [SinterBpOsdDecoder(**SETTINGS), BatchBpOsdDecoder(**SETTINGS)]:
+        predictions.append(decode_bit_packed(decoder, compile_decoder(decoder, dem), dem, packed))
+    assert np.array_equal(*predictions)
+
+
+def test_checks_with_one_edge():
+    # e.g. the checks of a sliding window that only one undecided mechanism still reaches
+    rng = np.random.default_rng(3)
+    H = (rng.random((12, 30)) < 0.15).astype(np.uint8)
+    H[:4] = 0
+    H[np.arange(4), rng.choice(30, 4, replace = False)] = 1
+    priors = rng.uniform(0.01, 0.1, 30)
+    syndromes = (H @ (rng.random((300, 30)) < priors).T.astype(np.uint8) % 2).T
+
+    reference = BpOsdDecoder(H, error_channel = list(priors), bp_method = 'ms', schedule = 'parallel', **SETTINGS)
+    expected = np.array([reference.decode(syndrome) for syndrome in syndromes])
+    with np.errstate(invalid = 'raise'):
+        errors = BatchBpOsd(H, priors, **SETTINGS).decode(syndromes)
+    assert np.array_equal(errors, expected)
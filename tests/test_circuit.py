@@ -0,0 +1,311 @@
+import re
+
+import numpy as np
+import pytest
+import stim
+
+import baseline_circuit
+from circuit import (CROSSING, NOISE_CHANNELS, BuildStatsCollector, CircuitTemplate, Layout, build_circuits_parallel,
+                     circuit_builder, circuit_program, enumerate_gates, group_noise, instruction_counts, schedule_layers)
+from crossings_27_4_3 import *
+
+#------------------------------------------------------------------------------
+# cases
+#------------------------------------------------------------------------------
+
+# the [[13, 1, 2]] code and its embeddings, from experiments_13_1_2.ipynb
+rep_3_checks = [(1, 0), (1, 2), (3, 2), (3, 4)]
+rep_3_mod_checks = [(1, 0), (1, 2), (1, 4), (3, 2), (3, 4)]
+log_obs = {'z' : [2], 'x' : [[(0, 2), (0, 4)]]}
+
+embedding_B1 = [r'$B_1$', [[(0, 1), (0, 4), 2], [(1, 4), (1, 1), 2], [(2, 1), (2, 4), 2], [(3, 4), (3, 1), 2],
+                           [(1, 2), (0, 2), 1], [(0, 3), (1, 3), 1], [(1, 2), (2, 2), 1], [(2, 3), (1, 3), 1],
+                           [(3, 2), (2, 2), 1], [(2, 3), (3, 3), 1], [(3, 2), (4, 2), 1], [(4, 3), (3, 3), 1]]]
+embedding_B2 = [r'$B_2$', [[(1, 4), (1, 1), 4], [(2, 1), (2, 4), 1], [(3, 4), (3, 1), 3], [(0, 1), (0, 0), 1],
+                           [(1, 0), (0, 0), 1], [(2, 1), (2, 0), 1], [(3, 0), (2, 0), 3], [(3, 0), (4, 0), 1],
+                           [(4, 1), (4, 0), 1]]]
+embedding_B3 = [r'$B_3$', [[(1, 4), (1, 1), 1], [(2, 1), (2, 4), 1], [(3, 4), (3, 1), 1], [(1, 0), (2, 0), 1],
+                           [(3, 0), (2, 0), 1], [(4, 1), (4, 0), 1]]]
+
+NOISE = dict(
+    after_clifford_depolarization = 0.001,
+    after_crossing_depolarization = 0.01,
+    after_reset_flip_probability = 0.002,
+    before_measure_flip_probability = 0.003,
+)
+
+
+def _cases():
+    for experiment in ['z_memory', 'x_memory']:
+        basis = 'x' if experiment == 'x_memory' else 'z'
+        for embedding in [embedding_B1, embedding_B2, embedding_B3]:
+            yield embedding[0] + experiment, dict(
+                shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks, crossings = embedding[1],
+                experiment = experiment, observable = log_obs[basis], rounds = 3, **NOISE)
+        for name, embedding in [('A0', mapped_embedding_A0), ('A1', embedding_A1), ('A2', mapped_embedding_A2),
+                                ('A3', mapped_embedding_A3)]:
+            yield name + experiment, dict(
+                shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks, crossings = embedding[1],
+                experiment = experiment, observable = A1_log_obs[basis], rounds = 3, **NOISE)
+
+
+CASES = dict(_cases())
+
+
+def _without_coordinates(text : str) -> str:
+    # the baseline detectors carry no coordinates and the rounds no SHIFT_COORDS:
+    lines = [line for line in text.splitlines() if not line.strip().startswith('SHIFT_COORDS')]
+    return re.sub(r'DETECTOR\([^)]*\)', 'DETECTOR', '\n'.join(lines))
+
+
+def _exact_circuit(**params) -> stim.Circuit:
+    # from the exact program text: str(stim.Circuit) rounds the probabilities
+    return stim.Circuit(_without_coordinates(circuit_program(**params)))
+
+
+#------------------------------------------------------------------------------
+# tests
+#------------------------------------------------------------------------------
+
+@pytest.mark.parametrize('name', CASES)
+def test_same_circuits_as_baseline(name):
+    # the baseline repeats DEPOLARIZE2 Cr times on crossed gates:
+    params = CASES[name]
+    assert _exact_circuit(**params, compose_crossings = False) == baseline_circuit.circuit_builder(**params)
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_uncrossed_gates_as_baseline(name):
+    # composing crossings leaves gates with Cr = 1 at exactly p * 15/16:
+    params = dict(CASES[name], crossings = [])
+    assert _exact_circuit(**params) == baseline_circuit.circuit_builder(**params)
+
+    single = dict(CASES[name], crossings = [[*crossing[:2], 1] for crossing in CASES[name]['crossings']])
+    assert _exact_circuit(**single) == baseline_circuit.circuit_builder(**single)
+
+
+@pytest.mark.parametrize('name', [name for name in CASES if name.startswith('A')])
+def test_composed_crossings_same_noise(name):
+    # one composed DEPOLARIZE2 per crossed gate, or Cr of them, give the same mechanisms:
+    params = CASES[name]
+    composed = circuit_builder(**params, compose_crossings = True).detector_error_model()
+    repeated = circuit_builder(**params, compose_crossings = False).detector_error_model()
+    assert composed.approx_equals(repeated, atol = 1e-12)
+
+
+@pytest.mark.parametrize('executor', ['thread', 'process'])
+def test_parallel_builds_match_serial(executor):
+    grid = [dict(params, rounds = rounds) for params in CASES.values() for rounds in (1, 3)]
+    built = list(build_circuits_parallel(grid, max_workers = 4, executor = executor))
+    assert len(built) == len(grid)
+    for params, circuit in built:
+        serial = circuit_builder(**params)
+        assert circuit == serial and str(circuit) == str(serial)
+
+
+def test_parallel_builds_are_bounded():
+    # the grid is read as builds are yielded, at most 2 * max_workers ahead:
+    pulled = []
+
+    def grid():
+        for k in range(20):
+            pulled.append(k)
+            yield dict(CASES['$B_1$z_memory'], rounds = 1 + k % 3)
+
+    yielded = 0
+    for _ in build_circuits_parallel(grid(), max_workers = 2):
+        yielded += 1
+        assert len(pulled) - yielded < 4
+    assert yielded == len(pulled) == 20
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_layers_are_valid(name):
+    params = CASES[name]
+    layout = Layout(params['shape'], params['row_checks'], params['col_checks'])
+    x_gates, z_gates, _, _ = enumerate_gates(layout, params['row_checks'], params['col_checks'], params['crossings'])
+    for gates in (x_gates, z_gates):
+        layers = schedule_layers(gates)
+        degrees = {}
+        for gate in gates:
+            for qubit in gate[0]:
+                degrees[qubit] = degrees.get(qubit, 0) + 1
+        assert len(layers) == max(degrees.values())
+        for layer in layers:
+            qubits = [qubit for gate in layer for qubit in gate[0]]
+            assert len(qubits) == len(set(qubits))
+        # every gate once, in input order within its layer:
+        assert sorted(map(str, sum(layers, []))) == sorted(map(str, gates))
+        for layer in layers:
+            positions = [gates.index(gate) for gate in layer]
+            assert positions == sorted(positions)
+
+
+@pytest.mark.parametrize('name', CASES)
+def test_layered_same_dem(name):
+    # the gates of the X-check (Z-check) block commute, so noise before and
+    # after the blocks propagates the same in both schedules; faults between
+    # the gates of a block propagate to the gates after them (hook errors),
+    # which depend on the order, so gate noise is switched off:
+    params = dict(CASES[name], after_clifford_depolarization = 0, after_crossing_depolarization = 0)
+    sorted_dem = circuit_builder(**params).detector_error_model()
+    layered_dem = circuit_builder(**params, schedule = 'layered').detector_error_model()
+    assert layered_dem.approx_equals(sorted_dem, atol = 1e-15)
+
+
+#------------------------------------------------------------------------------
+# per-gate and per-qubit noise
+#------------------------------------------------------------------------------
+
+def _template(name, **options):
+    structure = {key : value for key, value in CASES[name].items() if key not in NOISE}
+    return CircuitTemplate.from_layout(**structure, **options)
+
+
+def _noise_around_measurements(circuit : stim.Circuit) -> tuple[dict, dict, int]:
+    # error probability per qubit just before and just after the MR of every round,
+    # and the number of error instructions there:
+    before, after, instructions = {}, {}, 0
+    operations = list(circuit.flattened())
+    for k, operation in enumerate(operations):
+        if operation.name not in ('MR', 'MRX'):
+            continue
+        for side, step in [(before, -1), (after, 1)]:
+            j = k + step
+            while operations[j].name in ('X_ERROR', 'Z_ERROR'):
+                for target in operations[j].targets_copy():
+                    assert side.setdefault(target.value, operations[j].gate_args_copy()[0]) == operations[j].gate_args_copy()[0]
+                instructions += 1
+                j += step
+    return before, after, instructions
+
+
+def test_group_noise():
+    assert group_noise([4, 5, 6], 0.1) == [(0.1, [4, 5, 6])]
+    assert group_noise([4, 5, 6], [0.1, 0.2, 0.1]) == [(0.1, [4, 6]), (0.2, [5])]
+    # groups in the order of their first target, pairs kept together:
+    assert group_noise([0, 1, 2, 3, 4, 5, 6, 7], [0.3, 0.1, 0.3, 0.1], width = 2) == [(0.3, [0, 1, 4, 5]), (0.1, [2, 3, 6, 7])]
+
+
+@pytest.mark.parametrize('schedule', ['sorted', 'layered'])
+@pytest.mark.parametrize('name', ['$B_2$z_memory', 'A1x_memory'])
+def test_uniform_arrays_as_scalars(name, schedule):
+    template = _template(name, schedule = schedule)
+    arrays = dict(
+        gate_noise = [NOISE['after_crossing_depolarization'] if gate[1] is CROSSING else NOISE['after_clifford_depolarization']
+                      for gate in template.gates],
+        reset_noise = np.full(template.num_qubits, NOISE['after_reset_flip_probability']),
+        measure_noise = np.full(template.num_qubits, NOISE['before_measure_flip_probability']),
+    )
+    assert template.program(**NOISE, **arrays) == template.program(**NOISE)
+
+    # the Hadamards take after_clifford_depolarization, which defaults to 0:
+    without_hadamard_noise = '\n'.join(line for line in template.program(**NOISE).splitlines()
+                                       if not line.startswith('DEPOLARIZE1'))
+    assert template.program(**arrays) == without_hadamard_noise
+
+
+@pytest.mark.parametrize('name', ['$B_1$z_memory', 'A1z_memory', 'A2x_memory'])
+def test_arrays_land_on_their_gates_and_qubits(name):
+    template = _template(name)
+    gate_noise = 1e-4 * np.arange(1, len(template.gates) + 1)
+    reset_noise = 1e-5 * np.arange(1, template.num_qubits + 1)
+    measure_noise = 2e-5 * np.arange(1, template.num_qubits + 1)
+    circuit = template.instantiate(gate_noise = gate_noise, reset_noise = reset_noise, measure_noise = measure_noise)
+    circuit.detector_error_model()
+
+    # the sorted schedule puts one DEPOLARIZE2 (composed if crossed) right after every CNOT:
+    expected = {}
+    for (pair, _, Cr), p in zip(template.gates, gate_noise.tolist()):
+        expected[tuple(pair)] = pytest.approx(-np.expm1(Cr * np.log1p(-p)) * 15/16, rel = 1e-12)
+    found = {}
+    for operation in circuit.flattened():
+        if operation.name == 'DEPOLARIZE2':
+            targets = [target.value for target in operation.targets_copy()]
+            assert len(targets) == 2
+            assert found.setdefault(tuple(targets), operation.gate_args_copy()[0]) == operation.gate_args_copy()[0]
+    assert found == expected
+
+    before, after, _ = _noise_around_measurements(circuit)
+    params = CASES[name]
+    layout = Layout(params['shape'], params['row_checks'], params['col_checks'])
+    checks = [*layout.x_checks.values(), *layout.z_checks.values()]
+    assert before == {q : measure_noise[q] for q in checks}
+    assert after == {q : reset_noise[q] for q in checks}
+
+
+def test_equal_strengths_share_an_instruction():
+    template = _template('A1z_memory', schedule = 'layered')
+    qubits = np.arange(template.num_qubits)
+    two_values = dict(
+        gate_noise = np.where(np.arange(len(template.gates)) % 2, 1e-3, 2e-3),
+        reset_noise = np.where(qubits % 2, 1e-3, 2e-3),
+        measure_noise = np.where(qubits % 2, 3e-3, 4e-3),
+    )
+    circuit = template.instantiate(**two_values)
+    scalar = template.instantiate(after_crossing_depolarization = 1e-3, after_clifford_depolarization = 1e-3,
+                                  after_reset_flip_probability = 1e-3, before_measure_flip_probability = 1e-3)
+
+    # every scalar instruction splits into at most one per distinct strength:
+    def count(circuit, name):
+        return sum(operation.name == name for operation in circuit.flattened())
+    assert count(scalar, 'DEPOLARIZE2') < count(circuit, 'DEPOLARIZE2') <= 2 * count(scalar, 'DEPOLARIZE2')
+    rounds = count(circuit, 'MR')
+    assert _noise_around_measurements(circuit)[2] == 4 * rounds
+    assert _noise_around_measurements(scalar)[2] == 2 * rounds
+
+
+#------------------------------------------------------------------------------
+# build statistics
+#------------------------------------------------------------------------------
+
+def test_instruction_counts():
+    program = 'R 0 1\nX_ERROR(0.1) 0\nREPEAT 3 {\n    CNOT 0 1\n    REPEAT 2 {\n        DEPOLARIZE1(0.1) 0\n    }\n}\nM 0'
+    assert instruction_counts(program) == {'R' : 1, 'X_ERROR' : 1, 'CNOT' : 3, 'DEPOLARIZE1' : 6, 'M' : 1}
+
+
+@pytest.mark.parametrize('compose_crossings', [True, False])
+@pytest.mark.parametrize('name', ['$B_1$z_memory', '$B_2$x_memory', 'A1z_memory', 'A3x_memory'])
+def test_build_stats(name, compose_crossings):
+    params = CASES[name]
+    collector = BuildStatsCollector()
+    circuit = circuit_builder(**params, compose_crossings = compose_crossings, stats_hook = collector)
+    (stats,) = collector.builds
+    assert set(stats.times) == {'layout', 'gate_enumeration', 'sort', 'detectors', 'program', 'parse'}
+
+    # the counts against the baseline circuit (Cr DEPOLARIZE2 per crossed gate) and the circuit itself:
+    baseline = baseline_circuit.circuit_builder(**params)
+    operations = [operation.name for operation in circuit.flattened()]
+    crossed = {tuple(crossing[:2]) : crossing[2] for crossing in params['crossings']}
+    assert stats.counts['cnots'] * params['rounds'] == sum(len(instruction.targets_copy()) // 2
+                                                           for instruction in baseline.flattened() if instruction.name == 'CX')
+    # every crossing entry hits a gate, which gets crossing noise (also with Cr = 1):
+    assert stats.counts['matched_crossings'] == stats.counts['crossed_cnots'] == len(crossed)
+    assert stats.counts['unmatched_crossings'] == 0
+    assert stats.counts['detectors'] == circuit.num_detectors == baseline.num_detectors
+    # one DEPOLARIZE2 per gate, or Cr per crossed gate uncomposed (which stim fuses when parsing):
+    repeats = 0 if compose_crossings else sum(Cr - 1 for Cr in crossed.values())
+    assert stats.counts['depolarize2_instructions'] == (stats.counts['cnots'] + repeats) * params['rounds']
+    assert stats.counts['depolarize2_instructions'] == instruction_counts(
+        circuit_program(**params, compose_crossings = compose_crossings))['DEPOLARIZE2']
+    assert operations.count('DEPOLARIZE2') == stats.counts['cnots'] * params['rounds']
+    assert stats.counts['noise_channels'] == repeats * params['rounds'] + sum(name in NOISE_CHANNELS for name in operations)
+
+    summary = collector.summary()
+    assert summary['builds'] == 1 and summary['counts'] == stats.counts and summary['unmatched'] == []
+
+
+def test_unmatched_crossings():
+    # two data qubits never share a gate, so these entries cannot match:
+    params = CASES['$B_1$z_memory']
+    stray = [[(0, 0), (4, 4), 3], [(2, 2), (0, 4), 2]]
+    collector = BuildStatsCollector()
+    circuit = circuit_builder(**dict(params, crossings = params['crossings'] + stray), stats_hook = collector)
+    assert circuit == circuit_builder(**params)
+
+    (stats,) = collector.builds
+    assert stats.unmatched == [((0, 0), (4, 4)), ((2, 2), (0, 4))]
+    assert stats.counts['unmatched_crossings'] == 2
+    assert stats.counts['matched_crossings'] == len(params['crossings'])
+    assert collector.summary()['unmatched'] == [stats]
+    assert stats.as_dict()['unmatched'] == [[[0, 0], [4, 4]], [[2, 2], [0, 4]]]
@@ -0,0 +1,129 @@
+import os
+
+import numpy as np
+import stim
+
+from circuit import circuit_builder
+from circuit_cache import CircuitCache, circuit_key
+from crossings_27_4_3 import A0_log_obs, embedding_A0, hamming_A0, rep3_checks
+from embedding import Embedding
+from sweep import generate_tasks
+
+STRUCTURE = dict(shape = (5, 10), row_checks = hamming_A0, col_checks = rep3_checks, crossings = embedding_A0[1],
+                 observable = A0_log_obs['z'], rounds = 2)
+NOISE = dict(
+    after_clifford_depolarization = 0.001,
+    after_crossing_depolarization = 0.01,
+    after_reset_flip_probability = 0.002,
+    before_measure_flip_probability = 0.003,
+)
+
+
+def test_key():
+    key = circuit_key(**STRUCTURE, **NOISE)
+    # defaults are filled in, tuples hash like lists and numpy scalars like floats:
+    assert circuit_key(**STRUCTURE, **NOISE, experiment = 'z_memory') == key
+    assert circuit_key(**(STRUCTURE | {'shape' : [5, 10]}), **NOISE) == key
+    assert circuit_key(**STRUCTURE, **(NOISE | {'after_clifford_depolarization' : np.float64(0.001)})) == key
+    assert circuit_key(**(STRUCTURE | {'crossings' : Embedding.from_list(embedding_A0)}), **NOISE) == key
+    # instrumentation does not change the key:
+    assert circuit_key(**STRUCTURE, **NOISE, stats_hook = print) == key
+    # floats are hashed exactly:
+    assert circuit_key(**STRUCTURE, **(NOISE | {'after_clifford_depolarization' : np.nextafter(0.001, 1)})) != key
+    assert circuit_key(**STRUCTURE, **NOISE, experiment = 'x_memory') != key
+
+
+def test_round_trip(tmp_path):
+    params = STRUCTURE | NOISE
+    cache = CircuitCache(str(tmp_path))
+    circuit = cache.circuit(**params)
+    assert circuit == circuit_builder(**params)
+    assert cache.detector_error_model(**params) == circuit.detector_error_model()
+    assert (cache.detector_error_model(decompose_errors = True, **params)
+            == circuit.detector_error_model(decompose_errors = True))
+    assert sorted(os.listdir(tmp_path)) == sorted(circuit_key(**params) + suffix
+                                                  for suffix in ['.stim', '.dem', '.decomposed.dem'])
+
+    # a fresh cache (no memo) reads the files back exactly:
+    built = []
+    cache = CircuitCache(str(tmp_path), build_hook = built.append)
+    assert cache.circuit(**params) == circuit
+    assert stim.Circuit.from_file(cache.circuit_path(**params)) == circuit
+    assert cache.detector_error_model(**params) == circuit.detector_error_model()
+    assert not built
+
+
+def test_eviction(tmp_path):
+    # files of other caches sharing the directory:
+    others = ['shots.npy', '0' * 64 + '.distance.json', '0' * 64 + '.analytic.json']
+    for name in others:
+        (tmp_path / name).write_text('x' * 100000)
+
+    cache = CircuitCache(str(tmp_path))
+    params = [STRUCTURE | NOISE | {'after_clifford_depolarization' : p} for p in [0.001, 0.002, 0.003]]
+    paths = [cache.circuit_path(**p) for p in params[:2]]
+    # room for two and a half circuits:
+    cache.max_bytes = int(1.25 * cache.total_bytes)
+    assert all(os.path.exists(path) for path in paths)
+    assert cache.total_bytes == sum(os.path.getsize(path) for path in paths)
+
+    # touching the first circuit makes the second the least recently used:
+    os.utime(paths[0], (0, 1))
+    os.utime(paths[1], (0, 0))
+    paths.append(cache.circuit_path(**params[2]))
+    assert [os.path.exists(path) for path in paths] == [True, False, True]
+    assert cache.total_bytes == sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    assert all(os.path.exists(tmp_path / name) for name in others)
+
+    cache.clear()
+    assert sorted(os.listdir(tmp_path)) == sorted(others)
+    assert cache.total_bytes == 0
+
+
+def test_eviction_keeps_new_and_pinned_files(tmp_path):
+    cache = CircuitCache(str(tmp_path))
+    params = [STRUCTURE | NOISE | {'after_clifford_depolarization' : p} for p in [0.001, 0.002, 0.003, 0.004]]
+    pinned = cache.circuit_path(**params[0])
+    cache.pin(pinned)
+    old = cache.circuit_path(**params[1])
+    # every file alone is larger than the cache, and they all have the same age:
+    cache.max_bytes = os.path.getsize(pinned) // 2
+    for path in [pinned, old]:
+        os.utime(path, (0, 0))
+
+    new = cache.circuit_path(**params[2])
+    assert [os.path.exists(path) for path in [pinned, old, new]] == [True, False, True]
+    assert cache.total_bytes == os.path.getsize(pinned) + os.path.getsize(new)
+
+    cache.unpin()
+    os.utime(new, (0, 0))
+    newer = cache.circuit_path(**params[3])
+    assert [os.path.exists(path) for path in [pinned, new, newer]] == [False, False, True]
+    assert cache.total_bytes == os.path.getsize(newer)
+
+
+def test_memo_hits_count_as_use(tmp_path):
+    params = STRUCTURE | NOISE
+    cache = CircuitCache(str(tmp_path))
+    cache.circuit(**params)
+    path = tmp_path / (circuit_key(**params) + '.stim')
+    os.utime(path, (0, 0))
+    cache.circuit(**params)
+    assert os.path.getmtime(path) > 0
+
+
+def test_rewrite_is_counted_once(tmp_path):
+    cache = CircuitCache(str(tmp_path))
+    path = cache.circuit_path(**STRUCTURE, **NOISE)
+    size = cache.total_bytes
+    cache._write(path, open(path).read())
+    assert cache.total_bytes == size == os.path.getsize(path)
+
+
+def test_generated_tasks_are_pinned(tmp_path):
+    cache = CircuitCache(str(tmp_path))
+    tasks = list(generate_tasks(embeddings = [[embedding_A0, A0_log_obs]], alphas = [0, 1], ps = [0.001, 0.002],
+                                experiments = ['z_memory'], shape = (5, 10), row_checks = hamming_A0,
+                                col_checks = rep3_checks, rounds = 2, cache = cache))
+    assert cache.pinned == {str(task.circuit_path) for task in tasks}
+    assert len(cache.pinned) == 4
@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import crossings_27_4_3
+from bp_decoder import BatchBpOsdDecoder
+from code_capacity import CodeCapacity, logical_operators, parity_check_matrices
+from crossings_27_4_3 import rep3_checks
+from shot_store import compile_decoder, decode_bit_packed
+from test_circuit import log_obs, rep_3_checks, rep_3_mod_checks
+
+# (shape, row_checks, col_checks, logicals, number of logical qubits)
+CODES = {
+    name : ((5, 10), getattr(crossings_27_4_3, 'hamming_' + name), rep3_checks,
+            getattr(crossings_27_4_3, name + '_log_obs'), 4)
+    for name in ['A0', 'A1', 'A2', 'A3']
+}
+CODES['B'] = ((5, 5), rep_3_mod_checks, rep_3_checks, log_obs, 1)
+
+
+def _rank(matrix : np.ndarray) -> int:
+    # rank over GF(2)
+    matrix = matrix.copy() & 1
+    rank = 0
+    for column in range(matrix.shape[1]):
+        pivots = np.nonzero(matrix[rank:, column])[0]
+        if len(pivots) == 0:
+            continue
+        matrix[[rank, rank + pivots[0]]] = matrix[[rank + pivots[0], rank]]
+        rows = np.nonzero(matrix[:, column])[0]
+        matrix[rows[rows != rank]] ^= matrix[rank]
+        rank += 1
+        if rank == matrix.shape[0]:
+            break
+    return rank
+
+
+@pytest.mark.parametrize('name', CODES)
+def test_checks_and_logicals_commute(name):
+    shape, row_checks, col_checks, observables, k = CODES[name]
+    hx, hz = (h.toarray().astype(np.int64) for h in parity_check_matrices(shape, row_checks, col_checks))
+    lx, lz = (logical_operators(shape, row_checks, col_checks, observables[basis], experiment).toarray().astype(np.int64)
+              for basis, experiment in [('x', 'x_memory'), ('z', 'z_memory')])
+
+    assert not np.any(hx @ hz.T % 2)
+    assert not np.any(hx @ lz.T % 2)
+    assert not np.any(hz @ lx.T % 2)
+    # k independent logicals of each kind, outside the stabilizers, that pair up:
+    n = hx.shape[1]
+    assert n - _rank(hx) - _rank(hz) == k == len(lx) == len(lz)
+    assert _rank(np.vstack([hz, lz])) == _rank(hz) + k
+    assert _rank(np.vstack([hx, lx])) == _rank(hx) + k
+    assert _rank(lx @ lz.T) == k
+
+
+def test_sample_follows_the_detector_error_model():
+    shape, row_checks, col_checks, observables, _ = CODES['A1']
+    code = CodeCapacity.from_layout(shape, row_checks, col_checks, observables['z'])
+    dem = code.detector_error_model(p = 0.05, q = 0.02, rounds = 2)
+    assert dem.num_detectors == 3 * code.num_checks and dem.num_observables == 4
+
+    shots = 50000
+    detectors, flips = code.sample(0.05, shots, q = 0.02, rounds = 2, rng = np.random.default_rng(1), chunk_size = 3000)
+    expected_detectors, expected_flips, _ = dem.compile_sampler(seed = 1).sample(shots, bit_packed = True)
+    for sampled, expected in [(detectors, expected_detectors), (flips, expected_flips)]:
+        assert sampled.shape == expected.shape
+        ones, expected_ones = (np.unpackbits(bits, axis = 1, bitorder = 'little').mean(axis = 0)
+                               for bits in [sampled, expected])
+        assert np.allclose(ones, expected_ones, atol = 0.01)
+
+
+@pytest.mark.parametrize('q, rounds', [(0, 0), (0.01, 2)])
+def test_decode_rate(q, rounds):
+    shape, row_checks, col_checks, observables, _ = CODES['A1']
+    code = CodeCapacity.from_layout(shape, row_checks, col_checks, observables['z'])
+    assert code.simulate(p = 0, shots = 1000, q = 0, rounds = rounds)['errors'] == 0
+
+    # the same logical error rate as stim sampling its detector error model:
+    result = code.simulate(p = 0.03, q = q, rounds = rounds, shots = 20000, batch_size = 7000, seed = 2)
+    decoder = BatchBpOsdDecoder()
+    dem = code.detector_error_model(0.03, q, rounds)
+    detectors, flips, _ = dem.compile_sampler(seed = 2).sample(20000, bit_packed = True)
+    predictions = decode_bit_packed(decoder, compile_decoder(decoder, dem), dem, detectors)
+    expected = np.any(predictions != flips, axis = 1).mean()
+    sigma = np.sqrt(expected * (1 - expected) / 20000)
+    assert 0 < result['errors'] and result['shots'] == 20000
+    assert abs(result['rate'] - expected) < 5 * sigma
+
+    # and a higher one at higher p:
+    assert code.simulate(p = 0.08, q = q, rounds = rounds, shots = 20000, seed = 3)['rate'] > result['rate']
@@ -0,0 +1,82 @@
+import numpy as np
+import pytest
+
+import crossings_27_4_3
+from crossing_search import (CrossingState, compute_crossings, crossing_cost, embedding_for_layout, layout_checks,
+                             search_embeddings)
+from crossings_27_4_3 import hamming_A1, rep3_checks
+
+SHAPE = (5, 10)
+
+# the long-range arcs of the hand-made embeddings that run through the channel above their row,
+# keyed by the (check column, bit column) pairs of their own layouts:
+UP = {
+    'A0' : [(2, 0), (3, 0), (3, 5), (3, 9)],
+    'A1' : [(2, 4), (5, 1), (5, 7)],
+    'A2' : [(2, 0), (2, 5), (2, 6), (7, 9)],
+    'A3' : [(5, 3), (8, 3), (8, 2)],
+}
+MAPS = {'A0' : crossings_27_4_3.map_A0, 'A1' : np.arange(10), 'A2' : crossings_27_4_3.map_A2,
+        'A3' : crossings_27_4_3.map_A3}
+
+
+def _same_crossings(embedding, crossing_object) -> bool:
+    return sorted(map(str, embedding.crossings)) == sorted(map(str, crossing_object[1]))
+
+
+def _reference_directions(name : str) -> dict:
+    # UP moved back to the pairs of hamming_A1:
+    inverse = np.argsort(MAPS[name])
+    return {(int(inverse[c]), int(inverse[b])) : -1 for c, b in UP[name]}
+
+
+@pytest.mark.parametrize('name', ['A0', 'A1', 'A2', 'A3'])
+def test_hand_made_embeddings(name):
+    row_checks = getattr(crossings_27_4_3, 'hamming_' + name)
+    embedding = compute_crossings(SHAPE, row_checks, rep3_checks, dict.fromkeys(UP[name], -1), name)
+    assert _same_crossings(embedding, getattr(crossings_27_4_3, 'embedding_' + name))
+
+    # and from the A1 layout and the column map, like mapped_embedding_A0:
+    assert sorted(layout_checks(hamming_A1, MAPS[name])) == sorted(row_checks)
+    mapped = embedding_for_layout(SHAPE, hamming_A1, rep3_checks, MAPS[name], _reference_directions(name), name)
+    expected = crossings_27_4_3.embedding_A1 if name == 'A1' else getattr(crossings_27_4_3, 'mapped_embedding_' + name)
+    assert _same_crossings(mapped, expected)
+
+
+@pytest.mark.parametrize('weight', [None, lambda Cr: 1 - (1 - 2e-3)**Cr])
+@pytest.mark.parametrize('name', ['A1', 'A0'])
+def test_swaps_match_recount(name, weight):
+    directions = _reference_directions(name)
+    rng = np.random.default_rng(4)
+    state = CrossingState(SHAPE, hamming_A1, rep3_checks, rng.permutation(10), weight, directions)
+
+    def recount():
+        return crossing_cost(embedding_for_layout(SHAPE, hamming_A1, rep3_checks, state.map, directions), weight)
+
+    assert np.isclose(state.cost, recount())
+    for _ in range(200):
+        u, v = rng.choice(10, 2, replace = False)
+        cost = state.cost
+        delta = state.swap_delta(u, v)
+        state.swap(u, v)
+        assert np.isclose(state.cost, cost + delta)
+        assert np.isclose(state.cost, recount())
+
+
+def test_directions_must_be_signs():
+    with pytest.raises(ValueError):
+        compute_crossings(SHAPE, hamming_A1, rep3_checks, {(2, 4) : 0})
+    with pytest.raises(ValueError):
+        CrossingState(SHAPE, hamming_A1, rep3_checks, np.arange(10), directions = {(2, 4) : 2})
+
+
+def test_search():
+    results = search_embeddings(SHAPE, hamming_A1, rep3_checks, n_best = 3, steps = 3000, restarts = 2, seed = 5)
+    assert len(results) == 3
+    costs = [cost for cost, _ in results]
+    assert costs == sorted(costs)
+    for cost, map in results:
+        assert sorted(map.tolist()) == list(range(10))
+        assert cost == crossing_cost(embedding_for_layout(SHAPE, hamming_A1, rep3_checks, map))
+    # the annealing beats the hand-made A1 layout:
+    assert costs[0] <= crossing_cost(embedding_for_layout(SHAPE, hamming_A1, rep3_checks, MAPS['A1']))
@@ -0,0 +1,70 @@
+import functools
+import itertools
+import operator
+import os
+
+import pytest
+
+from circuit import circuit_builder
+from distance import DISTANCE_NOISE, embedding_distances, explain_error, logical_error_search
+from test_circuit import embedding_B1, log_obs, rep_3_checks, rep_3_mod_checks
+
+
+def _params(experiment : str) -> dict:
+    # the [[13, 1, 2]] code in its B1 embedding
+    return dict(shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks, crossings = embedding_B1[1],
+                experiment = experiment, observable = log_obs['x' if experiment == 'x_memory' else 'z'], rounds = 3)
+
+
+def _has_logical_error(circuit, w : int) -> bool:
+    # brute force: do w error mechanisms flip no detector but some observable?
+    mechanisms = []
+    for instruction in circuit.detector_error_model().flattened():
+        if instruction.type == 'error':
+            mechanisms.append(frozenset(str(target) for target in instruction.targets_copy()))
+    for faults in itertools.combinations(mechanisms, w):
+        targets = functools.reduce(operator.xor, faults)
+        if targets and all(target.startswith('L') for target in targets):
+            return True
+    return False
+
+
+@pytest.mark.parametrize('experiment, distance', [('z_memory', 2), ('x_memory', 3)])
+def test_distance(experiment, distance):
+    circuit = circuit_builder(**_params(experiment), **DISTANCE_NOISE)
+    result = logical_error_search(circuit, embedding_B1[1])
+    assert result['distance'] == len(result['faults']) == distance
+    assert not any(_has_logical_error(circuit, w) for w in range(1, distance))
+    assert _has_logical_error(circuit, distance)
+    assert logical_error_search(circuit, embedding_B1[1], graphlike = True)['distance'] >= distance
+
+    # nothing within too tight bounds:
+    assert logical_error_search(circuit, embedding_B1[1], max_detection_events = 1, max_edge_degree = 1) is None
+
+
+def test_fault_crossings():
+    circuit = circuit_builder(**_params('z_memory'), **DISTANCE_NOISE)
+    faults = explain_error(circuit.explain_detector_error_model_errors(), embedding_B1[1])
+    crossings = {frozenset(pair) : Cr for *pair, Cr in embedding_B1[1]}
+
+    kinds = set()
+    for fault in faults:
+        kinds.add((fault['gate'], fault['crossed']))
+        if fault['gate'] != 'DEPOLARIZE2':
+            # resets, measurements and single-qubit gates are not gate faults:
+            assert fault['Cr'] is None and not fault['crossed']
+        elif fault['crossed']:
+            assert fault['Cr'] == crossings[frozenset(fault['qubits'])]
+        else:
+            assert fault['Cr'] == 1
+    assert {('DEPOLARIZE2', True), ('DEPOLARIZE2', False)} < kinds
+
+
+def test_embedding_distances(tmp_path):
+    cases = {experiment : _params(experiment) for experiment in ['z_memory', 'x_memory']}
+    distances = embedding_distances(cases, max_workers = 2, cache_dir = str(tmp_path))
+    assert {name : result['distance'] for name, result in distances.items()} == {'z_memory' : 2, 'x_memory' : 3}
+    assert len(os.listdir(tmp_path)) == 2
+
+    # cached results are read back as they were computed:
+    assert embedding_distances(cases, max_workers = 1, cache_dir = str(tmp_path)) == distances
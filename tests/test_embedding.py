@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+import crossings_27_4_3
+from crossings_27_4_3 import crossing_mapper
+from embedding import Embedding
+
+EMBEDDINGS = {name : getattr(crossings_27_4_3, 'embedding_' + name) for name in ['A0', 'A1', 'A2', 'A3']}
+MAPS = {'A0' : crossings_27_4_3.map_A0, 'A1' : np.arange(10), 'A2' : crossings_27_4_3.map_A2,
+        'A3' : crossings_27_4_3.map_A3}
+
+
+def _original_crossing_mapper(crossing_object, map):
+    # crossing_mapper() before Embedding, one np.where per column:
+    og_map = np.array([0, 1, 2, 3, 4, 5, 6, 7, 8, 9])
+    remaped_corssings = [crossing_object[0], []]
+    for crossing in crossing_object[1]:
+        remaped_corssings[1].append([(crossing[0][0], og_map[np.where(map == crossing[0][1])[0][0]]),
+                                     (crossing[1][0], (og_map[np.where(map == crossing[1][1])[0][0]]) ), crossing[2]])
+    return remaped_corssings
+
+
+@pytest.mark.parametrize('name', EMBEDDINGS)
+def test_mapper_matches_original(name):
+    crossing_object = EMBEDDINGS[name]
+    expected = _original_crossing_mapper(crossing_object, MAPS[name])
+    assert crossing_mapper(crossing_object, MAPS[name]) == expected
+    assert crossing_mapper(Embedding.from_list(crossing_object), MAPS[name]) == Embedding.from_list(expected)
+    if name != 'A1':
+        assert getattr(crossings_27_4_3, 'mapped_embedding_' + name) == expected
+
+
+@pytest.mark.parametrize('suffix', ['.npz', '.json'])
+@pytest.mark.parametrize('name', EMBEDDINGS)
+def test_round_trip(tmp_path, name, suffix):
+    embedding = Embedding.from_list(EMBEDDINGS[name])
+    assert embedding.to_list() == EMBEDDINGS[name]
+    assert embedding.total() == sum(Cr for _, _, Cr in EMBEDDINGS[name][1])
+
+    path = str(tmp_path / (name + suffix))
+    embedding.save(path)
+    loaded = Embedding.load(path)
+    assert loaded == embedding
+    assert loaded.to_list() == EMBEDDINGS[name]
+    assert loaded.crossing_map() == embedding.crossing_map()
+
+
+def test_empty_and_invalid(tmp_path):
+    empty = Embedding.from_list(['none', []])
+    assert len(empty) == 0 and empty.total() == 0 and empty.to_list() == ['none', []]
+    for suffix in ['.npz', '.json']:
+        empty.save(str(tmp_path / ('none' + suffix)))
+        assert Embedding.load(str(tmp_path / ('none' + suffix))) == empty
+
+    with pytest.raises(ValueError):
+        Embedding('bad', [1, 2], [0, 0], [1, 1], [0, 1], [1])
+
+
+def test_npz_suffix(tmp_path):
+    # like np.savez, save() appends .npz to other paths, and load() reads them from the same path:
+    embedding = Embedding.from_list(EMBEDDINGS['A0'])
+    embedding.save(str(tmp_path / 'A0'))
+    assert os.listdir(tmp_path) == ['A0.npz']
+    assert Embedding.load(str(tmp_path / 'A0')) == embedding
+    assert Embedding.load(str(tmp_path / 'A0.npz')) == embedding
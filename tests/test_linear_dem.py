@@ -0,0 +1,24 @@
+import pytest
+
+from circuit import circuit_builder
+from crossings_27_4_3 import A0_log_obs, embedding_A0, hamming_A0, rep3_checks
+from linear_dem import LinearDEM
+from shot_store import sinter_detector_error_model
+
+NOISE = dict(
+    after_clifford_depolarization = 0.001,
+    after_crossing_depolarization = 0.01,
+    after_reset_flip_probability = 0.002,
+    before_measure_flip_probability = 0.003,
+)
+
+
+@pytest.mark.parametrize('experiment', ['z_memory', 'x_memory'])
+def test_same_dem_as_sinter(experiment):
+    # A0 x_memory does not decompose into graphlike errors, so sinter falls back:
+    structure = dict(shape = (5, 10), row_checks = hamming_A0, col_checks = rep3_checks, crossings = embedding_A0[1],
+                     experiment = experiment, observable = A0_log_obs['x' if experiment == 'x_memory' else 'z'],
+                     rounds = 3)
+    dem = LinearDEM.from_layout(decompose_errors = True, **structure).detector_error_model(**NOISE)
+    expected = sinter_detector_error_model(circuit_builder(**structure, **NOISE))
+    assert dem.approx_equals(expected.flattened(), atol = 1e-12)
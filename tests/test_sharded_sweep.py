@@ -0,0 +1,124 @@
+import os
+import shutil
+import time
+
+import sinter
+
+from crossings_27_4_3 import A0_log_obs, embedding_A0, embedding_A1, hamming_A0, rep3_checks
+from sharded_sweep import ShardQueue, make_shards, merge_shards, run_sharded_sweep, task_keys
+from test_circuit import embedding_B1, embedding_B2, log_obs, rep_3_checks, rep_3_mod_checks
+
+SWEEP = dict(embeddings = [[embedding_A0, A0_log_obs], [embedding_A1, A0_log_obs]], alphas = [0, 1], ps = [1e-3, 2e-3],
+             experiments = ['z_memory'], shape = (5, 10), row_checks = hamming_A0, col_checks = rep3_checks,
+             decoders = ('bposd', 'batch_bposd'))
+
+
+def test_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    keys = task_keys(**SWEEP)
+    assert len(keys) == len(set(keys)) == 2 * 2 * 2 * 2
+    # no circuit was built, and no cache directory created:
+    assert os.listdir(tmp_path) == []
+
+    shards = make_shards(keys, 3)
+    assert [len(shard) for shard in shards.values()] == [3, 3, 3, 3, 3, 1]
+    assert sum(shards.values(), []) == keys
+    assert make_shards(task_keys(**SWEEP), 3) == shards
+
+
+def test_claim_and_finish(tmp_path):
+    queue = ShardQueue(str(tmp_path))
+    queue.add_shards({'a' : ['1', '2'], 'b' : ['3']})
+    # queuing again keeps the shards and their state:
+    assert queue.claim('w1') == ('a', ['1', '2'])
+    queue.add_shards({'a' : ['1', '2'], 'b' : ['3']})
+    assert queue.status() == {'pending' : 1, 'running' : 1}
+
+    assert queue.claim('w2') == ('b', ['3'])
+    assert queue.claim('w3') is None
+
+    # only the worker holding a shard renews or finishes it:
+    assert not queue.heartbeat('a', 'w2')
+    assert not queue.finish('a', 'w2')
+    assert queue.heartbeat('a', 'w1')
+    assert queue.finish('a', 'w1')
+    assert not queue.finish('a', 'w1')
+    assert queue.status() == {'done' : 1, 'running' : 1}
+
+
+def test_lease_expiry(tmp_path):
+    queue = ShardQueue(str(tmp_path), lease_seconds = 0.2)
+    queue.add_shards({'a' : ['1']})
+    assert queue.claim('w1') == ('a', ['1'])
+    assert queue.claim('w2') is None
+
+    # a renewed lease is kept past lease_seconds:
+    with queue.lease('a', 'w1'):
+        time.sleep(0.5)
+        assert queue.claim('w2') is None
+
+    # a lapsed one goes to the next worker, and the first can no longer finish:
+    time.sleep(0.3)
+    assert queue.claim('w2') == ('a', ['1'])
+    assert not queue.heartbeat('a', 'w1')
+    assert not queue.finish('a', 'w1')
+    assert queue.finish('a', 'w2')
+    assert queue.status() == {'done' : 1}
+
+
+def _stat(strong_id, shots, errors, p = 1e-3, seconds = 1.0):
+    return sinter.TaskStats(strong_id = strong_id, decoder = 'bposd', json_metadata = {'p' : p},
+                            shots = shots, errors = errors, discards = 0, seconds = seconds)
+
+
+def _write(path, stats):
+    with open(path, 'w') as f:
+        print(sinter.CSV_HEADER, file = f)
+        for stat in stats:
+            print(stat.to_csv_line(), file = f)
+
+
+def test_stats_paths(tmp_path):
+    queue = ShardQueue(str(tmp_path))
+    # every worker of a shard has its own file:
+    paths = [queue.stats_path('a', worker) for worker in ['host-1:12', 'host/2:7', 'host-1:13']]
+    assert len(set(paths)) == 3
+    assert all(os.path.dirname(path) == os.path.join(str(tmp_path), 'shards') for path in paths)
+    for path in paths + [queue.stats_path('ab', 'host-1:12')]:
+        _write(path, [])
+    assert queue.stats_paths('a') == sorted(paths)
+
+
+def test_merge_shards(tmp_path):
+    queue = ShardQueue(str(tmp_path))
+    # a shard sampled by a worker that died and the one that took it over, and another shard:
+    _write(queue.stats_path('a', 'w1'), [_stat('x', 100, 3), _stat('y', 50, 1, p = 2e-3)])
+    _write(queue.stats_path('a', 'w2'), [_stat('x', 200, 5)])
+    _write(queue.stats_path('b', 'w1'), [_stat('z', 10, 0)])
+
+    stats = {stat.strong_id : stat for stat in merge_shards(str(tmp_path))}
+    assert stats == {'x' : _stat('x', 300, 8, seconds = 2.0), 'y' : _stat('y', 50, 1, p = 2e-3), 'z' : _stat('z', 10, 0)}
+    written = {stat.strong_id : stat for stat in sinter.read_stats_from_csv_files(os.path.join(tmp_path, 'stats.csv'))}
+    assert written == stats
+
+
+def test_workers_resume_each_other(tmp_path):
+    sweep = dict(embeddings = [[embedding_B1, log_obs], [embedding_B2, log_obs]], alphas = [1], ps = [1e-2, 2e-2],
+                 experiments = ['z_memory'], shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks,
+                 decoders = ('batch_bposd',), max_shots = 300, max_errors = 1000, shard_size = 3, num_workers = 1,
+                 chunk_size = 2, cache_dir = str(tmp_path / 'cache'))
+    first = {stat.strong_id : stat for stat in run_sharded_sweep(str(tmp_path / 'first'), **sweep)}
+    assert len(first) == 4 and all(stat.shots >= 300 for stat in first.values())
+    # one file per shard, of the only worker:
+    assert len(os.listdir(tmp_path / 'first' / 'shards')) == 2
+
+    # the shards of a worker that died after sampling everything are not sampled again by the next one:
+    os.makedirs(tmp_path / 'second' / 'shards')
+    for name in os.listdir(tmp_path / 'first' / 'shards'):
+        shutil.copy(tmp_path / 'first' / 'shards' / name, tmp_path / 'second' / 'shards' / (name.split('.')[0] + '.dead.csv'))
+    second = {stat.strong_id : stat for stat in run_sharded_sweep(str(tmp_path / 'second'), **sweep)}
+    assert second == first
+    queue = ShardQueue(str(tmp_path / 'second'))
+    assert queue.status() == {'done' : 2}
+    for shard_id in {name.split('.')[0] for name in os.listdir(tmp_path / 'second' / 'shards')}:
+        assert len(queue.stats_paths(shard_id)) == 2
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+import sinter
+
+from bp_decoder import BatchBpOsdDecoder
+from circuit_cache import CircuitCache
+from crossings_27_4_3 import A0_log_obs, embedding_A0, hamming_A0, rep3_checks
+from shot_store import ShotStore, compile_decoder, decode_bit_packed, decode_store, sample_store, \
+    sinter_detector_error_model
+
+PARAMS = dict(shape = (5, 10), row_checks = hamming_A0, col_checks = rep3_checks, crossings = embedding_A0[1],
+              observable = A0_log_obs['z'], rounds = 2, after_clifford_depolarization = 0.01,
+              after_crossing_depolarization = 0.01, after_reset_flip_probability = 0.01,
+              before_measure_flip_probability = 0.01)
+
+
+def test_sample_and_decode(tmp_path):
+    cache = CircuitCache(str(tmp_path))
+    circuit_path = cache.circuit_path(**PARAMS)
+    circuit = cache.circuit(**PARAMS)
+
+    # the store holds the shots of the seeded sampler, chunk by chunk:
+    store = sample_store(circuit_path, shots = 5000, chunk_size = 1500, seed = 7)
+    sampler = circuit.compile_detector_sampler(seed = 7)
+    chunks = [sampler.sample(n, separate_observables = True, bit_packed = True) for n in [1500, 1500, 1500, 500]]
+    detectors, observables = (np.concatenate(arrays) for arrays in zip(*chunks))
+    assert np.array_equal(store.detectors(), detectors)
+    assert np.array_equal(store.observables(), observables)
+    # a store with enough shots is reused as it is:
+    assert np.array_equal(sample_store(circuit_path, shots = 1000, seed = 8).detectors(), detectors)
+
+    decoders = {'batch_bposd' : BatchBpOsdDecoder(), 'batch_bposd_5' : BatchBpOsdDecoder(max_iter = 5)}
+    stats = decode_store(store, circuit_path, decoders, json_metadata = {'p' : 0.01}, chunk_size = 1200,
+                         max_workers = 2)
+
+    # the same errors as decoding all shots at once in this process:
+    dem = sinter_detector_error_model(circuit)
+    for stat in stats:
+        decoder = decoders[stat.decoder]
+        predictions = decode_bit_packed(decoder, compile_decoder(decoder, dem), dem, detectors)
+        errors = np.any(predictions != observables, axis = 1).sum()
+        assert stat.shots == 5000
+        assert stat.errors == errors
+        assert errors > 0
+
+    # and the strong_id that sinter gives the task:
+    collected = sinter.collect(num_workers = 1, max_shots = 100, custom_decoders = decoders,
+                               tasks = [sinter.Task(circuit_path = circuit_path, decoder = name,
+                                                    json_metadata = {'p' : 0.01}) for name in decoders])
+    assert ({stat.decoder : stat.strong_id for stat in stats}
+            == {stat.decoder : stat.strong_id for stat in collected})
+
+    # the store is left alone by the cache and removed by hand:
+    cache.clear()
+    assert store.exists()
+    store.remove()
+    assert not store.exists() and os.listdir(tmp_path) == []
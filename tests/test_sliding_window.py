@@ -0,0 +1,125 @@
+import numpy as np
+import pytest
+import scipy.sparse
+import stim
+from ldpc.ckt_noise.dem_matrices import detector_error_model_to_check_matrices
+
+from bp_decoder import BatchBpOsdDecoder
+from circuit import Layout, circuit_builder
+from crossings_27_4_3 import A1_log_obs, embedding_A1, hamming_A1, rep3_checks
+from shot_store import compile_decoder, decode_bit_packed
+from sliding_window import SlidingWindowDecoder, detector_rounds
+
+
+def compiled_check_matrix(dem : stim.DetectorErrorModel) -> scipy.sparse.csc_matrix:
+    matrices = detector_error_model_to_check_matrices(dem, allow_undecomposed_hyperedges = True)
+    return scipy.sparse.csc_matrix(matrices.check_matrix, dtype = np.uint8)
+
+
+def _circuit(experiment : str, rounds : int, p : float = 2e-3) -> stim.Circuit:
+    return circuit_builder(shape = (5, 10), row_checks = hamming_A1, col_checks = rep3_checks,
+                           crossings = embedding_A1[1], experiment = experiment,
+                           observable = A1_log_obs['x' if experiment == 'x_memory' else 'z'], rounds = rounds,
+                           after_clifford_depolarization = p, after_crossing_depolarization = p,
+                           after_reset_flip_probability = p, before_measure_flip_probability = p)
+
+
+@pytest.mark.parametrize('rounds', [1, 2, 5])
+@pytest.mark.parametrize('experiment', ['z_memory', 'x_memory'])
+def test_detector_coordinates(experiment, rounds):
+    # [row, col, 0] of the check, shifted by one round after the head and before the tail:
+    layout = Layout((5, 10), hamming_A1, rep3_checks)
+    checks = sorted(layout.x_checks if experiment == 'x_memory' else layout.z_checks)
+    dem = _circuit(experiment, rounds).detector_error_model()
+    coordinates = dem.get_detector_coordinates()
+    assert len(coordinates) == dem.num_detectors == (rounds + 1) * len(checks)
+
+    by_round = {}
+    for k in range(dem.num_detectors):
+        row, col, r = coordinates[k]
+        by_round.setdefault(r, []).append((row, col))
+    assert sorted(by_round) == list(range(rounds + 1))
+    assert all(sorted(detectors) == checks for detectors in by_round.values())
+
+    rounds_of = detector_rounds(dem)
+    assert np.array_equal(rounds_of, [coordinates[k][2] for k in range(dem.num_detectors)])
+    assert np.all(np.diff(rounds_of) >= 0)
+
+
+def test_detectors_need_rounds():
+    dem = stim.DetectorErrorModel('error(0.1) D0 D1\ndetector(0, 0) D0\ndetector D1')
+    with pytest.raises(ValueError):
+        detector_rounds(dem)
+
+
+def test_commit_leaves_a_buffer():
+    with pytest.raises(ValueError):
+        SlidingWindowDecoder(window = 3, commit = 3)
+
+
+@pytest.mark.parametrize('window, commit', [(2, 1), (3, 2), (4, 2)])
+def test_windows(window, commit):
+    rounds = 8
+    dem = _circuit('z_memory', rounds).detector_error_model()
+    compiled = SlidingWindowDecoder(window = window, commit = commit).compile_decoder_for_dem(dem = dem)
+    rounds_of = detector_rounds(dem)
+    H = compiled_check_matrix(dem)
+
+    starts = [w.start for w in compiled.windows]
+    assert starts == list(range(0, starts[-1] + 1, commit))
+    # the last window reaches the last round and no earlier one does:
+    assert [w.rows.stop == dem.num_detectors for w in compiled.windows] == [False] * (len(starts) - 1) + [True]
+    for w in compiled.windows:
+        # the window's rounds, and the one before it:
+        assert set(rounds_of[w.rows.start:w.rows.stop]) == set(range(max(w.start - 1, 0), min(w.start + window, rounds + 1)))
+        if w is compiled.windows[-1]:
+            assert w.commit.all()
+            continue
+        # committed mechanisms lie in the commit rounds, with a round of buffer after them:
+        committed = H[:, w.columns[w.commit]].tocsc()
+        assert set(rounds_of[committed.indices]) <= set(range(max(w.start - 1, 0), w.start + commit))
+        assert committed.indices.min() >= w.rows.start
+
+    # every mechanism that flips a detector is committed by exactly one window:
+    committed = np.concatenate([w.columns[w.commit] for w in compiled.windows])
+    assert sorted(committed.tolist()) == np.nonzero(np.diff(H.indptr))[0].tolist()
+
+
+@pytest.mark.parametrize('rounds', [12, 20])
+def test_bulk_windows_share_a_decoder(rounds):
+    dem = _circuit('z_memory', rounds).detector_error_model()
+    compiled = SlidingWindowDecoder(window = 4, commit = 2).compile_decoder_for_dem(dem = dem)
+    # the first window has no round before it and the last one commits
+    # everything, all the others are the same window shifted in time:
+    keys = [w.key for w in compiled.windows]
+    assert len(keys) == rounds // 2
+    assert len(set(keys[1:-1])) == 1
+    assert len(compiled.decoders) == 3
+
+
+def test_one_window_is_global_decoding():
+    rounds = 3
+    circuit = _circuit('z_memory', rounds)
+    dem = circuit.detector_error_model()
+    packed = circuit.compile_detector_sampler(seed = 5).sample(2000, bit_packed = True)
+
+    predictions = []
+    for decoder in [BatchBpOsdDecoder(), SlidingWindowDecoder(window = rounds + 1, commit = 1)]:
+        predictions.append(decode_bit_packed(decoder, compile_decoder(decoder, dem), dem, packed))
+    assert np.array_equal(*predictions)
+
+
+@pytest.mark.parametrize('experiment', ['z_memory', 'x_memory'])
+def test_agrees_with_global_decoding(experiment):
+    circuit = _circuit(experiment, rounds = 6)
+    dem = circuit.detector_error_model()
+    detectors, observables = circuit.compile_detector_sampler(seed = 6).sample(20000, separate_observables = True,
+                                                                               bit_packed = True)
+
+    errors = []
+    for decoder in [BatchBpOsdDecoder(), SlidingWindowDecoder(window = 4, commit = 2)]:
+        predictions = decode_bit_packed(decoder, compile_decoder(decoder, dem), dem, detectors)
+        errors.append(np.any(predictions != observables, axis = 1).sum())
+    global_errors, window_errors = errors
+    assert global_errors > 100
+    assert abs(window_errors - global_errors) <= 0.1 * global_errors
@@ -0,0 +1,87 @@
+import itertools
+
+import numpy as np
+import pytest
+import sinter
+import stim
+
+from circuit import circuit_builder
+from shot_store import sinter_detector_error_model
+from stratified import FaultStrata, elementary_symmetric, fault_count_probabilities, fault_mechanisms, sample_fault_sets
+from sweep import CUSTOM_DECODERS
+from test_circuit import embedding_B1, embedding_B2, log_obs, rep_3_checks, rep_3_mod_checks
+
+
+def _circuit(p : float, embedding = embedding_B1):
+    return circuit_builder(
+        shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks, crossings = embedding[1],
+        experiment = 'z_memory', observable = log_obs['z'], rounds = 3, after_clifford_depolarization = p,
+        after_crossing_depolarization = p, after_reset_flip_probability = p, before_measure_flip_probability = p)
+
+
+def test_fault_count_probabilities():
+    priors = np.array([0.1, 0.02, 0.3, 0.05, 0.2])
+    # against the sum over all subsets:
+    expected = np.zeros(len(priors) + 1)
+    for fired in itertools.product([0, 1], repeat = len(priors)):
+        expected[sum(fired)] += np.prod(np.where(fired, priors, 1 - priors))
+    assert np.allclose(fault_count_probabilities(priors, len(priors)), expected)
+    pairs = sum(a * b for a, b in itertools.combinations(priors, 2))
+    assert np.allclose(elementary_symmetric(priors, 2), [1, priors.sum(), pairs])
+
+
+@pytest.mark.parametrize('w', [1, 2, 3])
+def test_sample_fault_sets(w):
+    priors = np.array([0.1, 0.02, 0.3, 0.05, 0.2])
+    shots = 200000
+    sets = sample_fault_sets(priors, w, shots, np.random.default_rng(3))
+
+    # exactly w distinct mechanisms per set:
+    assert sets.shape == (shots, w)
+    assert np.all(np.diff(sets, axis = 1) > 0)
+
+    # with the probability of the set given that exactly w mechanisms fire:
+    odds = priors / (1 - priors)
+    subsets = list(itertools.combinations(range(len(priors)), w))
+    expected = np.array([np.prod(odds[list(subset)]) for subset in subsets]) / elementary_symmetric(odds, w)[w]
+    counts = {subset : 0 for subset in subsets}
+    for row in map(tuple, sets.tolist()):
+        counts[row] += 1
+    observed = np.array([counts[subset] for subset in subsets])
+    sigma = np.sqrt(shots * expected * (1 - expected))
+    assert np.all(np.abs(observed - shots * expected) < 5 * sigma)
+
+
+def test_agrees_with_direct_sampling():
+    p0 = 5e-3
+    circuit = _circuit(p0)
+    dem = sinter_detector_error_model(circuit)
+    strata = FaultStrata.sample(dem, CUSTOM_DECODERS['batch_bposd'](), max_faults = 6, shots_per_stratum = 20000,
+                                seed = 11)
+    estimate = strata.failure_rate(dem)
+    assert estimate['truncation'] < 1e-3 * estimate['rate']
+
+    # within the error bars of both:
+    stat, = sinter.collect(num_workers = 2, max_shots = 200000,
+                           custom_decoders = {'batch_bposd' : CUSTOM_DECODERS['batch_bposd']()},
+                           tasks = [sinter.Task(circuit = circuit, decoder = 'batch_bposd')])
+    direct = stat.errors / stat.shots
+    sigma = np.sqrt(direct * (1 - direct) / stat.shots)
+    assert estimate['low'] - 3 * sigma < direct < estimate['high'] + 3 * sigma
+
+    # the same mechanisms at another p, or with the crossings of another embedding, reweight:
+    assert strata.failure_rate(sinter_detector_error_model(_circuit(2 * p0)))['rate'] > estimate['rate']
+    assert strata.failure_rate(sinter_detector_error_model(_circuit(p0, embedding_B2)))['rate'] != estimate['rate']
+
+    # others are rejected, also as many mechanisms in another order:
+    errors = [instruction for instruction in dem.flattened() if instruction.type == 'error']
+    shuffled = stim.DetectorErrorModel()
+    for instruction in errors[::-1]:
+        shuffled.append(instruction)
+    assert len(fault_mechanisms(shuffled)[2]) == len(strata.priors)
+    with pytest.raises(ValueError):
+        strata.failure_rate(shuffled)
+    with pytest.raises(ValueError):
+        strata.failure_rate(sinter_detector_error_model(circuit_builder(
+            shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks, crossings = embedding_B1[1],
+            experiment = 'z_memory', observable = log_obs['z'], rounds = 4, after_clifford_depolarization = p0)))
@@ -0,0 +1,179 @@
+import numpy as np
+import pytest
+import sinter
+
+import sweep
+from circuit import BuildStatsCollector
+from circuit_cache import CircuitCache
+from sweep import (collect_in_chunks, curve_crossovers, finished_tasks, generate_tasks, refine_points,
+                   run_adaptive_sweep, run_sweep, task_key)
+from test_circuit import embedding_B1, embedding_B2, log_obs, rep_3_checks, rep_3_mod_checks
+
+# a [[13, 1, 2]] grid of 2 embeddings x 2 p x 1 decoder:
+GRID = dict(embeddings = [[embedding_B1, log_obs], [embedding_B2, log_obs]], alphas = [1.0], ps = [1e-2, 2e-2],
+            experiments = ['z_memory'], shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks,
+            decoders = ('batch_bposd',))
+
+# logical error rates of two embeddings that cross each other at p = 10^-2.5 / 2 and where B1
+# crosses p at 10^-2.5, all between 10^-3 and 10^-2:
+RATES = {r'$B_1$' : lambda p: 10**2.5 * p**2, r'$B_2$' : lambda p: p / 2}
+
+
+def _stat(crossing : str, p : float, shots : int, alpha : float = 1.0, errors : int | None = None) -> sinter.TaskStats:
+    return sinter.TaskStats(
+        strong_id = f'{crossing}-{alpha}-{p}',
+        decoder = 'bposd',
+        json_metadata = {'p' : p, 'alpha' : alpha, 'crossing' : crossing, 'experiment' : 'z_memory'},
+        shots = shots,
+        errors = round(RATES[crossing](p) * shots) if errors is None else errors,
+    )
+
+
+def test_generate_tasks_is_lazy(tmp_path):
+    collector = BuildStatsCollector()
+    cache = CircuitCache(str(tmp_path), build_hook = collector)
+    tasks = generate_tasks(**GRID, cache = cache)
+    assert collector.builds == []
+    first = next(tasks)
+    assert len(collector.builds) == 1
+    assert str(first.circuit_path) in cache.pinned
+
+    # skipped tasks are never built:
+    keys = [task_key(task.decoder, task.json_metadata) for task in generate_tasks(**GRID, cache = cache)]
+    assert len(keys) == 4 and len(collector.builds) == 4
+    collector.builds.clear()
+    cache = CircuitCache(str(tmp_path / 'other'), build_hook = collector)
+    rest = generate_tasks(**GRID, cache = cache, skip = set(keys[::2]))
+    rest = [task_key(task.decoder, task.json_metadata) for task in rest]
+    assert rest == keys[1::2] and len(collector.builds) == 2
+
+
+def test_finished_tasks(tmp_path):
+    path = str(tmp_path / 'stats.csv')
+    assert finished_tasks(path, 100, 10) == set()
+    stats = {name : sinter.TaskStats(strong_id = name, decoder = 'bposd', json_metadata = {'p' : p},
+                                     shots = shots, errors = errors)
+             for name, p, shots, errors in [('shots', 1, 100, 2), ('errors', 2, 50, 10), ('neither', 3, 99, 9)]}
+    with open(path, 'w') as f:
+        print(sinter.CSV_HEADER, file = f)
+        for stat in stats.values():
+            print(stat.to_csv_line(), file = f)
+    assert finished_tasks(path, 100, 10) == {task_key('bposd', {'p' : p}) for p in [1, 2]}
+    assert finished_tasks(path, 99, 11) == {task_key('bposd', {'p' : p}) for p in [1, 3]}
+
+
+def test_collect_in_chunks(monkeypatch):
+    # the next chunk is built while one samples, not more:
+    pulled = []
+    chunks = []
+
+    def tasks():
+        for k in range(10):
+            pulled.append(k)
+            yield k
+
+    def collect(tasks, **options):
+        chunks.append((list(tasks), len(pulled)))
+        return [_stat(r'$B_1$', 1e-3 * (k + 1), 100) for k in tasks]
+
+    monkeypatch.setattr(sinter, 'collect', collect)
+    stats = collect_in_chunks(tasks(), chunk_size = 4, max_shots = 100)
+    assert [chunk for chunk, _ in chunks] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert all(n <= 4 * (k + 2) for k, (_, n) in enumerate(chunks))
+    assert len(stats) == 10
+
+
+def test_run_sweep_resumes(tmp_path):
+    options = dict(**GRID, max_shots = 300, max_errors = 10**4, num_workers = 1, chunk_size = 3,
+                   resume_file = str(tmp_path / 'stats.csv'))
+
+    def counts(stats):
+        return {stat.strong_id : (stat.shots, stat.errors) for stat in stats}
+
+    first = counts(run_sweep(**options, cache_dir = str(tmp_path / 'cache')))
+    assert len(first) == 4 and all(shots >= 300 for shots, _ in first.values())
+    assert counts(sinter.read_stats_from_csv_files(options['resume_file'])) == first
+
+    # every task is finished, so nothing is built (in a fresh cache) or sampled again:
+    collector = BuildStatsCollector()
+    second = run_sweep(**options, cache_dir = str(tmp_path / 'other'), build_hook = collector)
+    assert collector.builds == []
+    assert counts(second) == first
+    assert counts(sinter.read_stats_from_csv_files(options['resume_file'])) == first
+
+
+def test_refine_points():
+    ps = [1e-3, 1e-2, 1e-1 / 4]
+    stats = [_stat(crossing, p, 10**6) for crossing in RATES for p in ps[:2]]
+    # the third point only has a few shots, so the curves are tied with p there, but in the same order:
+    stats += [_stat(crossing, ps[2], 20, errors = errors) for crossing, errors in zip(RATES, [1, 0])]
+
+    new_points, contested = refine_points(stats)
+    # the crossing interval is split geometrically, with the shots of its ends:
+    assert list(new_points.items()) == [(('z_memory', 1.0, pytest.approx(10**-2.5)), 10**6)]
+    assert contested == {('z_memory', 1.0, p) for p in ps}
+
+    # but not below min_p_ratio:
+    assert refine_points(stats, min_p_ratio = 20)[0] == {}
+
+    # along alpha, with the same rule:
+    stats = [_stat(crossing, 1e-2, 10**6, alpha = alpha, errors = round(RATES[crossing](1e-2 * alpha) * 10**6))
+             for crossing in RATES for alpha in [0.1, 1.0]]
+    assert list(refine_points(stats)[0].items()) == [(('z_memory', pytest.approx(0.55), 1e-2), 10**6)]
+    assert refine_points(stats, min_alpha_step = 1)[0] == {}
+
+
+def test_curve_crossovers():
+    stats = [_stat(crossing, p, 10**9) for crossing in RATES for p in [1e-3, 1e-2]]
+    crossovers = {crossover['curves'] : crossover['p'] for crossover in curve_crossovers(stats)}
+    # both are power laws, so log-log interpolation is exact:
+    B1, B2 = (r'$B_1$', 'bposd'), (r'$B_2$', 'bposd')
+    assert crossovers == {(B1, B2) : pytest.approx(10**-2.5 / 2, rel = 1e-5),
+                          (B1, 'p') : pytest.approx(10**-2.5, rel = 1e-5)}
+
+
+def test_adaptive_sweep(tmp_path, monkeypatch):
+    # sinter is replaced by exact sampling of RATES, accumulating shots like a resume file:
+    sampled = {}
+    passes = []
+
+    def collect(tasks, **options):
+        requests = {}
+        for task in tasks:
+            meta = task.json_metadata
+            key = (meta['crossing'], meta['p'])
+            requests[key] = task.collection_options.max_shots
+            sampled[key] = _stat(meta['crossing'], meta['p'], task.collection_options.max_shots)
+        passes.append(requests)
+        return list(sampled.values())
+
+    monkeypatch.setattr(sweep, 'collect_in_chunks', collect)
+    stats = run_adaptive_sweep(
+        embeddings = [[embedding_B1, log_obs], [embedding_B2, log_obs]], alphas = [1.0], ps = [1e-3, 1e-2],
+        experiments = ['z_memory'], shape = (5, 5), row_checks = rep_3_mod_checks, col_checks = rep_3_checks,
+        initial_shots = 10**4, max_shots = 10**5, max_errors = 150, min_p_ratio = 2, max_passes = 20,
+        resume_file = str(tmp_path / 'sweep.csv'), cache_dir = str(tmp_path / 'cache'))
+
+    # the first pass samples the grid, the second also the middle of the crossing interval,
+    # starting from the shots of its ends:
+    assert set(passes[0]) == {(crossing, p) for crossing in RATES for p in [1e-3, 1e-2]}
+    midpoint = [key for key in passes[1] if key[1] not in (1e-3, 1e-2)]
+    assert {crossing for crossing, _ in midpoint} == set(RATES)
+    assert all(p == pytest.approx(10**-2.5) for _, p in midpoint)
+    assert all(passes[1][key] == 10**4 for key in midpoint)
+
+    # B1 at 1e-2 has 1000 errors after the first pass, so it is never sampled again, and
+    # neither is any other task once it reached max_errors:
+    errors = {}
+    for requests in passes:
+        assert not any(errors.get(key, 0) >= 150 for key in requests)
+        errors |= {key : round(RATES[key[0]](key[1]) * shots) for key, shots in requests.items()}
+    assert (r'$B_1$', 1e-2) not in set().union(*passes[1:])
+
+    # shots double every pass, up to max_shots, after which the sweep stops by itself:
+    for before, after in zip(passes, passes[1:]):
+        for key in before.keys() & after.keys():
+            assert after[key] == min(2 * before[key], 10**5)
+    assert len(passes) < 20
+    assert all(p in (1e-3, 1e-2) or 1e-3 < p < 1e-2 for _, p in sampled)
+    assert {(stat.json_metadata['crossing'], stat.json_metadata['p']) for stat in stats} == set(sampled)